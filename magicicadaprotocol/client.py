@@ -28,17 +28,26 @@
 """The storage protocol client."""
 
 import logging
+import mmap
+import os
+import time
 import uuid
+import zlib
 
 from functools import partial
-from itertools import chain
 
+from twisted.internet.error import ConnectionClosed
+from twisted.internet.interfaces import IPushProducer
 from twisted.internet.protocol import ClientFactory
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, threads
 from twisted.python import log
+from twisted.python.failure import Failure
+from zope.interface import implementer
 
 from magicicadaprotocol import (
+    content_hash,
     delta,
+    errors,
     protocol_pb2,
     public_file_info,
     request,
@@ -48,6 +57,13 @@ from magicicadaprotocol import (
 
 log_debug = partial(log.msg, loglevel=logging.DEBUG)
 
+# the capability for servers that take the hashes and sizes of an upload
+# at its end, in the EOF message
+SIZES_AT_END_CAP = "sizes-at-end"
+
+# the content sources that are sliced from a memory mapping instead of read
+MAPPED_SOURCE_TYPES = (str, bytes, os.PathLike, mmap.mmap)
+
 
 class StorageClient(request.RequestHandler):
     """A Basic Storage Protocol client."""
@@ -73,6 +89,29 @@ class StorageClient(request.RequestHandler):
 
         self.line_mode = True
         self.max_payload_size = request.MAX_PAYLOAD_SIZE
+        # set when set_caps succeeds with SIZES_AT_END_CAP
+        self.sizes_at_end = False
+        # how many holders want the reads paused, see pauseReads
+        self.reads_paused = 0
+
+    def pauseReads(self):
+        """Pause reading from the transport.
+
+        Each pauseReads must be undone by a resumeReads, the transport is
+        resumed only when nobody wants it paused anymore.
+
+        """
+        self.reads_paused += 1
+        if self.reads_paused == 1:
+            self.transport.pauseProducing()
+
+    def resumeReads(self):
+        """Undo a pauseReads."""
+        if self.reads_paused == 0:
+            return
+        self.reads_paused -= 1
+        if self.reads_paused == 0:
+            self.transport.resumeProducing()
 
     def protocol_version(self):
         """Ask for the protocol version
@@ -257,15 +296,17 @@ class StorageClient(request.RequestHandler):
         offset=0,
         callback=None,
         node_attr_callback=None,
+        sink=None,
     ):
         """Get the content of node with 'a_hash'.
 
         the content will be on request.content
-        or callback will be called for every piece that arrives.
+        or callback will be called for every piece that arrives,
+        or it will be written to sink as it arrives.
 
         """
         req = self.get_content_request(
-            share, node, a_hash, offset, callback, node_attr_callback
+            share, node, a_hash, offset, callback, node_attr_callback, sink
         )
         return req.deferred
 
@@ -277,19 +318,42 @@ class StorageClient(request.RequestHandler):
         offset=0,
         callback=None,
         node_attr_callback=None,
+        sink=None,
     ):
         """Get the content of node with 'a_hash', return the request.
 
         The content will be on request.content, or callback will be
-        called for every piece that arrives.
+        called for every piece that arrives, or it will be written to
+        sink (a path, a file descriptor or a file-like object, see
+        ContentSink) as it arrives.
 
         """
         p = GetContent(
-            self, share, node, a_hash, offset, callback, node_attr_callback
+            self,
+            share,
+            node,
+            a_hash,
+            offset,
+            callback,
+            node_attr_callback,
+            sink,
         )
         p.start()
         return p
 
+    def get_contents(self, items, window=8, callback=None):
+        """Get the content of many nodes, keeping 'window' requests open.
+
+        'items' is an iterable of (share, node, hash) tuples.
+        'callback' is called with (share, node, data) for each finished
+        download instead of collecting them in request.results; if it
+        returns a deferred the next download waits for it.
+
+        """
+        r = MultiGetContent(self, items, window, callback)
+        r.start()
+        return r.deferred
+
     def put_content(
         self,
         share,
@@ -303,6 +367,7 @@ class StorageClient(request.RequestHandler):
         upload_id=None,
         upload_id_cb=None,
         magic_hash=None,
+        deflate=False,
     ):
         """Put the content of fd into file node."""
         req = self.put_content_request(
@@ -317,6 +382,7 @@ class StorageClient(request.RequestHandler):
             upload_id=upload_id,
             upload_id_cb=upload_id_cb,
             magic_hash=magic_hash,
+            deflate=deflate,
         )
         return req.deferred
 
@@ -333,6 +399,7 @@ class StorageClient(request.RequestHandler):
         upload_id=None,
         upload_id_cb=None,
         magic_hash=None,
+        deflate=False,
     ):
         """Put the content of fd into file node, return the request."""
         p = PutContent(
@@ -348,10 +415,73 @@ class StorageClient(request.RequestHandler):
             upload_id=upload_id,
             upload_id_cb=upload_id_cb,
             magic_hash=magic_hash,
+            deflate=deflate,
         )
         p.start()
         return p
 
+    def upload_file(
+        self,
+        share,
+        node,
+        previous_hash,
+        path,
+        upload_id=None,
+        upload_id_cb=None,
+    ):
+        """Put the content of the file at path into file node.
+
+        The content is compressed while it's sent, so no compressed copy
+        is written to disk. If the server takes the hashes and sizes at
+        the end (self.sizes_at_end) the file is read only once; if not,
+        it's hashed first in a thread.
+
+        Return a deferred with the PutContent request.
+
+        """
+        if self.sizes_at_end:
+            d = defer.succeed(None)
+        else:
+            d = threads.deferToThread(content_hash.hash_file, path)
+        d.addCallback(
+            self._upload_file,
+            share,
+            node,
+            previous_hash,
+            path,
+            upload_id,
+            upload_id_cb,
+        )
+        return d
+
+    def _upload_file(
+        self, info, share, node, previous_hash, path, upload_id, upload_id_cb
+    ):
+        """Upload the file, with its UploadInfo if there's one."""
+        kwargs = dict(
+            upload_id=upload_id, upload_id_cb=upload_id_cb, deflate=True
+        )
+        if info is None:
+            args = (None, None, None, None)
+        else:
+            args = (info.hash, info.crc32, info.size, info.deflated_size)
+            kwargs['magic_hash'] = info.magic_hash._magic_hash
+        fh = open(path, 'rb')
+        try:
+            req = self.put_content_request(
+                share, node, previous_hash, *args, fh, **kwargs
+            )
+        except Exception:
+            fh.close()
+            raise
+        req.deferred.addBoth(self._uploaded_file, fh)
+        return req.deferred
+
+    def _uploaded_file(self, result, fh):
+        """The upload finished, close the file."""
+        fh.close()
+        return result
+
     def query(self, items):
         """Get the current hash for items if changed.
 
@@ -362,8 +492,28 @@ class StorageClient(request.RequestHandler):
         r.start()
         return r.deferred
 
+    def query_stream(self, items, max_in_flight=4, on_state=None):
+        """Get the current hash for items, keeping few queries open.
+
+        'items' is an iterable of (share, node, hash) tuples, consumed
+        as the queries are built; at most 'max_in_flight' Query requests
+        are open at the same time.
+        'on_state' is called with each NODE_STATE received instead of
+        collecting them in request.response.
+
+        """
+        r = StreamingQuery(self, items, max_in_flight, on_state)
+        r.start()
+        return r.deferred
+
     def get_delta(
-        self, share_id, from_generation=None, callback=None, from_scratch=False
+        self,
+        share_id,
+        from_generation=None,
+        callback=None,
+        from_scratch=False,
+        batch=None,
+        lazy=False,
     ):
         """Get a delta for a share_id
 
@@ -372,12 +522,46 @@ class StorageClient(request.RequestHandler):
         'callback' can be specified to get deltas as they get instead of
             getting them all at once at the end.
         'from_scratch' at True means list all live nodes.
+        'batch' is a delta.DeltaBatch to fill with the deltas, to hold
+            them in columns instead of one object each.
+        'lazy' at True gives deltas that read their fields from the
+            message only when used.
 
         """
-        r = GetDelta(self, share_id, from_generation, callback, from_scratch)
+        r = GetDelta(
+            self,
+            share_id,
+            from_generation,
+            callback,
+            from_scratch,
+            batch,
+            lazy,
+        )
         r.start()
         return r.deferred
 
+    def get_delta_stream(
+        self,
+        share_id,
+        from_generation=None,
+        from_scratch=False,
+        max_pending=10000,
+        lazy=False,
+    ):
+        """Get a delta for a share_id, to be pulled in batches.
+
+        Return the started DeltaStream, which hands the deltas with
+        next_batch() or 'async for', pausing the transport while more
+        than 'max_pending' deltas are not taken. Its 'checkpoint' is the
+        generation to resume the delta from if the connection is lost.
+
+        """
+        r = DeltaStream(
+            self, share_id, from_generation, from_scratch, max_pending, lazy
+        )
+        r.start()
+        return r
+
     def get_free_space(self, share_id):
         """Get quota info for the given share (or the user's own space)."""
         r = FreeSpaceInquiry(self, share_id)
@@ -632,10 +816,119 @@ class StorageClient(request.RequestHandler):
         return r.deferred
 
 
+class ContentSink:
+    """Write the content of a download as it arrives.
+
+    The bytes received are written untouched, and inflated on the fly to
+    compute the size, hash and crc32 of the content, so it can be checked
+    against what the server announced without reading it again.
+
+    Only a content received from its start can be inflated; for the rest
+    of one (a resumed download) only deflated_size is computed.
+
+    @ivar deflated_size: the amount of bytes received
+    @ivar size: the size of the inflated content
+    @ivar crc32: the crc32 of the inflated content
+    @ivar hash: the hash of the inflated content (available when finished)
+    @ivar inflater: the decompressor, None if not inflating
+
+    """
+
+    # the max size of each inflated piece, to bound memory
+    inflate_size = 2**20
+
+    def __init__(self, target, inflate=True):
+        """Create a ContentSink.
+
+        @param target: a path to create, a file descriptor, or a file-like
+            object to write the content to; paths are closed when done,
+            the others are left open
+        @param inflate: if the content is received from its start, to
+            inflate it and compute its size, hash and crc32
+
+        """
+        self.fd = None
+        self.fh = None
+        self.owned = False
+        if isinstance(target, str):
+            self.fh = open(target, 'wb')
+            self.owned = True
+        elif isinstance(target, int):
+            self.fd = target
+        else:
+            self.fh = target
+        self.deflated_size = 0
+        self.size = 0
+        self.crc32 = 0
+        self.hash = None
+        self.hasher = content_hash.content_hash_factory()
+        self.inflater = zlib.decompressobj() if inflate else None
+
+    def write(self, data):
+        """Write and account for a piece of the content."""
+        self.deflated_size += len(data)
+        if self.fd is not None:
+            view = memoryview(data)
+            while view:
+                written = os.write(self.fd, view)
+                view = view[written:]
+        else:
+            self.fh.write(data)
+
+        if self.inflater is None:
+            return
+        inflated = self.inflater.decompress(data, self.inflate_size)
+        while inflated:
+            self._account(inflated)
+            inflated = self.inflater.decompress(
+                self.inflater.unconsumed_tail, self.inflate_size
+            )
+
+    def _account(self, inflated):
+        """Update the size, crc32 and hash with inflated data."""
+        self.size += len(inflated)
+        self.crc32 = content_hash.crc32(inflated, self.crc32)
+        self.hasher.update(inflated)
+
+    def finish(self):
+        """All the content was received, compute the final values."""
+        if self.inflater is not None:
+            self._account(self.inflater.flush())
+            self.hash = self.hasher.content_hash()
+        self.close()
+
+    def close(self):
+        """Close the target, if it was opened here."""
+        if self.owned and not self.fh.closed:
+            self.fh.close()
+
+    def check(self, deflated_size, size, hash, crc32):
+        """Compare with the given values.
+
+        Return a list of (name, expected, received) for the ones that
+        don't match.
+
+        """
+        mismatches = []
+        for name, expected in [
+            ('deflated_size', deflated_size),
+            ('size', size),
+            ('hash', hash),
+            ('crc32', crc32),
+        ]:
+            received = getattr(self, name)
+            if expected != received:
+                mismatches.append((name, expected, received))
+        return mismatches
+
+
 class GetContent(request.Request):
     """A Request to get the content of a node id.
 
-    @ivar data: the content of the node (available upon success)
+    @ivar data: the content of the node (available upon success, if called
+        without callback nor sink)
+    @ivar sink: the ContentSink the content is written to, if any
+    @ivar node_attr: the NodeAttr message received, if any
 
     """
 
@@ -648,6 +941,8 @@ class GetContent(request.Request):
         'node_attr_callback',
         'parts',
         'data',
+        'sink',
+        'node_attr',
     )
 
     def __init__(
@@ -659,6 +954,7 @@ class GetContent(request.Request):
         offset=0,
         callback=None,
         node_attr_callback=None,
+        sink=None,
     ):
         """Request the content of node with 'a_hash'.
 
@@ -668,8 +964,15 @@ class GetContent(request.Request):
         @param a_hash: the hash of the content of the version we have
         @param offset: offset for reading
         @param callback: function to call when data arrives
+        @param node_attr_callback: function to call with the node attributes
+        @param sink: a ContentSink, or a path, file descriptor or file-like
+            object to build one, to write the data to as it arrives; when
+            getting the whole content it's also verified against the node
+            attributes (not to be used with callback)
 
         """
+        if callback is not None and sink is not None:
+            raise ValueError("Use a callback or a sink, not both.")
         request.Request.__init__(self, protocol)
         self.share = share
         self.node_id = node_id
@@ -678,6 +981,14 @@ class GetContent(request.Request):
         self.callback = callback
         self.node_attr_callback = node_attr_callback
         self.parts = []
+        if sink is not None:
+            if not isinstance(sink, ContentSink):
+                sink = ContentSink(sink, inflate=not offset)
+            elif offset:
+                # the content doesn't start at the deflate header
+                sink.inflater = None
+        self.sink = sink
+        self.node_attr = None
 
     def _start(self):
         """Send GET_CONTENT."""
@@ -692,6 +1003,7 @@ class GetContent(request.Request):
     def processMessage(self, message):
         """Process messages."""
         if message.type == protocol_pb2.Message.NODE_ATTR:
+            self.node_attr = message.node_attr
             if self.node_attr_callback is not None:
                 self.node_attr_callback(
                     deflated_size=message.node_attr.deflated_size,
@@ -705,6 +1017,8 @@ class GetContent(request.Request):
                 return
             if self.callback is not None:
                 self.callback(message.bytes.bytes)
+            elif self.sink is not None:
+                self.sink.write(message.bytes.bytes)
             else:
                 self.parts.append(message.bytes.bytes)
         elif message.type == protocol_pb2.Message.EOF:
@@ -713,8 +1027,20 @@ class GetContent(request.Request):
                 # end.
                 self.done()
                 return
-            if self.callback is None:
+            if self.callback is None and self.sink is None:
                 self.data = b"".join(self.parts)
+            elif self.sink is not None:
+                self.sink.finish()
+                if self.offset == 0 and self.node_attr is not None:
+                    mismatches = self.sink.check(
+                        deflated_size=self.node_attr.deflated_size,
+                        size=self.node_attr.size,
+                        hash=self.node_attr.hash,
+                        crc32=self.node_attr.crc32,
+                    )
+                    if mismatches:
+                        self.error(errors.ContentVerificationError(mismatches))
+                        return
             self.done()
         elif message.type == protocol_pb2.Message.OK:
             self.done()
@@ -723,6 +1049,12 @@ class GetContent(request.Request):
         else:
             self._default_process_message(message)
 
+    def cleanup(self):
+        """Also close the sink."""
+        request.Request.cleanup(self)
+        if self.sink is not None:
+            self.sink.close()
+
     def _cancel(self):
         """Cancel the current download."""
         message = protocol_pb2.Message()
@@ -730,6 +1062,126 @@ class GetContent(request.Request):
         self.sendMessage(message)
 
 
+@implementer(IPushProducer)
+class MultiGetContent:
+    """Create a Request-like object that gets the content of many nodes.
+
+    At most 'window' GetContent requests are kept in flight over the
+    connection, the next one is started as soon as one of them finishes.
+    If the connection is lost or the producer stopped, no more downloads
+    are started, and the deferred fails when the ones in flight finish.
+
+    @ivar results: the (share, node, data) of each download (available upon
+        success, if called without callback)
+    @ivar failures: the (share, node, failure) of each failed download
+    @ivar error: the failure that stopped the downloads, if any
+
+    """
+
+    __slots__ = (
+        'protocol',
+        'items',
+        'window',
+        'callback',
+        'results',
+        'failures',
+        'in_flight',
+        'exhausted',
+        'producing',
+        'error',
+        'deferred',
+    )
+
+    def __init__(self, protocol, items, window=8, callback=None):
+        """Create a multi get content.
+
+        @param protocol: the request handler
+        @param items: an iterable of (share, node, hash) tuples
+        @param window: how many downloads to keep in flight
+        @param callback: function to call with (share, node, data) for each
+            finished download, the next download waits for it if it
+            returns a deferred
+
+        """
+        if window < 1:
+            raise ValueError("window must be at least 1.")
+        self.protocol = protocol
+        self.items = iter(items)
+        self.window = window
+        self.callback = callback
+        self.results = []
+        self.failures = []
+        self.in_flight = 0
+        self.exhausted = False
+        self.producing = True
+        self.error = None
+        self.deferred = defer.Deferred()
+
+    def start(self):
+        """Start the first downloads."""
+        self._fill()
+
+    def resumeProducing(self):
+        """IPushProducer interface."""
+        self.producing = True
+        self._fill()
+
+    def pauseProducing(self):
+        """IPushProducer interface."""
+        self.producing = False
+
+    def stopProducing(self):
+        """IPushProducer interface."""
+        self.producing = False
+        if self.error is None:
+            self.error = Failure(request.RequestCancelledError("STOPPED"))
+        self._fill()
+
+    def _fill(self):
+        """Start downloads until the window is full."""
+        while (
+            self.error is None
+            and self.producing
+            and not self.exhausted
+            and self.in_flight < self.window
+        ):
+            try:
+                share, node, a_hash = next(self.items)
+            except StopIteration:
+                self.exhausted = True
+                break
+            self.in_flight += 1
+            req = self.protocol.get_content_request(share, node, a_hash)
+            d = req.deferred
+            d.addCallback(self._got_content, share, node)
+            d.addErrback(self._failed, share, node)
+            d.addBoth(self._finished)
+
+        if self.in_flight or self.deferred.called:
+            return
+        if self.error is not None:
+            self.deferred.errback(self.error)
+        elif self.exhausted:
+            self.deferred.callback(self)
+
+    def _got_content(self, req, share, node):
+        """Hand the content to the callback, or store it."""
+        if self.callback is not None:
+            return self.callback(share, node, req.data)
+        self.results.append((share, node, req.data))
+
+    def _failed(self, failure, share, node):
+        """Store the failure, and stop if the connection is gone."""
+        self.failures.append((share, node, failure))
+        if self.error is None and failure.check(ConnectionClosed):
+            self.error = failure
+
+    def _finished(self, _):
+        """A download finished, start the next one."""
+        self.in_flight -= 1
+        self._fill()
+
+
 class ListShares(request.Request):
     """List all the shares the user is involved.
 
@@ -1152,6 +1604,36 @@ class Move(request.Request):
             self._default_process_message(message)
 
 
+def _varint_size(value):
+    """Return the size of value encoded as a varint."""
+    size = 1
+    while value > 0x7F:
+        value >>= 7
+        size += 1
+    return size
+
+
+def _string_field_size(value):
+    """Return the encoded size of a (small numbered) string field."""
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return 1 + _varint_size(len(value)) + len(value)
+
+
+def query_item_size(share, node, a_hash):
+    """Return how much a (share, node, hash) item adds to a QUERY message.
+
+    That is the size of the Query entry, plus its tag and length.
+
+    """
+    size = (
+        _string_field_size(share)
+        + _string_field_size(str(node))
+        + _string_field_size(a_hash)
+    )
+    return 1 + _varint_size(size) + size
+
+
 class MultiQuery:
     """Create a Request-like object that encapsulates many Query requests
 
@@ -1172,14 +1654,14 @@ class MultiQuery:
         items = iter(items)
         defers = []
         self.queries = []
+        overflow = None
 
         while True:
-            r = Query(protocol, items)
+            r = Query(protocol, items, first=overflow)
             self.queries.append(r)
             defers.append(r.deferred)
-            if r.overflow:
-                items = chain([r.overflow], items)
-            else:
+            overflow = r.overflow
+            if overflow is None:
                 break
 
         self.deferred = defer.DeferredList(defers, consumeErrors=True)
@@ -1190,17 +1672,113 @@ class MultiQuery:
             q.start()
 
 
+class StreamingQuery:
+    """Create a Request-like object that queries many items a few at a time.
+
+    The Query requests are built lazily from the items, and at most
+    'max_in_flight' of them are kept open over the connection. If the
+    connection is lost no more queries are started, and the deferred
+    fails when the ones in flight finish.
+
+    @ivar response: the node state messages that were received (if called
+        without on_state)
+    @ivar failures: the failure of each failed Query
+    @ivar error: the failure that stopped the queries, if any
+
+    """
+
+    __slots__ = (
+        'protocol',
+        'items',
+        'overflow',
+        'max_in_flight',
+        'on_state',
+        'response',
+        'failures',
+        'in_flight',
+        'exhausted',
+        'error',
+        'deferred',
+    )
+
+    def __init__(self, protocol, items, max_in_flight=4, on_state=None):
+        """Create a streaming query.
+
+        @param protocol: the request handler
+        @param items: an iterable of (share, node, hash) tuples
+        @param max_in_flight: how many queries to keep open
+        @param on_state: function to call with each node state received
+
+        """
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1.")
+        self.protocol = protocol
+        self.items = iter(items)
+        self.overflow = None
+        self.max_in_flight = max_in_flight
+        self.response = []
+        self.on_state = self.response.append if on_state is None else on_state
+        self.failures = []
+        self.in_flight = 0
+        self.exhausted = False
+        self.error = None
+        self.deferred = defer.Deferred()
+
+    def start(self):
+        """Start the first queries."""
+        self._fill()
+
+    def _fill(self):
+        """Build and start queries until there are enough in flight."""
+        while (
+            self.error is None
+            and not self.exhausted
+            and self.in_flight < self.max_in_flight
+        ):
+            query = Query(
+                self.protocol, self.items, self.on_state, self.overflow
+            )
+            self.overflow = query.overflow
+            if query.overflow is None:
+                self.exhausted = True
+                if not query.query_message.query:
+                    break
+            self.in_flight += 1
+            query.deferred.addErrback(self._failed)
+            query.deferred.addBoth(self._finished)
+            query.start()
+
+        if self.in_flight or self.deferred.called:
+            return
+        if self.error is not None:
+            self.deferred.errback(self.error)
+        elif self.exhausted:
+            self.deferred.callback(self)
+
+    def _failed(self, failure):
+        """Store the failure, and stop if the connection is gone."""
+        self.failures.append(failure)
+        if self.error is None and failure.check(ConnectionClosed):
+            self.error = failure
+
+    def _finished(self, _):
+        """A query finished, start the next one."""
+        self.in_flight -= 1
+        self._fill()
+
+
 class Query(request.Request):
     """Query about the hash of a node_id.
 
     @ivar remains: the items that could not fit in the query
-    @ivar response: the node state messages that were received
+    @ivar response: the node state messages that were received (if called
+        without on_state)
 
     """
 
-    __slots__ = ('query_message', 'response', 'overflow')
+    __slots__ = ('query_message', 'response', 'overflow', 'on_state')
 
-    def __init__(self, protocol, items):
+    def __init__(self, protocol, items, on_state=None, first=None):
         """Generate a query message to send to the server.
 
         Put as much items as it can inside the message whats left is
@@ -1208,6 +1786,10 @@ class Query(request.Request):
 
         @param protocol: the request handler
         @param items: a list of (node, hash, share) tuples
+        @param on_state: function to call with each node state received,
+            instead of keeping them in self.response
+        @param first: an item to put before the ones in items (the
+            overflow of a previous query)
 
         """
         request.Request.__init__(self, protocol)
@@ -1215,27 +1797,28 @@ class Query(request.Request):
         qm.id = 0  # just to have something in the field when calculating size
         qm.type = protocol_pb2.Message.QUERY
         self.response = []
+        self.on_state = on_state
         self.overflow = None
         items_that_fit = []
 
-        def add_items(msg, *args):
-            """Add items to query."""
-            for share, node, content_hash in args:
-                qi = msg.query.add()
-                qi.share = share
-                qi.node = str(node)
-                qi.hash = content_hash
-
-        for item in items:
-            add_items(qm, item)
-            if qm.ByteSize() > request.MAX_MESSAGE_SIZE:
+        # account the size of each item instead of asking the whole
+        # message for it each time, and build the message only once
+        size = qm.ByteSize()
+        items = iter(items)
+        item = next(items, None) if first is None else first
+        while item is not None:
+            size += query_item_size(*item)
+            if size > request.MAX_MESSAGE_SIZE:
                 self.overflow = item
                 break
             items_that_fit.append(item)
+            item = next(items, None)
 
-        if self.overflow is not None:
-            qm.ClearField("query")
-            add_items(qm, *items_that_fit)
+        for share, node, a_hash in items_that_fit:
+            qi = qm.query.add()
+            qi.share = share
+            qi.node = str(node)
+            qi.hash = a_hash
 
     def _start(self):
         """Send QUERY."""
@@ -1244,7 +1827,10 @@ class Query(request.Request):
     def processMessage(self, message):
         """Handle messages."""
         if message.type == protocol_pb2.Message.NODE_STATE:
-            self.response.append(message.node_state)
+            if self.on_state is None:
+                self.response.append(message.node_state)
+            else:
+                self.on_state(message.node_state)
             self.protocol.notify_node_state(message.node_state)
         elif message.type == protocol_pb2.Message.QUERY_END:
             self.done()
@@ -1253,10 +1839,21 @@ class Query(request.Request):
 
 
 class BytesMessageProducer:
-    """Produce BYTES messages from a file."""
+    """Produce BYTES messages from a file.
+
+    Files with a descriptor are read with positional reads from the
+    producer's own offset, other file-like objects are seeked once and
+    then read in sequence. Several messages are sent in each reactor turn,
+    until paused or the turn's budget is used.
+
+    """
 
-    # to allow patching this in test and use task.Clock
+    # to allow patching these in test and use task.Clock
     callLater = reactor.callLater
+    clock = time.monotonic
+    # the max messages to send, and seconds to spend, in each reactor turn
+    messages_per_turn = 16
+    turn_time = 0.01
 
     def __init__(self, req, fh, offset):
         """Create a BytesMessageProducer."""
@@ -1265,6 +1862,8 @@ class BytesMessageProducer:
         self.fh = fh
         self.offset = offset
         self.finished = False
+        self.fileno = None
+        self.positioned = False
 
     def resumeProducing(self):
         """IPushProducer interface."""
@@ -1279,33 +1878,223 @@ class BytesMessageProducer:
         """IPushProducer interface."""
         self.producing = False
 
+    def _position(self):
+        """Get ready to read from the offset."""
+        self.positioned = True
+        if hasattr(os, 'pread'):
+            try:
+                if self.fh.seekable():
+                    self.fileno = self.fh.fileno()
+            except (AttributeError, OSError):
+                # not a real file
+                pass
+        if self.offset:
+            if self.fileno is None:
+                self.fh.seek(self.offset)
+        elif self.fileno is not None:
+            # start where the file is, as sequential reads would
+            self.offset = self.fh.tell()
+
+    def read(self, size):
+        """Read up to size bytes from the offset."""
+        if self.fileno is not None:
+            data = os.pread(self.fileno, size, self.offset)
+        else:
+            data = self.fh.read(size)
+        self.offset += len(data)
+        return data
+
     def go(self):
         """While producing, generates data.
 
-        Read a little from the file, generates a BYTES message, and pass the
-        control to the reactor.  If no more data, finish with EOF.
+        Read from the file and generate BYTES messages, until paused or
+        the turn's budget is used, then pass the control to the reactor.
+        If no more data, finish with EOF.
 
         """
         if not self.producing or self.request.cancelled or self.finished:
             return
+        if not self.positioned:
+            self._position()
+
+        deadline = self.clock() + self.turn_time
+        for _ in range(self.messages_per_turn):
+            data = self.read(self.request.max_payload_size)
+            if not data:
+                self.request.sendMessage(self.eof_message())
+                self.producing = False
+                self.finished = True
+                self.close()
+                return
 
-        if self.offset:
-            self.fh.seek(self.offset)
-        data = self.fh.read(self.request.max_payload_size)
-        if data:
-            if self.offset:
-                self.offset += len(data)
             response = protocol_pb2.Message()
             response.type = protocol_pb2.Message.BYTES
             response.bytes.bytes = data
             self.request.sendMessage(response)
+            if (
+                not self.producing
+                or self.request.cancelled
+                or self.clock() > deadline
+            ):
+                break
+
+        if self.producing:
             self.callLater(0, self.go)
+
+    def eof_message(self):
+        """Return the message to send after all the data."""
+        message = protocol_pb2.Message()
+        message.type = protocol_pb2.Message.EOF
+        return message
+
+    def close(self):
+        """Release what was used to read; the file is the caller's."""
+
+
+class DeflateBytesMessageProducer(BytesMessageProducer):
+    """Produce BYTES messages compressing the content of a file on the fly.
+
+    The content hash, magic hash, crc32, size and deflated size are
+    computed while sending, and set in the request when done; if the
+    request has them sent at the end, they go in the EOF message.
+
+    The offset is on the compressed content: the file is compressed
+    from its start, and what the server already has is skipped.
+
+    The source is anything the other producers take, a file-like object
+    or a path or mmap object; the not compressed content is read from it
+    by the matching producer.
+
+    """
+
+    # how much of the file to compress at once
+    block_size = 2**16
+
+    def __init__(self, req, source, offset):
+        """Create a DeflateBytesMessageProducer."""
+        BytesMessageProducer.__init__(self, req, None, 0)
+        if isinstance(source, MAPPED_SOURCE_TYPES):
+            self.raw = MappedBytesMessageProducer(req, source, 0)
+        else:
+            self.raw = BytesMessageProducer(req, source, 0)
+        self.skip = offset
+        self.compressor = zlib.compressobj()
+        self.hasher = content_hash.content_hash_factory()
+        self.magic_hasher = content_hash.magic_hash_factory()
+        self.crc32 = 0
+        self.size = 0
+        self.deflated_size = 0
+        self.deflated = bytearray()
+        self.flushed = False
+
+    def _position(self):
+        """Get ready to read from the start of the source."""
+        self.positioned = True
+        self.raw._position()
+
+    def _compress_more(self, size):
+        """Read and compress from the file, return the compressed data."""
+        data = self.raw.read(max(size, self.block_size))
+        if not data:
+            self.flushed = True
+            return self.compressor.flush()
+        self.hasher.update(data)
+        self.magic_hasher.update(data)
+        self.crc32 = content_hash.crc32(data, self.crc32)
+        self.size += len(data)
+        return self.compressor.compress(data)
+
+    def read(self, size):
+        """Return up to size bytes of the compressed content."""
+        deflated = self.deflated
+        while not self.flushed and len(deflated) < size:
+            compressed = self._compress_more(size)
+            self.deflated_size += len(compressed)
+            if self.skip:
+                skipped = min(self.skip, len(compressed))
+                self.skip -= skipped
+                compressed = compressed[skipped:]
+            deflated += compressed
+        data = bytes(deflated[:size])
+        del deflated[:size]
+        return data
+
+    def eof_message(self):
+        """Set the computed values in the request, and send them if asked."""
+        req = self.request
+        req.hash = self.hasher.content_hash()
+        req.magic_hash = self.magic_hasher.content_hash()._magic_hash
+        req.crc32 = self.crc32
+        req.size = self.size
+        req.deflated_size = self.deflated_size
+
+        message = BytesMessageProducer.eof_message(self)
+        if req.sizes_at_end:
+            message.put_content.hash = req.hash
+            message.put_content.magic_hash = req.magic_hash
+            message.put_content.crc32 = req.crc32
+            message.put_content.size = req.size
+            message.put_content.deflated_size = req.deflated_size
+        return message
+
+    def close(self):
+        """Release what the source was read with."""
+        self.raw.close()
+
+
+class MappedBytesMessageProducer(BytesMessageProducer):
+    """Produce BYTES messages from a memory mapped file.
+
+    The source is a path, which is mapped (and unmapped when done) by the
+    producer, or an already built mmap object, which is left open. The
+    payloads are sliced from a memoryview over the mapping, so there are
+    no read calls.
+
+    """
+
+    def __init__(self, req, source, offset):
+        """Create a MappedBytesMessageProducer."""
+        BytesMessageProducer.__init__(self, req, None, offset)
+        self.source = source
+        self.mapping = None
+        self.view = None
+
+    def _position(self):
+        """Map the file."""
+        self.positioned = True
+        if isinstance(self.source, mmap.mmap):
+            self.view = memoryview(self.source)
+            return
+        with open(self.source, 'rb') as fh:
+            if os.fstat(fh.fileno()).st_size:
+                self.mapping = mmap.mmap(
+                    fh.fileno(), 0, access=mmap.ACCESS_READ
+                )
+        if self.mapping is None:
+            # empty files can not be mapped
+            self.view = memoryview(b'')
         else:
-            message = protocol_pb2.Message()
-            message.type = protocol_pb2.Message.EOF
-            self.request.sendMessage(message)
-            self.producing = False
-            self.finished = True
+            self.view = memoryview(self.mapping)
+
+    def read(self, size):
+        """Slice up to size bytes from the offset."""
+        if self.view is None:
+            # already closed
+            return b''
+        start = self.offset
+        end = start + size
+        data = self.view[start:end].tobytes()
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        """Release the view, and the mapping if it's ours."""
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
 
 
 class PutContent(request.Request):
@@ -1329,6 +2118,8 @@ class PutContent(request.Request):
         'new_generation',
         'max_payload_size',
         'magic_hash',
+        'deflate',
+        'sizes_at_end',
     )
 
     def __init__(
@@ -1345,6 +2136,7 @@ class PutContent(request.Request):
         upload_id=None,
         upload_id_cb=None,
         magic_hash=None,
+        deflate=False,
     ):
         """Put content into a node.
 
@@ -1355,11 +2147,16 @@ class PutContent(request.Request):
         @param new_hash: the hash hint for the new content
         @param crc32: the crc32 hint for the new content
         @param size: the size hint for the new content
-        @param fd: a file-like object to read data from
+        @param fd: a file-like object to read data from, or a path or
+                   mmap object to slice the data from a memory mapping
         @param upload_id: the upload id (to resume the upload.)
         @param upload_id_cb: callback that will be called with the upload id
                              assigned by the server for the session
         @param magic_hash: the magic_hash of the file
+        @param deflate: if fd has the content not compressed, to compress
+            it while sending; then the hash, crc32, size, deflated_size
+            and magic_hash can be None, to be computed while sending and
+            sent at the end (only if the server accepted SIZES_AT_END_CAP)
 
         """
         request.Request.__init__(self, protocol)
@@ -1376,6 +2173,13 @@ class PutContent(request.Request):
         self.new_generation = None
         self.magic_hash = magic_hash
         self.max_payload_size = protocol.max_payload_size
+        self.deflate = deflate
+        self.sizes_at_end = deflate and deflated_size is None
+        if self.sizes_at_end and not protocol.sizes_at_end:
+            raise ValueError(
+                "The hashes and sizes can't be sent at the end, the server "
+                "didn't accept %r." % (SIZES_AT_END_CAP,)
+            )
 
     def _start(self):
         """Send PUT_CONTENT."""
@@ -1384,10 +2188,11 @@ class PutContent(request.Request):
         message.put_content.share = self.share
         message.put_content.node = str(self.node_id)
         message.put_content.previous_hash = self.previous_hash
-        message.put_content.hash = self.hash
-        message.put_content.crc32 = self.crc32
-        message.put_content.size = self.size
-        message.put_content.deflated_size = self.deflated_size
+        if not self.sizes_at_end:
+            message.put_content.hash = self.hash
+            message.put_content.crc32 = self.crc32
+            message.put_content.size = self.size
+            message.put_content.deflated_size = self.deflated_size
         if self.upload_id:
             message.put_content.upload_id = self.upload_id
         if self.magic_hash is not None:
@@ -1403,7 +2208,13 @@ class PutContent(request.Request):
                     message.begin_content.upload_id,
                     message.begin_content.offset,
                 )
-            message_producer = BytesMessageProducer(
+            if self.deflate:
+                producer_class = DeflateBytesMessageProducer
+            elif isinstance(self.fd, MAPPED_SOURCE_TYPES):
+                producer_class = MappedBytesMessageProducer
+            else:
+                producer_class = BytesMessageProducer
+            message_producer = producer_class(
                 self, self.fd, message.begin_content.offset
             )
             self.registerProducer(message_producer, streaming=True)
@@ -1415,10 +2226,17 @@ class PutContent(request.Request):
         else:
             self._default_process_message(message)
 
+    def cleanup(self):
+        """Also release what the producer is reading from."""
+        request.Request.cleanup(self)
+        if self.producer is not None:
+            self.producer.close()
+
     def _cancel(self):
         """Cancel the current upload."""
         if self.producer is not None:
             self.producer.stopProducing()
+            self.producer.close()
         message = protocol_pb2.Message()
         message.type = protocol_pb2.Message.CANCEL_REQUEST
         self.sendMessage(message)
@@ -1616,6 +2434,8 @@ class QuerySetCaps(request.Request):
             self.redirect_hostname = message.accept_caps.redirect_hostname
             self.redirect_port = message.accept_caps.redirect_port
             self.redirect_srvrecord = message.accept_caps.redirect_srvrecord
+            if self.set_mode and self.accepted:
+                self.protocol.sizes_at_end = SIZES_AT_END_CAP in self.caps
             self.done()
         else:
             self._default_process_message(message)
@@ -1679,7 +2499,7 @@ class GetDelta(request.Request):
     @ivar free_bytes: The free space of the volume.
                 Only a hint if full is False.
     @ivar response: the list of deltanodes received or empty if called with
-                callback
+                callback, or the given DeltaBatch
     """
 
     def __init__(
@@ -1689,6 +2509,8 @@ class GetDelta(request.Request):
         from_generation=None,
         callback=None,
         from_scratch=False,
+        batch=None,
+        lazy=False,
     ):
         """Generates a GET_DELTA message to the server.
 
@@ -1696,6 +2518,10 @@ class GetDelta(request.Request):
         @param volume_id: the volume id
         @param from_generation: the starting generation for the delta
         @param from_scratch: request a delta with all live files
+        @param batch: a delta.DeltaBatch to fill with the deltas received
+            instead of building a list of FileInfoDelta
+        @param lazy: build deltas that read their fields from the message
+            only when used
 
         """
         if from_generation is None and from_scratch is False:
@@ -1712,7 +2538,9 @@ class GetDelta(request.Request):
             dm.get_delta.from_generation = from_generation
         dm.get_delta.from_scratch = from_scratch
 
-        self.response = []
+        self.batch = batch
+        self.lazy = lazy
+        self.response = [] if batch is None else batch
         self.end_generation = None
         self.full = None
         self.free_bytes = None
@@ -1723,6 +2551,8 @@ class GetDelta(request.Request):
         'from_generation',
         'callback',
         'delta_message',
+        'batch',
+        'lazy',
         'response',
         'end_generation',
         'full',
@@ -1737,11 +2567,12 @@ class GetDelta(request.Request):
     def processMessage(self, message):
         """Handle messages."""
         if message.type == protocol_pb2.Message.DELTA_INFO:
-            info = delta.from_message(message)
             if self.callback:
-                self.callback(info)
+                self.callback(delta.from_message(message, self.lazy))
+            elif self.batch is not None:
+                self.batch.add_message(message.delta_info)
             else:
-                self.response.append(info)
+                self.response.append(delta.from_message(message, self.lazy))
         elif message.type == protocol_pb2.Message.DELTA_END:
             self.end_generation = message.delta_end.generation
             self.full = message.delta_end.full
@@ -1750,6 +2581,176 @@ class GetDelta(request.Request):
         else:
             self._default_process_message(message)
 
+    def processMessages(self, messages):
+        """Handle a batch of messages, converting the deltas in one go."""
+        if self.batch is not None and not self.callback:
+            # the deltas go straight into the DeltaBatch
+            for message in messages:
+                self.processMessage(message)
+            return
+        infos = []
+        for message in messages:
+            if message.type == protocol_pb2.Message.DELTA_INFO:
+                infos.append(delta.from_message(message, self.lazy))
+                continue
+            self._add_deltas(infos)
+            infos = []
+            self.processMessage(message)
+        self._add_deltas(infos)
+
+    def _add_deltas(self, infos):
+        """Pass the deltas to the callback, or store them."""
+        if self.callback:
+            for info in infos:
+                self.callback(info)
+        else:
+            self.response.extend(infos)
+
+
+class DeltaStream(GetDelta):
+    """Get a delta on a volume, handing the deltas to a consumer that pulls.
+
+    The deltas are handed in batches (all the ones received so far) by
+    next_batch, or by iterating with 'async for'. While more than
+    max_pending deltas are waiting for the consumer the reads are paused,
+    and they're resumed when the consumer takes them.
+
+    @ivar checkpoint: the highest generation handed to the consumer, to
+        resume the delta from there if the connection is lost; always None
+        from scratch, as a listing of the live nodes is not in generation
+        order and can't be resumed
+    @ivar failure: the failure the request finished with, if any
+    """
+
+    __slots__ = (
+        'max_pending',
+        'pending',
+        'waiting',
+        'paused',
+        'checkpoint',
+        'failure',
+    )
+
+    def __init__(
+        self,
+        protocol,
+        share_id,
+        from_generation=None,
+        from_scratch=False,
+        max_pending=10000,
+        lazy=False,
+    ):
+        """Generates a GET_DELTA message to the server.
+
+        @param protocol: the request handler
+        @param share_id: the volume id
+        @param from_generation: the starting generation for the delta
+        @param from_scratch: request a delta with all live files
+        @param max_pending: how many deltas to hold for the consumer
+            before pausing the reads
+        @param lazy: build deltas that read their fields from the message
+            only when used
+
+        """
+        GetDelta.__init__(
+            self,
+            protocol,
+            share_id,
+            from_generation,
+            from_scratch=from_scratch,
+            lazy=lazy,
+        )
+        self.max_pending = max_pending
+        self.pending = []
+        self.waiting = []
+        self.paused = False
+        self.checkpoint = None if from_scratch else from_generation
+        self.failure = None
+        self.deferred.addBoth(self._ended)
+
+    def processMessage(self, message):
+        """Handle messages."""
+        if message.type == protocol_pb2.Message.DELTA_INFO:
+            self._add_deltas([delta.from_message(message, self.lazy)])
+        else:
+            GetDelta.processMessage(self, message)
+
+    def _add_deltas(self, infos):
+        """Hand the deltas to a waiting consumer, or hold them."""
+        if not infos:
+            return
+        if self.waiting:
+            self._hand(self.waiting.pop(0), infos)
+            return
+        self.pending.extend(infos)
+        if len(self.pending) > self.max_pending and not self.paused:
+            self.paused = True
+            self.protocol.pauseReads()
+
+    def _hand(self, d, infos):
+        """Hand the deltas to the consumer waiting on d."""
+        if not self.delta_message.get_delta.from_scratch:
+            generation = max(info.generation for info in infos)
+            if self.checkpoint is None or generation > self.checkpoint:
+                self.checkpoint = generation
+        d.callback(infos)
+
+    def _ended(self, result):
+        """The request finished, let the waiting consumers know.
+
+        A failure is also handed to the consumer by next_batch, and
+        kept in the deferred for its other callbacks.
+
+        """
+        if isinstance(result, Failure):
+            self.failure = result
+        self._resume()
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            self._end_batch(d)
+        return result
+
+    def _end_batch(self, d):
+        """Fire d for the end of the deltas."""
+        if self.failure is None:
+            d.callback(None)
+        else:
+            d.errback(self.failure)
+
+    def _resume(self):
+        """Resume the reads, if they were paused."""
+        if self.paused:
+            self.paused = False
+            self.protocol.resumeReads()
+
+    def next_batch(self):
+        """Return a deferred with the list of deltas received so far.
+
+        It waits for the next ones if there are none yet, and fires with
+        None after the last one, or with the failure the request finished
+        with.
+
+        """
+        d = defer.Deferred()
+        if self.pending:
+            infos, self.pending = self.pending, []
+            self._resume()
+            self._hand(d, infos)
+        elif self.finished:
+            self._end_batch(d)
+        else:
+            self.waiting.append(d)
+        return d
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        infos = await self.next_batch()
+        if infos is None:
+            raise StopAsyncIteration
+        return infos
+
 
 class ThrottlingStorageClient(StorageClient):
     """The throttling version of the StorageClient protocol."""
@@ -1787,12 +2788,12 @@ class ThrottlingStorageClient(StorageClient):
         StorageClient.dataReceived(self, data)
 
     def throttleReads(self):
-        """Pause self.transport."""
-        self.transport.pauseProducing()
+        """Pause the reads."""
+        self.pauseReads()
 
     def unthrottleReads(self):
-        """Resume self.transport."""
-        self.transport.resumeProducing()
+        """Resume the reads."""
+        self.resumeReads()
 
     def throttleWrites(self):
         """Pause producing."""
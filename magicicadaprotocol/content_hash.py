@@ -27,39 +27,88 @@
 
 """Hash Handling Stuffs."""
 
-import copy
 import hashlib
+import os
 import zlib
 
+from concurrent.futures import ThreadPoolExecutor
+
 
 def noop():
     """No op."""
 
 
+# how much of a file to read at once when hashing it
+HASH_BLOCK_SIZE = 2**20
+
+
 class ContentHash:
     """Encapsulate the generation of content hashes.
 
     We cant subclass openssl hash classes, so we do some
-    composition to get similar methods.
+    composition to get similar methods: update, digest and hexdigest are
+    the hash object's own methods, bound when the hasher is created.
 
     """
 
+    __slots__ = (
+        'hash_object',
+        'digest_size',
+        'block_size',
+        'update',
+        'digest',
+        'hexdigest',
+    )
+
     method = noop
     method_name = ""
 
     def __init__(self):
-        self.hash_object = self.method()
-
-    digest_size = property(lambda self: self.hash_object.digest_size)
-    block_size = property(lambda self: self.hash_object.block_size)
-    update = property(lambda self: self.hash_object.update)
-    digest = property(lambda self: self.hash_object.digest)
-    hexdigest = property(lambda self: self.hash_object.hexdigest)
+        self._bind(self.method())
+
+    def _bind(self, hash_object):
+        """Use hash_object, binding its methods."""
+        self.hash_object = hash_object
+        self.digest_size = hash_object.digest_size
+        self.block_size = hash_object.block_size
+        self.update = hash_object.update
+        self.digest = hash_object.digest
+        self.hexdigest = hash_object.hexdigest
+
+    def update_many(self, buffers):
+        """Update with each of the buffers."""
+        update = self.hash_object.update
+        for data in buffers:
+            update(data)
+
+    def update_from_file(self, fd, block_size=HASH_BLOCK_SIZE):
+        """Update with the rest of the content of the binary file fd.
+
+        The file is read in blocks of block_size, into the same buffer.
+
+        @return: how many bytes were read
+
+        """
+        update = self.hash_object.update
+        buf = bytearray(block_size)
+        total = 0
+        with memoryview(buf) as view:
+            while True:
+                read = fd.readinto(buf)
+                if not read:
+                    break
+                if read == block_size:
+                    update(buf)
+                else:
+                    with view[:read] as block:
+                        update(block)
+                total += read
+        return total
 
     def copy(self):
         """Copy the generated hash."""
-        cp = copy.copy(self)
-        cp.hash_object = self.hash_object.copy()
+        cp = self.__class__.__new__(self.__class__)
+        cp._bind(self.hash_object.copy())
         return cp
 
     def content_hash(self):
@@ -70,6 +119,8 @@ class ContentHash:
 class SHA1ContentHash(ContentHash):
     """Generate SHA1 of ContentHash."""
 
+    __slots__ = ()
+
     method = hashlib.sha1
     method_name = "sha1"
 
@@ -91,21 +142,28 @@ class HiddenMagicHash:
         raise NotImplementedError("Magic value can not be pickled.")
 
 
+def _forbidden_digest():
+    """Forbidden access."""
+    raise NotImplementedError("Can not access magic digest.")
+
+
 class MagicContentHash(ContentHash):
     """Generate the magic hash."""
 
+    __slots__ = ()
+
     method = hashlib.sha1
     method_name = "magic_hash"
 
     def __init__(self):
-        self.hash_object = self.method()
+        ContentHash.__init__(self)
         self.update(b"Ubuntu One")
 
-    def digest(self):
-        """Forbidden access."""
-        raise NotImplementedError("Can not access magic digest.")
-
-    hexdigest = digest
+    def _bind(self, hash_object):
+        """Use hash_object, hiding its digests."""
+        ContentHash._bind(self, hash_object)
+        self.digest = _forbidden_digest
+        self.hexdigest = _forbidden_digest
 
     def content_hash(self):
         """Add hex digest to content hash."""
@@ -129,3 +187,206 @@ def crc32(data, previous_crc32=0):
 
     """
     return zlib.crc32(data, previous_crc32) & 0xFFFFFFFF
+
+
+# the crc32 polynomial, reflected
+CRC32_POLY = 0xEDB88320
+
+
+def _multmodp(a, b):
+    """Multiply a and b, polynomials modulo CRC32_POLY (reflected)."""
+    m = 1 << 31
+    p = 0
+    while True:
+        if a & m:
+            p ^= b
+            if not a & (m - 1):
+                break
+        m >>= 1
+        b = (b >> 1) ^ CRC32_POLY if b & 1 else b >> 1
+    return p
+
+
+def _build_x2n_table():
+    """Return x^(2^k) modulo CRC32_POLY, for k in 0..31."""
+    table = []
+    p = 1 << 30  # x^1
+    for _ in range(32):
+        table.append(p)
+        p = _multmodp(p, p)
+    return table
+
+
+_x2n_table = _build_x2n_table()
+
+
+def _x2nmodp(n, k):
+    """Return x^(n * 2^k) modulo CRC32_POLY."""
+    p = 1 << 31  # x^0
+    while n:
+        if n & 1:
+            p = _multmodp(_x2n_table[k & 31], p)
+        n >>= 1
+        k += 1
+    return p
+
+
+def crc32_combine(crc_a, crc_b, len_b):
+    """Return the crc32 of a + b, from the crc32 of a and of b.
+
+    @param crc_a: the crc32 of the first part
+    @param crc_b: the crc32 of the second part
+    @param len_b: the length of the second part
+
+    """
+    return _multmodp(_x2nmodp(len_b, 3), crc_a) ^ crc_b
+
+
+class UploadInfo:
+    """What PutContent needs to know about the content of a file.
+
+    hash: the content hash
+    magic_hash: the magic hash, hidden in a HiddenMagicHash
+    crc32: the crc32 of the content
+    size: the size of the content
+    deflated_size: the size of the content compressed with zlib
+
+    """
+
+    __slots__ = (
+        'path',
+        'hash',
+        'magic_hash',
+        'crc32',
+        'size',
+        'deflated_size',
+    )
+
+    def __init__(self, path, hash, magic_hash, crc32, size, deflated_size):
+        self.path = path
+        self.hash = hash
+        self.magic_hash = magic_hash
+        self.crc32 = crc32
+        self.size = size
+        self.deflated_size = deflated_size
+
+
+def hash_file(path, deflated=None, block_size=HASH_BLOCK_SIZE):
+    """Get all that's needed to upload the file at path, reading it once.
+
+    Each block read feeds the content hash, the magic hash, the crc32 and
+    the compressor; hashlib and zlib release the GIL while working on big
+    blocks, so several files can be hashed in threads at the same time.
+
+    @param path: the path of the file
+    @param deflated: a file-like object to write the compressed content
+        to, if it's wanted
+    @param block_size: how much to read at once
+    @return: an UploadInfo
+
+    """
+    hasher = content_hash_factory()
+    magic_hasher = magic_hash_factory()
+    compressor = zlib.compressobj()
+    crc = 0
+    size = 0
+    deflated_size = 0
+
+    buf = bytearray(block_size)
+    with memoryview(buf) as view, open(path, 'rb') as fh:
+        while True:
+            read = fh.readinto(buf)
+            if not read:
+                break
+            with view[:read] as block:
+                hasher.update(block)
+                magic_hasher.update(block)
+                crc = zlib.crc32(block, crc)
+                compressed = compressor.compress(block)
+            size += read
+            if compressed:
+                deflated_size += len(compressed)
+                if deflated is not None:
+                    deflated.write(compressed)
+
+    compressed = compressor.flush()
+    deflated_size += len(compressed)
+    if deflated is not None:
+        deflated.write(compressed)
+
+    return UploadInfo(
+        path=path,
+        hash=hasher.content_hash(),
+        magic_hash=magic_hasher.content_hash(),
+        crc32=crc & 0xFFFFFFFF,
+        size=size,
+        deflated_size=deflated_size,
+    )
+
+
+def _crc32_range(path, start, length, block_size):
+    """Return the crc32 of length bytes of the file at path from start."""
+    crc = 0
+    buf = bytearray(block_size)
+    with memoryview(buf) as view, open(path, 'rb') as fh:
+        fh.seek(start)
+        while length:
+            with view[: min(length, block_size)] as block:
+                read = fh.readinto(block)
+                if not read:
+                    break
+                with block[:read] as data:
+                    crc = zlib.crc32(data, crc)
+            length -= read
+    return crc
+
+
+def crc32_file(path, workers=4, block_size=HASH_BLOCK_SIZE):
+    """Return the crc32 of the file at path, computed in threads.
+
+    The file is split in one range per worker, each with its own crc32
+    (zlib releases the GIL while working on big blocks), and those are
+    combined with crc32_combine.
+
+    @param path: the path of the file
+    @param workers: how many parts of the file to read at the same time
+    @param block_size: how much to read at once
+    @return: the crc32 of the content, as crc32 returns it
+
+    """
+    size = os.path.getsize(path)
+    part_size = max(-(-size // workers), block_size)
+    ranges = [
+        (start, min(part_size, size - start))
+        for start in range(0, size, part_size)
+    ]
+    if len(ranges) <= 1:
+        return _crc32_range(path, 0, size, block_size) & 0xFFFFFFFF
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        crcs = list(
+            executor.map(
+                lambda r: _crc32_range(path, r[0], r[1], block_size), ranges
+            )
+        )
+    crc = crcs[0]
+    for (_, length), part_crc in zip(ranges[1:], crcs[1:]):
+        crc = crc32_combine(crc, part_crc, length)
+    return crc & 0xFFFFFFFF
+
+
+def hash_files(paths, workers=4, block_size=HASH_BLOCK_SIZE):
+    """Get the UploadInfo of many files, hashing them in threads.
+
+    @param paths: the paths of the files
+    @param workers: how many files to hash at the same time
+    @param block_size: how much to read at once from each file
+    @return: the list of UploadInfo, in the same order than paths
+
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(
+            executor.map(
+                lambda path: hash_file(path, block_size=block_size), paths
+            )
+        )
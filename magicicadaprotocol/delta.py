@@ -27,6 +27,10 @@
 
 """Provides wrapper classes for delta nodes messages."""
 
+import sys
+
+from array import array
+
 from magicicadaprotocol import protocol_pb2
 
 FILE = 0
@@ -38,9 +42,55 @@ file_type_registry = {
 }
 
 
-class FileInfoDelta:
+FIELDS = (
+    'generation',
+    'is_live',
+    'file_type',
+    'parent_id',
+    'share_id',
+    'node_id',
+    'name',
+    'is_public',
+    'content_hash',
+    'crc32',
+    'size',
+    'last_modified',
+)
+
+
+class BaseFileInfoDelta:
+    """The file/directory object information for a delta.
+
+    Deltas compare equal if all their FIELDS are, eager or lazy.
+
+    """
+
+    __slots__ = ()
+
+    def as_tuple(self):
+        """Return the values of all the fields, in FIELDS order."""
+        return tuple(getattr(self, name) for name in FIELDS)
+
+    def __eq__(self, other):
+        if not isinstance(other, BaseFileInfoDelta):
+            return False
+
+        return self.as_tuple() == other.as_tuple()
+
+    def __repr__(self):
+        return "<%s generation=%r node_id=%r name=%r>" % (
+            self.__class__.__name__,
+            self.generation,
+            self.node_id,
+            self.name,
+        )
+
+
+class FileInfoDelta(BaseFileInfoDelta):
     """Hold the file/directory object information for a delta."""
 
+    __slots__ = FIELDS
+
     def __init__(
         self,
         generation,
@@ -92,18 +142,199 @@ class FileInfoDelta:
         )
         return result
 
-    def __eq__(self, other):
-        if not isinstance(other, self.__class__):
-            return False
 
-        return self.__dict__ == other.__dict__
+def _delta_info_field(name):
+    """Return a property reading name from the DeltaInfo."""
+    return property(lambda self: getattr(self.delta_info, name))
+
+
+def _file_info_field(name):
+    """Return a property reading name from the DeltaInfo's FileInfo."""
+    return property(lambda self: getattr(self.delta_info.file_info, name))
+
+
+class LazyFileInfoDelta(BaseFileInfoDelta):
+    """A delta that reads each field from the message only when used."""
+
+    __slots__ = ('delta_info',)
+
+    def __init__(self, delta_info):
+        self.delta_info = delta_info
+
+    @classmethod
+    def from_message(cls, delta_info):
+        """Creates the object keeping the message."""
+        return cls(delta_info)
+
+    generation = _delta_info_field('generation')
+    is_live = _delta_info_field('is_live')
+    share_id = _file_info_field('share')
+    node_id = _file_info_field('node')
+    name = _file_info_field('name')
+    is_public = _file_info_field('is_public')
+    content_hash = _file_info_field('content_hash')
+    crc32 = _file_info_field('crc32')
+    size = _file_info_field('size')
+    last_modified = _file_info_field('last_modified')
+
+    @property
+    def file_type(self):
+        return file_type_registry[self.delta_info.file_info.type]
+
+    @property
+    def parent_id(self):
+        return self.delta_info.file_info.parent or None
+
+
+# the smallest array type that can hold a crc32
+CRC32_TYPECODE = 'I' if array('I').itemsize >= 4 else 'L'
+
+
+def _intern(value):
+    """Intern value, if it's a string."""
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+class DeltaBatch:
+    """Hold many deltas in columns, instead of one object per delta.
+
+    The numbers are kept in arrays and the strings (which repeat a lot,
+    like the share and parent ids) interned in lists. The FileInfoDelta
+    of a row is only built when asked for.
+
+    """
+
+    __slots__ = (
+        'generations',
+        'is_lives',
+        'file_types',
+        'parent_ids',
+        'share_ids',
+        'node_ids',
+        'names',
+        'is_publics',
+        'content_hashes',
+        'crc32s',
+        'sizes',
+        'last_modifieds',
+    )
+
+    def __init__(self, infos=()):
+        """Create the batch, with the FileInfoDelta in infos, if any."""
+        self.generations = array('Q')
+        self.is_lives = bytearray()
+        self.file_types = bytearray()
+        self.parent_ids = []
+        self.share_ids = []
+        self.node_ids = []
+        self.names = []
+        self.is_publics = bytearray()
+        self.content_hashes = []
+        self.crc32s = array(CRC32_TYPECODE)
+        self.sizes = array('Q')
+        self.last_modifieds = array('Q')
+        for info in infos:
+            self.append(info)
+
+    def _add(
+        self,
+        generation,
+        is_live,
+        file_type,
+        parent_id,
+        share_id,
+        node_id,
+        name,
+        is_public,
+        content_hash,
+        crc32,
+        size,
+        last_modified,
+    ):
+        """Add a row with the given values."""
+        self.generations.append(generation)
+        self.is_lives.append(is_live)
+        self.file_types.append(file_type)
+        self.parent_ids.append(_intern(parent_id))
+        self.share_ids.append(_intern(share_id))
+        self.node_ids.append(_intern(node_id))
+        self.names.append(_intern(name))
+        self.is_publics.append(is_public)
+        self.content_hashes.append(_intern(content_hash))
+        self.crc32s.append(crc32)
+        self.sizes.append(size)
+        self.last_modifieds.append(last_modified)
+
+    def append(self, info):
+        """Add a FileInfoDelta."""
+        self._add(*info.as_tuple())
+
+    def add_message(self, delta_info):
+        """Add the delta in a DeltaInfo message, with no FileInfoDelta."""
+        info = delta_info.file_info
+        self._add(
+            delta_info.generation,
+            delta_info.is_live,
+            file_type_registry[info.type],
+            info.parent or None,
+            info.share,
+            info.node,
+            info.name,
+            info.is_public,
+            info.content_hash,
+            info.crc32,
+            info.size,
+            info.last_modified,
+        )
+
+    def __len__(self):
+        return len(self.generations)
+
+    def __getitem__(self, index):
+        """Build the FileInfoDelta for the row at index."""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("DeltaBatch index out of range.")
+        return FileInfoDelta(
+            self.generations[index],
+            bool(self.is_lives[index]),
+            self.file_types[index],
+            self.parent_ids[index],
+            self.share_ids[index],
+            self.node_ids[index],
+            self.names[index],
+            bool(self.is_publics[index]),
+            self.content_hashes[index],
+            self.crc32s[index],
+            self.sizes[index],
+            self.last_modifieds[index],
+        )
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
 
 
 message_type_registry = {
     protocol_pb2.DeltaInfo.FILE_INFO: FileInfoDelta.from_message
 }
 
+lazy_message_type_registry = {
+    protocol_pb2.DeltaInfo.FILE_INFO: LazyFileInfoDelta.from_message
+}
+
+
+def from_message(message, lazy=False):
+    """Generates Info objects from DELTA_INFO messages.
+
+    If lazy, the objects read the fields from the message when used.
 
-def from_message(message):
-    """Generates Info objects from DELTA_INFO messages."""
-    return message_type_registry[message.delta_info.type](message.delta_info)
+    """
+    if lazy:
+        registry = lazy_message_type_registry
+    else:
+        registry = message_type_registry
+    return registry[message.delta_info.type](message.delta_info)
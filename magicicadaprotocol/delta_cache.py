@@ -0,0 +1,257 @@
+# Copyright 2015-2022 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the
+# OpenSSL library under certain conditions as described in each
+# individual source file, and distribute linked combinations
+# including the two.
+# You must obey the GNU General Public License in all respects
+# for all of the code used other than OpenSSL.  If you modify
+# file(s) with this exception, you may extend this exception to your
+# version of the file(s), but you are not obligated to do so.  If you
+# do not wish to do so, delete this exception statement from your
+# version.  If you delete this exception statement from all source
+# files in the program, then also delete it here.
+
+"""A persistent, append only, cache of the deltas of a volume."""
+
+import mmap
+import os
+import struct
+
+from magicicadaprotocol import delta, protocol_pb2
+
+MAGIC = b'MGDC\x00\x01'
+
+# kind, node id size, payload size
+RECORD_HEADER = struct.Struct('!cBI')
+GENERATION = struct.Struct('!Q')
+
+LIVE = b'D'
+DEAD = b'X'
+END_GENERATION = b'G'
+
+_file_type_to_message = {
+    value: key for key, value in delta.file_type_registry.items()
+}
+
+
+def _delta_info(info):
+    """Return the DeltaInfo message for a FileInfoDelta."""
+    if isinstance(info, delta.LazyFileInfoDelta):
+        return info.delta_info
+    message = protocol_pb2.DeltaInfo()
+    message.type = protocol_pb2.DeltaInfo.FILE_INFO
+    message.generation = info.generation
+    message.is_live = info.is_live
+    file_info = message.file_info
+    file_info.type = _file_type_to_message[info.file_type]
+    if info.parent_id is not None:
+        file_info.parent = info.parent_id
+    file_info.share = info.share_id
+    file_info.node = info.node_id
+    file_info.name = info.name
+    file_info.is_public = info.is_public
+    file_info.content_hash = info.content_hash
+    file_info.crc32 = info.crc32
+    file_info.size = info.size
+    file_info.last_modified = info.last_modified
+    return message
+
+
+class DeltaCache:
+    """Keep the deltas of the live nodes of a volume in a file.
+
+    The file is a sequence of records, only ever appended to: the
+    DeltaInfo of a node, the removal of a node, or the generation the
+    volume was at after a GetDelta. When opened, only the record headers
+    are read to index the latest record of each node, and the deltas are
+    parsed from a memory mapping of the file when asked for.
+
+    @ivar generation: the last end generation stored, None if none
+    @ivar records: how many node records the file has, live or not
+    """
+
+    def __init__(self, path):
+        """Open (or create) the cache at path."""
+        self.path = path
+        self._open()
+
+    def _open(self):
+        """Open the file and index it."""
+        self.generation = None
+        self.offsets = {}
+        self.records = 0
+        self.mapping = None
+        self.view = None
+        self.fh = open(self.path, 'a+b')
+        self._load()
+
+    def _load(self):
+        """Index the records in the file, dropping a torn last one."""
+        self.fh.seek(0, os.SEEK_END)
+        size = self.fh.tell()
+        if not size:
+            self.fh.write(MAGIC)
+            self.fh.flush()
+            return
+        self.fh.seek(0)
+        if self.fh.read(len(MAGIC)) != MAGIC:
+            self.fh.close()
+            raise ValueError("%r is not a delta cache." % (self.path,))
+
+        view = self._view(size)
+        pos = len(MAGIC)
+        while pos + RECORD_HEADER.size <= size:
+            kind, id_size, payload_size = RECORD_HEADER.unpack_from(view, pos)
+            id_start = pos + RECORD_HEADER.size
+            id_end = id_start + id_size
+            end = id_end + payload_size
+            if end > size:
+                break
+            if kind == END_GENERATION:
+                (self.generation,) = GENERATION.unpack_from(view, id_end)
+            else:
+                node_id = str(view[id_start:id_end], 'utf-8')
+                if kind == LIVE:
+                    self.offsets[node_id] = pos
+                else:
+                    self.offsets.pop(node_id, None)
+                self.records += 1
+            pos = end
+
+        if pos < size:
+            # the last record was not completely written
+            self._unmap()
+            self.fh.truncate(pos)
+
+    def _view(self, size):
+        """Return a view of at least size bytes of the file."""
+        if self.view is None or len(self.view) < size:
+            # map it again, to see what was appended
+            self._unmap()
+            self.fh.flush()
+            self.mapping = mmap.mmap(
+                self.fh.fileno(), 0, access=mmap.ACCESS_READ
+            )
+            self.view = memoryview(self.mapping)
+        return self.view
+
+    def _unmap(self):
+        """Release the memory mapping."""
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+
+    def _append(self, kind, node_id, payload):
+        """Append a record, return its offset."""
+        node_id = node_id.encode('utf-8')
+        offset = self.fh.seek(0, os.SEEK_END)
+        self.fh.write(
+            RECORD_HEADER.pack(kind, len(node_id), len(payload))
+            + node_id
+            + payload
+        )
+        return offset
+
+    def _read(self, offset):
+        """Return the lazy delta of the record at offset."""
+        view = self._view(offset + RECORD_HEADER.size)
+        _, id_size, payload_size = RECORD_HEADER.unpack_from(view, offset)
+        start = offset + RECORD_HEADER.size + id_size
+        end = start + payload_size
+        view = self._view(end)
+        message = protocol_pb2.DeltaInfo()
+        message.ParseFromString(view[start:end])
+        return delta.LazyFileInfoDelta(message)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, node_id):
+        return node_id in self.offsets
+
+    def __iter__(self):
+        """Yield the (lazy) deltas of all the live nodes."""
+        for offset in list(self.offsets.values()):
+            yield self._read(offset)
+
+    def get(self, node_id):
+        """Return the (lazy) delta of the node, None if not there."""
+        offset = self.offsets.get(node_id)
+        if offset is None:
+            return None
+        return self._read(offset)
+
+    def add(self, info):
+        """Store the FileInfoDelta as the latest of its node."""
+        payload = _delta_info(info).SerializeToString()
+        self.offsets[info.node_id] = self._append(LIVE, info.node_id, payload)
+        self.records += 1
+
+    def discard(self, node_id):
+        """Forget the node, if it's there."""
+        if self.offsets.pop(node_id, None) is not None:
+            self._append(DEAD, node_id, b'')
+            self.records += 1
+
+    def set_generation(self, generation):
+        """Store the generation the volume is at, with all its deltas."""
+        self._append(END_GENERATION, '', GENERATION.pack(generation))
+        self.generation = generation
+        self.flush()
+
+    def flush(self):
+        """Write what was appended to the file."""
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    def compact(self):
+        """Rewrite the file with only the latest records of live nodes."""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as fh:
+            fh.write(MAGIC)
+            view = self._view(self.fh.seek(0, os.SEEK_END))
+            for offset in self.offsets.values():
+                _, id_size, size = RECORD_HEADER.unpack_from(view, offset)
+                end = offset + RECORD_HEADER.size + id_size + size
+                fh.write(view[offset:end])
+            if self.generation is not None:
+                fh.write(
+                    RECORD_HEADER.pack(END_GENERATION, 0, GENERATION.size)
+                    + GENERATION.pack(self.generation)
+                )
+            fh.flush()
+            os.fsync(fh.fileno())
+        self.close()
+        os.replace(tmp_path, self.path)
+        self._open()
+
+    def clear(self):
+        """Forget all the nodes and the generation."""
+        self.close()
+        with open(self.path, 'wb') as fh:
+            fh.write(MAGIC)
+            fh.flush()
+            os.fsync(fh.fileno())
+        self._open()
+
+    def close(self):
+        """Close the file."""
+        self._unmap()
+        self.fh.close()
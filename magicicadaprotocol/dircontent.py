@@ -27,10 +27,18 @@
 
 """Standard routines for working with directory content."""
 
+import bisect
 import operator
 import re
 
-from magicicadaprotocol.dircontent_pb2 import DirectoryContent
+from array import array
+
+from google.protobuf.message import DecodeError
+
+from magicicadaprotocol.dircontent_pb2 import (
+    DirectoryContent,
+    DirectoryEntry,
+)
 
 ILLEGAL_FILENAMES = [".", ".."]
 ILLEGAL_FILENAME_CHARS_RE_SOURCE = r'[\000/]'
@@ -66,42 +74,194 @@ def normalize_filename(filename):
     return filename
 
 
-def parse_dir_content(stream):
+def _decode_varint(data, pos):
+    """Decode the varint at pos in data.
+
+    Return the value and the position after it, or None if data ends
+    before the varint does.
+
+    """
+    value = 0
+    shift = 0
+    size = len(data)
+    while pos < size:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+    return None
+
+
+# the key of the DirectoryContent.entries records
+ENTRIES_KEY = (DirectoryContent.ENTRIES_FIELD_NUMBER << 3) | 2
+
+# the wire types of the protobuf fields, and the size of the fixed ones
+WIRE_VARINT, WIRE_FIXED64, WIRE_LENGTH, WIRE_FIXED32 = 0, 1, 2, 5
+FIXED_SIZES = {WIRE_FIXED64: 8, WIRE_FIXED32: 4}
+
+# how much to read from the stream at once when parsing
+PARSE_BLOCK_SIZE = 2**16
+
+
+def parse_dir_content(stream, block_size=PARSE_BLOCK_SIZE):
     """Unserialize directory content from a stream.
 
+    The stream is read in blocks of block_size bytes, and each entry is
+    yielded as soon as its record is complete, so neither the whole
+    content nor the whole parsed message are held in memory. Unknown
+    fields are skipped, as the protobuf parser does.
+
     @param stream: an IO-alike stream object
+    @param block_size: how much to read from the stream at once
     @return: a generator yielding DirEntry objects
 
     """
-    raw_content = stream.read()
-    unserialized_content = DirectoryContent()
-    # XXX what exceptions can protobuf's parser raise?
-    unserialized_content.ParseFromString(raw_content)
-
-    for entry in unserialized_content.entries:
-        yield DirEntry(
-            name=entry.name, node_type=entry.node_type, uuid=entry.node
-        )
+    pending = bytearray()
+    entry = DirectoryEntry()
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        pending += block
+        pos = 0
+        entries = []
+        with memoryview(pending) as view:
+            while True:
+                key = _decode_varint(view, pos)
+                if key is None:
+                    break
+                key, start = key
+                wire_type = key & 7
+                if wire_type == WIRE_LENGTH:
+                    length = _decode_varint(view, start)
+                    if length is None:
+                        break
+                    length, start = length
+                    end = start + length
+                elif wire_type == WIRE_VARINT:
+                    end = _decode_varint(view, start)
+                    if end is None:
+                        break
+                    end = end[1]
+                elif wire_type in FIXED_SIZES:
+                    end = start + FIXED_SIZES[wire_type]
+                else:
+                    raise DecodeError(
+                        "Unexpected wire type in directory content."
+                    )
+                if end > len(view):
+                    break
+                if key == ENTRIES_KEY:
+                    entry.ParseFromString(view[start:end])
+                    entries.append(
+                        DirEntry(
+                            name=entry.name,
+                            node_type=entry.node_type,
+                            uuid=entry.node,
+                        )
+                    )
+                pos = end
+        del pending[:pos]
+        yield from entries
+
+    if pending:
+        raise DecodeError("Truncated directory content.")
 
 
 def write_dir_content(entries, stream):
     """Takes a sequence of DirEntry objects, sorts them, and writes
     the corresponding serialized directory content to the given stream.
 
+    A DirContentIndex is already sorted, and its serialized content is
+    written as is.
+
     @param entries: an iterator producing DirEntry objects
     @param stream: an IO-compatible stream to write to
 
     """
+    if isinstance(entries, DirContentIndex):
+        entries.write(stream)
+        return
     sorted_entries = sorted(entries, key=operator.attrgetter('utf8_name'))
     for chunk in yield_presorted_dir_content(sorted_entries):
         stream.write(chunk)
 
 
-def yield_presorted_dir_content(sorted_entries):
+def _encode_varint(value, out):
+    """Append value encoded as a varint to the out bytearray."""
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _varint_size(value):
+    """Return the size of value encoded as a varint."""
+    size = 1
+    while value > 0x7F:
+        value >>= 7
+        size += 1
+    return size
+
+
+def _encode_string(value):
+    """Return the string as bytes, encoding it in UTF-8 if needed."""
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return value
+
+
+def encode_dir_entry(entry, out):
+    """Append the serialized entries record of entry to out.
+
+    This writes the same bytes protobuf would for a DirectoryContent with
+    only this entry, without building the protobuf objects.
+
+    @param entry: a DirEntry
+    @param out: the bytearray to append to
+
+    """
+    name = entry.utf8_name
+    node = _encode_string(entry.uuid)
+    size = (
+        len(name)
+        + _varint_size(len(name))
+        + len(node)
+        + _varint_size(len(node))
+        + _varint_size(entry.node_type)
+        + 3
+    )
+    out.append(ENTRIES_KEY)
+    _encode_varint(size, out)
+    out.append(0x0A)
+    _encode_varint(len(name), out)
+    out += name
+    out.append(0x12)
+    _encode_varint(len(node), out)
+    out += node
+    out.append(0x18)
+    _encode_varint(entry.node_type, out)
+
+
+# how much serialized content to put in each yielded chunk
+CHUNK_SIZE = 2**16
+
+
+def yield_presorted_dir_content(
+    sorted_entries, chunk_size=CHUNK_SIZE, direct=True
+):
     """Takes a presorted sequence of DirEntry objects and yields each
     chunks of serialized content.
 
+    The entries are encoded into a reused buffer and yielded in chunks of
+    about chunk_size bytes.
+
     @param sorted_entries: a presorted sequence of DirEntry objects
+    @param chunk_size: the size after which a chunk is yielded
+    @param direct: encode the entries directly instead of serializing
+        them with protobuf
 
     """
 
@@ -111,12 +271,22 @@ def yield_presorted_dir_content(sorted_entries):
     # each entry that we serialize.
     content = DirectoryContent()
     pb_entry = content.entries.add()
+    chunk = bytearray()
 
     for entry in sorted_entries:
-        pb_entry.name = entry.name
-        pb_entry.node_type = entry.node_type
-        pb_entry.node = entry.uuid
-        yield content.SerializeToString()
+        if direct:
+            encode_dir_entry(entry, chunk)
+        else:
+            pb_entry.name = entry.name
+            pb_entry.node_type = entry.node_type
+            pb_entry.node = entry.uuid
+            chunk += content.SerializeToString()
+        if len(chunk) >= chunk_size:
+            yield bytes(chunk)
+            chunk.clear()
+
+    if chunk:
+        yield bytes(chunk)
 
 
 class DirEntry:
@@ -129,6 +299,8 @@ class DirEntry:
 
     """
 
+    __slots__ = ('name', 'utf8_name', 'node_type', 'uuid')
+
     def __init__(self, name=None, utf8_name=None, node_type=None, uuid=None):
         """Initializes a directory entry object.  Providing either the unicode
         or UTF-8 names will result in both name fields being set.
@@ -166,3 +338,153 @@ class DirEntry:
             )
         else:
             return False
+
+
+def _utf8(name):
+    """Return the name encoded in UTF-8, if it's not already."""
+    if isinstance(name, str):
+        return name.encode('utf-8')
+    return name
+
+
+class DirContentIndex:
+    """The entries of a directory, kept sorted by their UTF-8 name.
+
+    Names are looked up with a binary search, and entries are inserted,
+    removed and renamed in place. Once serialized, the serialized content
+    is kept and updated by splicing in or out only the records of the
+    entries that changed, so a change doesn't need a sort nor serializing
+    every entry again.
+
+    """
+
+    __slots__ = ('names', 'entries', 'serialized', 'sizes')
+
+    def __init__(self, entries=(), presorted=False):
+        """Create the index with the entries.
+
+        @param entries: an iterable of DirEntry objects, with unique names
+        @param presorted: if the entries are already sorted by utf8_name
+
+        """
+        entries = list(entries)
+        if not presorted:
+            entries.sort(key=operator.attrgetter('utf8_name'))
+        self.entries = entries
+        self.names = [entry.utf8_name for entry in entries]
+        self.serialized = None
+        self.sizes = None
+
+    @classmethod
+    def from_stream(cls, stream):
+        """Create the index from the serialized content in stream."""
+        entries = list(parse_dir_content(stream))
+        names = [entry.utf8_name for entry in entries]
+        presorted = all(a < b for a, b in zip(names, names[1:]))
+        return cls(entries, presorted=presorted)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __contains__(self, name):
+        return self._find(_utf8(name)) is not None
+
+    def _find(self, utf8_name):
+        """Return the position of the entry with the name, or None."""
+        pos = bisect.bisect_left(self.names, utf8_name)
+        if pos < len(self.names) and self.names[pos] == utf8_name:
+            return pos
+        return None
+
+    def get(self, name):
+        """Return the entry with the name, or None."""
+        pos = self._find(_utf8(name))
+        if pos is None:
+            return None
+        return self.entries[pos]
+
+    def _splice(self, pos, remove, entry=None):
+        """Update the serialized content, if any, at the entry in pos.
+
+        Take out the record of the entry at pos if remove, and put in the
+        one of entry if given.
+
+        """
+        if self.serialized is None:
+            return
+        offset = sum(self.sizes[:pos])
+        size = self.sizes[pos] if remove else 0
+        record = bytearray()
+        if entry is not None:
+            encode_dir_entry(entry, record)
+        end = offset + size
+        self.serialized[offset:end] = record
+        if remove and entry is not None:
+            self.sizes[pos] = len(record)
+        elif remove:
+            del self.sizes[pos]
+        else:
+            self.sizes.insert(pos, len(record))
+
+    def insert(self, entry):
+        """Add the entry, replacing the one with the same name if any."""
+        pos = bisect.bisect_left(self.names, entry.utf8_name)
+        replace = pos < len(self.names) and self.names[pos] == entry.utf8_name
+        self._splice(pos, replace, entry)
+        if replace:
+            self.entries[pos] = entry
+        else:
+            self.names.insert(pos, entry.utf8_name)
+            self.entries.insert(pos, entry)
+
+    def remove(self, name):
+        """Remove the entry with the name, and return it.
+
+        Raise KeyError if there's no entry with that name.
+
+        """
+        pos = self._find(_utf8(name))
+        if pos is None:
+            raise KeyError(name)
+        self._splice(pos, True)
+        del self.names[pos]
+        return self.entries.pop(pos)
+
+    def rename(self, name, new_name):
+        """Give the entry with name the new name, and return it.
+
+        Raise KeyError if there's no entry with name; an entry with the
+        new name, if any, is replaced.
+
+        """
+        old = self.remove(name)
+        entry = DirEntry(
+            name=new_name if isinstance(new_name, str) else None,
+            utf8_name=new_name if isinstance(new_name, bytes) else None,
+            node_type=old.node_type,
+            uuid=old.uuid,
+        )
+        self.insert(entry)
+        return entry
+
+    def serialize(self):
+        """Return the serialized content of the entries."""
+        if self.serialized is None:
+            self.serialized = bytearray()
+            self.sizes = array('L')
+            for entry in self.entries:
+                size = len(self.serialized)
+                encode_dir_entry(entry, self.serialized)
+                self.sizes.append(len(self.serialized) - size)
+        return bytes(self.serialized)
+
+    def write(self, stream):
+        """Write the serialized content to stream."""
+        if self.serialized is None:
+            self.serialize()
+        for pos in range(0, len(self.serialized), CHUNK_SIZE):
+            end = pos + CHUNK_SIZE
+            stream.write(bytes(self.serialized[pos:end]))
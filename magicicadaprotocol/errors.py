@@ -69,6 +69,23 @@ class RequestCancelledError(StorageProtocolError):
     """The request was cancelled."""
 
 
+class ContentVerificationError(StorageProtocolError):
+    """The content received doesn't match what the server announced."""
+
+    def __init__(self, mismatches):
+        """Create a ContentVerificationError.
+
+        @param mismatches: a list of (name, expected, received) tuples.
+        """
+        super(ContentVerificationError, self).__init__(
+            ", ".join(
+                "%s: expected %r, got %r" % mismatch for mismatch in mismatches
+            )
+        )
+        #: the (name, expected, received) values that didn't match
+        self.mismatches = mismatches
+
+
 # Request specific errors
 
 
@@ -0,0 +1,353 @@
+# Copyright 2015-2022 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the
+# OpenSSL library under certain conditions as described in each
+# individual source file, and distribute linked combinations
+# including the two.
+# You must obey the GNU General Public License in all respects
+# for all of the code used other than OpenSSL.  If you modify
+# file(s) with this exception, you may extend this exception to your
+# version of the file(s), but you are not obligated to do so.  If you
+# do not wish to do so, delete this exception statement from your
+# version.  If you delete this exception statement from all source
+# files in the program, then also delete it here.
+"""A persistent cache of the hashes of the files, by their stat."""
+
+import hashlib
+import hmac
+import os
+import struct
+
+from collections import OrderedDict
+
+from magicicadaprotocol import content_hash
+
+MAGIC = b'MGHC\x00\x01'
+
+# how many files to keep in memory
+DEFAULT_MAX_ENTRIES = 2**17
+
+# device, inode, size, mtime (in nanoseconds)
+STAT_KEY = struct.Struct('!QQQq')
+
+# the random part of what hides each magic hash
+NONCE_SIZE = 16
+
+# the size of the HMAC that authenticates each record
+MAC_SIZE = 16
+
+# how many records to read at once when loading
+LOAD_RECORDS = 4096
+
+HAS_MAGIC = 1
+
+
+def stat_key(st):
+    """Return what identifies the content of a file, from its stat."""
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _xor(data, pad):
+    """Return data xor'ed with pad, which is as long as data."""
+    value = int.from_bytes(data, 'big') ^ int.from_bytes(pad, 'big')
+    return value.to_bytes(len(data), 'big')
+
+
+class HashCache:
+    """Keep the UploadInfo of files in a file, to not hash them again.
+
+    The files are identified by their device, inode, size and mtime, so
+    a file that didn't change is found without reading it. The cache
+    file is a header with the hash methods and a table of fixed size
+    records, one per file: a file stored again is overwritten in place,
+    a new one is appended. When opened the whole table is scanned to
+    index where the record of each file is; the records themselves are
+    read from the file when used, keeping in memory up to max_entries of
+    them, the least recently used ones are forgotten.
+
+    With a key, each record is authenticated with its HMAC, checked when
+    read from the file, and the magic hash is never stored as is: it's
+    xor'ed with the HMAC of a random nonce and the file identity. Without
+    a key the magic hash is not stored, and is None in the cached infos.
+
+    @ivar index: the position of each record in the file, by stat key,
+        oldest used first
+    @ivar entries: the records in memory, by stat key, oldest used first
+    """
+
+    def __init__(self, path, key=None, max_entries=DEFAULT_MAX_ENTRIES):
+        """Open (or create) the cache at path.
+
+        @param path: the path of the cache file
+        @param key: the bytes to authenticate the records and hide the
+            magic hashes with; keep it out of the disk
+        @param max_entries: how many records to keep in memory
+        """
+        self.path = path
+        self.key = key
+        self.max_entries = max_entries
+        self.hash_method = content_hash.content_hash_factory
+        self.magic_method = content_hash.magic_hash_factory
+        self.header = MAGIC + (
+            '%s:%s:hmac\n'
+            % (self.hash_method.method_name, self.magic_method.method_name)
+        ).encode('ascii')
+        self.hash_size = self.hash_method.method().digest_size
+        self.magic_size = self.magic_method.method().digest_size
+        self.record = struct.Struct(
+            '!%ds%dsIQB%ds%ds%ds'
+            % (
+                STAT_KEY.size,
+                self.hash_size,
+                NONCE_SIZE,
+                self.magic_size,
+                MAC_SIZE,
+            )
+        )
+        self.index = OrderedDict()
+        self.entries = OrderedDict()
+        self._open()
+
+    def _open(self):
+        """Open the file and load it."""
+        try:
+            self.fh = open(self.path, 'r+b')
+        except FileNotFoundError:
+            self.fh = open(self.path, 'w+b')
+        self._load()
+
+    def _load(self):
+        """Index the records in the file, dropping a torn last one.
+
+        A cache of other hash methods is emptied.
+
+        """
+        fh = self.fh
+        fh.seek(0)
+        header = fh.read(len(self.header))
+        if header != self.header:
+            if header and not header.startswith(MAGIC):
+                fh.close()
+                raise ValueError("%r is not a hash cache." % (self.path,))
+            fh.seek(0)
+            fh.truncate(0)
+            fh.write(self.header)
+            fh.flush()
+            return
+
+        record_size = self.record.size
+        index = self.index
+        pos = len(self.header)
+        while True:
+            data = fh.read(record_size * LOAD_RECORDS)
+            end = len(data) - len(data) % record_size
+            for start in range(0, end, record_size):
+                key = STAT_KEY.unpack_from(data, start)
+                index.pop(key, None)
+                index[key] = pos + start
+            pos += end
+            if end < len(data):
+                # the last record was not completely written
+                fh.truncate(pos)
+                break
+            if len(data) < record_size * LOAD_RECORDS:
+                break
+
+    def _pad(self, nonce, key_bytes):
+        """Return what hides the magic hash of the record."""
+        mac = hmac.new(self.key, nonce + key_bytes, hashlib.sha256)
+        return mac.digest()[: self.magic_size]
+
+    def _mac(self, body):
+        """Return the HMAC of the record body, empty without a key."""
+        if self.key is None:
+            return b''
+        mac = hmac.new(self.key, body, hashlib.sha256)
+        return mac.digest()[:MAC_SIZE]
+
+    def _pack(self, info, key):
+        """Return the record for the UploadInfo of the file with key."""
+        key_bytes = STAT_KEY.pack(*key)
+        method, hexdigest = info.hash.split(':', 1)
+        if method != self.hash_method.method_name:
+            raise ValueError("%r is not a %s hash." % (info.hash, method))
+        digest = bytes.fromhex(hexdigest)
+        flags = 0
+        nonce = token = b''
+        if self.key is not None and info.magic_hash is not None:
+            magic = info.magic_hash._magic_hash.split(':', 1)[1]
+            nonce = os.urandom(NONCE_SIZE)
+            token = _xor(bytes.fromhex(magic), self._pad(nonce, key_bytes))
+            flags |= HAS_MAGIC
+        record = self.record.pack(
+            key_bytes,
+            digest,
+            info.crc32,
+            info.deflated_size,
+            flags,
+            nonce,
+            token,
+            b'',
+        )
+        body = record[:-MAC_SIZE]
+        return body + self._mac(body).ljust(MAC_SIZE, b'\x00')
+
+    def _unpack(self, record, path):
+        """Return the UploadInfo in the record, for the file at path."""
+        (
+            key_bytes,
+            digest,
+            crc32,
+            deflated_size,
+            flags,
+            nonce,
+            token,
+            _,
+        ) = self.record.unpack(record)
+        size = STAT_KEY.unpack(key_bytes)[2]
+        magic_hash = None
+        if flags & HAS_MAGIC and self.key is not None:
+            magic = _xor(token, self._pad(nonce, key_bytes))
+            magic_hash = content_hash.HiddenMagicHash(
+                self.magic_method.method_name + ':' + magic.hex()
+            )
+        return content_hash.UploadInfo(
+            path=path,
+            hash=self.hash_method.method_name + ':' + digest.hex(),
+            magic_hash=magic_hash,
+            crc32=crc32,
+            size=size,
+            deflated_size=deflated_size,
+        )
+
+    def _read(self, key):
+        """Return the record of key from the file, None if not valid.
+
+        With a key, a record that doesn't match its HMAC (it was torn,
+        tampered with, or written with another key) is not valid.
+
+        """
+        self.fh.seek(self.index[key])
+        record = self.fh.read(self.record.size)
+        if len(record) != self.record.size:
+            return None
+        if STAT_KEY.unpack_from(record) != key:
+            return None
+        if self.key is not None:
+            mac = record[-MAC_SIZE:]
+            if not hmac.compare_digest(mac, self._mac(record[:-MAC_SIZE])):
+                return None
+        return record
+
+    def _remember(self, key, record):
+        """Keep the record in memory, forgetting the least used one."""
+        self.entries.pop(key, None)
+        self.entries[key] = record
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, path, st=None):
+        """Return the cached UploadInfo of the file, None if not there.
+
+        @param st: the stat of the file, if it's known already
+        """
+        if st is None:
+            st = os.stat(path)
+        key = stat_key(st)
+        if key not in self.index:
+            return None
+        self.index.move_to_end(key)
+        record = self.entries.get(key)
+        if record is None:
+            record = self._read(key)
+            if record is None:
+                return None
+            self._remember(key, record)
+        else:
+            self.entries.move_to_end(key)
+        return self._unpack(record, path)
+
+    def add(self, info, st):
+        """Store the UploadInfo of the file with stat st."""
+        key = stat_key(st)
+        record = self._pack(info, key)
+        self._remember(key, record)
+        pos = self.index.pop(key, None)
+        if pos is None:
+            pos = self.fh.seek(0, os.SEEK_END)
+        else:
+            self.fh.seek(pos)
+        self.index[key] = pos
+        self.fh.write(record)
+
+    def hash_file(self, path, block_size=content_hash.HASH_BLOCK_SIZE):
+        """Return the UploadInfo of the file, hashing it only if needed.
+
+        The result is stored only if the file didn't change while it
+        was hashed.
+
+        """
+        st = os.stat(path)
+        info = self.get(path, st)
+        if info is None or (info.magic_hash is None and self.key):
+            info = content_hash.hash_file(path, block_size=block_size)
+            if stat_key(os.stat(path)) == stat_key(st):
+                self.add(info, st)
+        return info
+
+    def flush(self):
+        """Write what was added to the file."""
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    def compact(self, max_records=None):
+        """Rewrite the file with only the valid records.
+
+        @param max_records: if given, keep only this many of them, the
+            most recently used
+        """
+        keys = list(self.index)
+        if max_records is not None:
+            skip = max(len(keys) - max_records, 0)
+            keys = keys[skip:]
+        tmp_path = self.path + '.tmp'
+        index = OrderedDict()
+        with open(tmp_path, 'wb') as fh:
+            fh.write(self.header)
+            for key in keys:
+                record = self.entries.get(key)
+                if record is None:
+                    record = self._read(key)
+                    if record is None:
+                        continue
+                index[key] = fh.tell()
+                fh.write(record)
+            fh.flush()
+            os.fsync(fh.fileno())
+        self.fh.close()
+        os.replace(tmp_path, self.path)
+        self.fh = open(self.path, 'r+b')
+        self.index = index
+        for key in list(self.entries):
+            if key not in index:
+                del self.entries[key]
+
+    def close(self):
+        """Close the file."""
+        self.fh.close()
@@ -37,7 +37,7 @@ import time
 
 from twisted.internet.protocol import Protocol, connectionDone
 from twisted.internet.interfaces import IPushProducer
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from zope.interface import implementer
 
 from magicicadaprotocol import protocol_pb2, validators
@@ -67,6 +67,14 @@ MAX_PAYLOAD_SIZE = MAX_MESSAGE_SIZE - 300
 # the referred is the own root node, and not any of the shares
 ROOT = ''
 
+# the names of the message types, by number
+MESSAGE_TYPE_NAMES = {
+    value.number: value.name
+    for value in protocol_pb2.Message.DESCRIPTOR.enum_types_by_name[
+        'MessageType'
+    ].values
+}
+
 
 @implementer(IPushProducer)
 class RequestHandler(Protocol):
@@ -75,12 +83,33 @@ class RequestHandler(Protocol):
     @cvar REQUEST_ID_START:  the request id starting number. replace this in
     client subclasses. servers should start at 0, clients should start at 1.
     @cvar PROTOCOL_VERSION: the protocol version for this peer.
+    @cvar BATCH_MESSAGES: if True, all the messages decoded from a single
+    read are handed together to processMessages instead of one by one to
+    processMessage.
+    @cvar WRITE_HIGH_WATER_MARK: if not zero, outgoing frames are buffered
+    and written together at the end of the reactor turn, or as soon as
+    this many bytes are waiting.
+    @cvar UNVALIDATED_MESSAGE_TYPES: the message types that carry no
+    validated fields, so they are dispatched without validation.
 
     """
 
     SIZE, MESSAGE = range(2)
     REQUEST_ID_START = 0
     PROTOCOL_VERSION = 3
+    BATCH_MESSAGES = False
+    WRITE_HIGH_WATER_MARK = 0
+    UNVALIDATED_MESSAGE_TYPES = frozenset(
+        [
+            protocol_pb2.Message.BYTES,
+            protocol_pb2.Message.EOF,
+            protocol_pb2.Message.NOOP,
+            protocol_pb2.Message.PONG,
+        ]
+    )
+
+    # to allow patching this in test and use task.Clock
+    callLater = reactor.callLater
 
     def __init__(self):
         """RequestHandler creation is done by the factory."""
@@ -89,7 +118,13 @@ class RequestHandler(Protocol):
         self.requests = {}
         self.pending_length = SIZE_FMT_SIZE
         self.waiting_for = self.SIZE
-        self.pending_parts = []
+        self.pending_data = bytearray()
+        self.outgoing_frames = []
+        self.outgoing_size = 0
+        self.flush_call = None
+        self.unvalidated_types = self.UNVALIDATED_MESSAGE_TYPES
+        self.handlers = None
+        self.registered_handlers = {}
         self.producing = True
 
     def get_new_request_id(self):
@@ -106,6 +141,11 @@ class RequestHandler(Protocol):
     def connectionLost(self, reason=connectionDone):
         """Abort any outstanding requests when we lose our connection."""
         Protocol.connectionLost(self, reason)
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+        self.outgoing_frames = []
+        self.outgoing_size = 0
         requests = list(self.requests.values())  # make a copy
         for request in requests:
             request.stopProducing()
@@ -166,25 +206,31 @@ class RequestHandler(Protocol):
         self.transport.writeSequence(data)
 
     def buildMessage(self, data):
-        """Create messages from data received."""
-        # more parts for the old message
-        while len(data) > self.pending_length:
-            # split and create a new message
-            p = self.pending_length
-            self.buildMessage(data[:p])
-            data = data[p:]
-        else:
-            # just more data
-            self.pending_parts.append(data)
-            self.pending_length -= len(data)
-
-            if self.pending_length == 0:
-                # we have a finished message
-                buf = b"".join(self.pending_parts)
-                self.pending_parts = []
+        """Create messages from data received.
+
+        All the complete frames in the data are decoded in a single pass,
+        parsing each message body straight from a view over the received
+        bytes. Only a trailing incomplete frame is kept in pending_data
+        until more data arrives.
+
+        If BATCH_MESSAGES is set, the decoded messages are collected and
+        dispatched together to processMessages once the data is consumed.
+
+        """
+        batch = [] if self.BATCH_MESSAGES else None
+        pending = self.pending_data
+        if pending:
+            pending += data
+            data = pending
+        view = memoryview(data)
+        pos = 0
+        try:
+            while len(data) - pos >= self.pending_length:
+                start = pos
+                pos += self.pending_length
                 if self.waiting_for == self.SIZE:
                     # send an error if size is too big, close connection
-                    sz = struct.unpack(SIZE_FMT, buf)[0]
+                    sz = struct.unpack_from(SIZE_FMT, data, start)[0]
                     if sz > MAX_MESSAGE_SIZE:
                         # we cant answer this request because we cant
                         # parse it, so we just drop the connection
@@ -197,8 +243,23 @@ class RequestHandler(Protocol):
                     self.waiting_for = self.SIZE
                     self.pending_length = SIZE_FMT_SIZE
                     message = protocol_pb2.Message()
-                    message.ParseFromString(buf)
-                    self.processMessage(message)
+                    message.ParseFromString(view[start:pos])
+                    if batch is None:
+                        self.processMessage(message)
+                    else:
+                        batch.append(message)
+        finally:
+            # keep only what was not consumed, for the next read
+            if data is pending:
+                view.release()
+                del pending[:pos]
+            else:
+                pending += view[pos:]
+                view.release()
+
+            # the frames before an error are dispatched, as one by one
+            if batch:
+                self.processMessages(batch)
 
     def processMessage(self, message):
         """Process an incoming message.
@@ -208,7 +269,7 @@ class RequestHandler(Protocol):
         if its a new message, we call self.handle_MESSAGENAME.
         """
         result = None
-        is_invalid = validators.validate_message(message)
+        is_invalid = self.validate_message(message)
 
         if is_invalid:
             self.log.error("Validation error: " + ", ".join(is_invalid))
@@ -229,32 +290,152 @@ class RequestHandler(Protocol):
                 except Exception as e:
                     self.requests[message.id].error(e)
             else:
-                name = (
-                    protocol_pb2.Message.DESCRIPTOR.enum_types_by_name[
-                        'MessageType'
-                    ]
-                    .values_by_number[message.type]
-                    .name
-                )
-
-                handler = getattr(self, "handle_" + name, None)
+                handler = self.get_handlers().get(message.type)
                 if handler is not None:
                     result = handler(message)
                 else:
+                    name = MESSAGE_TYPE_NAMES.get(message.type, message.type)
                     raise Exception(
                         "peer cant handle message '%s' {%s}"
                         % (name, str(message).replace("\n", " "))
                     )
         return result
 
+    @classmethod
+    def get_handler_names(cls):
+        """Return the names of the handle_MESSAGENAME methods, by type.
+
+        They are looked up once per class, and again after
+        invalidate_handlers is called.
+        """
+        names = cls.__dict__.get('_handler_names')
+        if names is None:
+            names = {}
+            for number, name in MESSAGE_TYPE_NAMES.items():
+                if hasattr(cls, "handle_" + name):
+                    names[number] = "handle_" + name
+            cls._handler_names = names
+        return names
+
+    def get_handlers(self):
+        """Return the dispatch table, from message type to handler.
+
+        The table is built on first use from the handle_MESSAGENAME
+        methods and the registered handlers, and rebuilt after
+        invalidate_handlers is called.
+        """
+        if self.handlers is None:
+            handlers = {
+                number: getattr(self, name)
+                for number, name in self.get_handler_names().items()
+            }
+            handlers.update(self.registered_handlers)
+            self.handlers = handlers
+        return self.handlers
+
+    def register_handler(self, message_type, handler):
+        """Handle the new messages of message_type with handler(message)."""
+        self.registered_handlers[message_type] = handler
+        if self.handlers is not None:
+            self.handlers[message_type] = handler
+
+    def invalidate_handlers(self):
+        """Forget the dispatch table, to pick up new handle_* methods.
+
+        The registered handlers are kept.
+        """
+        type(self)._handler_names = None
+        self.handlers = None
+
+    def validate_message(self, message):
+        """Return the list of validation errors for the message.
+
+        Messages of the unvalidated types are not checked at all, but for
+        an EOF carrying the sizes and hashes of a put_content.
+        """
+        if message.type in self.unvalidated_types and not (
+            message.type == protocol_pb2.Message.EOF
+            and message.HasField('put_content')
+        ):
+            return []
+        return validators.validate_message(message)
+
+    def set_message_validation(self, message_type, validate):
+        """Set if the messages of the given type are validated or not."""
+        if validate:
+            self.unvalidated_types = self.unvalidated_types - {message_type}
+        else:
+            self.unvalidated_types = self.unvalidated_types | {message_type}
+
+    def processMessages(self, messages):
+        """Process a batch of incoming messages, in order.
+
+        Consecutive valid messages for the same active request are handed
+        to it all at once if it overrides processMessages, everything
+        else goes through processMessage.
+        """
+        target = None
+        pending = []
+        for message in messages:
+            req = self.requests.get(message.id)
+            if (
+                req is None
+                or type(req).processMessages is Request.processMessages
+                or self.validate_message(message)
+            ):
+                self._dispatch_batch(target, pending)
+                target, pending = None, []
+                self.processMessage(message)
+                continue
+            if req is not target:
+                self._dispatch_batch(target, pending)
+                target, pending = req, []
+            pending.append(message)
+        self._dispatch_batch(target, pending)
+
+    def _dispatch_batch(self, req, messages):
+        """Hand the messages to the request, if any.
+
+        If it fails, the request is errored as with processMessage.
+        """
+        if messages:
+            try:
+                req.processMessages(messages)
+            except Exception as e:
+                if not req.finished:
+                    req.error(e)
+
     def sendMessage(self, message):
         """send a message over the pipe.
 
-        handles len+data plus message serialization.
+        handles len+data plus message serialization. The whole frame is
+        written at once, right away or at the end of the reactor turn if
+        WRITE_HIGH_WATER_MARK is set.
         """
         m = message.SerializeToString()
-        self.write(struct.pack(SIZE_FMT, len(m)))
-        self.write(m)
+        frame = struct.pack(SIZE_FMT, len(m)) + m
+        if not self.WRITE_HIGH_WATER_MARK:
+            self.write(frame)
+            return
+
+        self.outgoing_frames.append(frame)
+        self.outgoing_size += len(frame)
+        if self.outgoing_size >= self.WRITE_HIGH_WATER_MARK:
+            self.flushFrames()
+        elif self.flush_call is None:
+            self.flush_call = self.callLater(0, self.flushFrames)
+
+    def flushFrames(self):
+        """Write all the buffered outgoing frames in a single call."""
+        if self.flush_call is not None:
+            if self.flush_call.active():
+                self.flush_call.cancel()
+            self.flush_call = None
+        if self.outgoing_frames:
+            frames = self.outgoing_frames
+            self.outgoing_frames = []
+            self.outgoing_size = 0
+            self.writeSequence(frames)
 
     def handle_PING(self, message):
         """handle an incoming ping message."""
@@ -434,6 +615,17 @@ class Request:
         """
         pass
 
+    def processMessages(self, messages):
+        """handle a batch of incoming messages for this request.
+
+        Override this to consume streaming responses all at once, by
+        default every message is passed to processMessage.
+
+        @param messages: a list of protocol_pb2.Message instances.
+        """
+        for message in messages:
+            self.processMessage(message)
+
     def cancel(self):
         """We should stop this request."""
         # if the request already finished, it can't be cancelled!
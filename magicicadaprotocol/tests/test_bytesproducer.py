@@ -63,6 +63,8 @@ class TestProducingState(TestCase):
         fh.seek(0)
         req = FakeRequest()
         self.bmp = client.BytesMessageProducer(req, fh, 0)
+        # one message per turn, to not finish right away
+        self.bmp.messages_per_turn = 1
 
     def test_start(self):
         """It starts not producing anything."""
@@ -113,6 +115,7 @@ class TestGenerateData(TwistedTestCase):
         self.clock = task.Clock()
         self.bmp = client.BytesMessageProducer(self.req, fh, 0)
         self.patch(self.bmp, 'callLater', self.clock.callLater)
+        self.patch(self.bmp, 'clock', self.clock.seconds)
 
     def test_start(self):
         """It starts not producing anything."""
@@ -133,3 +136,71 @@ class TestGenerateData(TwistedTestCase):
         self.bmp.resumeProducing()
         self.clock.advance(1)
         self.assertEqual(self.req.messages, [])
+
+    def test_several_messages_per_turn(self):
+        """Send several messages in the same turn."""
+        self.bmp.resumeProducing()
+        self.assertEqual(self.req.messages, ["BYTES", "BYTES", "EOF"])
+
+    def test_messages_per_turn_limit(self):
+        """Don't send more than messages_per_turn in a turn."""
+        self.bmp.messages_per_turn = 1
+        self.bmp.resumeProducing()
+        self.assertEqual(self.req.messages, ["BYTES"])
+        self.clock.advance(1)
+        self.assertEqual(self.req.messages, ["BYTES", "BYTES", "EOF"])
+
+    def test_turn_time_limit(self):
+        """Don't spend more than turn_time in a turn."""
+
+        def send(message):
+            self.req.messages.append(message.type)
+            self.clock.advance(self.bmp.turn_time * 2)
+
+        self.req.sendMessage = send
+        self.bmp.resumeProducing()
+        self.assertEqual(self.req.messages, [protocol_pb2.Message.BYTES])
+
+    def test_pause_stops_the_turn(self):
+        """Stop sending as soon as paused."""
+        self.req.sendMessage = lambda m: (
+            self.req.messages.append(m.type),
+            self.bmp.pauseProducing(),
+        )
+        self.bmp.resumeProducing()
+        self.clock.advance(1)
+        self.assertEqual(self.req.messages, [protocol_pb2.Message.BYTES])
+
+
+class TestPositionalRead(TwistedTestCase):
+    """Test the reading from real files."""
+
+    timeout = 1
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        yield super(TestPositionalRead, self).setUp()
+        self.path = self.mktemp()
+        with open(self.path, 'wb') as fh:
+            fh.write(b"abcdefgh")
+        self.fh = open(self.path, 'rb')
+        self.addCleanup(self.fh.close)
+        self.req = FakeRequest()
+        self.req.sendMessage = self.req.messages.append
+
+    def produce(self, offset):
+        """Produce all the file from offset, return the payloads."""
+        bmp = client.BytesMessageProducer(self.req, self.fh, offset)
+        bmp.resumeProducing()
+        self.assertTrue(bmp.finished)
+        return [m.bytes.bytes for m in self.req.messages[:-1]]
+
+    def test_from_offset(self):
+        """Read from the offset, without moving the file position."""
+        self.assertEqual(self.produce(3), [b"def", b"gh"])
+        self.assertEqual(self.fh.tell(), 0)
+
+    def test_from_current_position(self):
+        """Without offset, read from where the file is."""
+        self.fh.seek(2)
+        self.assertEqual(self.produce(0), [b"cde", b"fgh"])
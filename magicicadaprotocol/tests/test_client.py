@@ -35,6 +35,9 @@ from collections import defaultdict
 from twisted.application import internet, service
 from twisted.internet import defer
 from twisted.internet.defer import Deferred
+from twisted.internet.error import ConnectionLost
+from twisted.internet.testing import StringTransport
+from twisted.python.failure import Failure
 from twisted.trial.unittest import TestCase
 from twisted.web import server, resource
 
@@ -45,15 +48,21 @@ from magicicadaprotocol.client import (
     ChangePublicAccess,
     CreateUDF,
     DeleteVolume,
+    DeltaStream,
+    GetContent,
     GetDelta,
     ListPublicFiles,
     ListVolumes,
     MakeDir,
     MakeFile,
     Move,
+    MultiGetContent,
     PutContent,
+    Query,
     StorageClient,
+    StreamingQuery,
     Unlink,
+    query_item_size,
 )
 
 from magicicadaprotocol.tests import test_delta_info
@@ -749,6 +758,77 @@ class GetDeltaTestCase(RequestTestCase):
         self.request.processMessage(message)
         self.assertTrue(delta.from_message(message) in response)
 
+    def test_process_messages_content(self):
+        """Test request processMessages for a batch of content."""
+        messages = [test_delta_info.get_message() for _ in range(3)]
+        self.request.processMessages(messages)
+        self.assertEqual(len(self.request.response), 3)
+        self.assertTrue(
+            delta.from_message(messages[0]) in self.request.response
+        )
+
+    def test_process_messages_content_callback(self):
+        """Test request processMessages for content w/callback."""
+        response = []
+        self.request = self.make_request(SHARE, 0, callback=response.append)
+        messages = [test_delta_info.get_message() for _ in range(3)]
+        self.request.processMessages(messages)
+        self.assertEqual(len(response), 3)
+        self.assertEqual(self.request.response, [])
+
+    def test_process_messages_end(self):
+        """Test request processMessages with content and the end."""
+        end = protocol_pb2.Message()
+        end.type = protocol_pb2.Message.DELTA_END
+        end.delta_end.generation = 100
+        messages = [test_delta_info.get_message(), end]
+        self.request.processMessages(messages)
+        self.assertEqual(len(self.request.response), 1)
+        self.assertTrue(self.done_called, 'done() was called')
+        self.assertEqual(self.request.end_generation, 100)
+
+    def test_process_message_content_lazy(self):
+        """Test request processMessage building lazy deltas."""
+        self.request = self.make_request(SHARE, 0, lazy=True)
+        message = test_delta_info.get_message()
+        self.request.processMessage(message)
+        (info,) = self.request.response
+        self.assertIsInstance(info, delta.LazyFileInfoDelta)
+        self.assertEqual(info, delta.from_message(message))
+
+    def test_process_messages_content_lazy_callback(self):
+        """Test request processMessages passing lazy deltas."""
+        response = []
+        self.request = self.make_request(
+            SHARE, 0, callback=response.append, lazy=True
+        )
+        messages = [test_delta_info.get_message() for _ in range(3)]
+        self.request.processMessages(messages)
+        self.assertEqual(len(response), 3)
+        self.assertIsInstance(response[0], delta.LazyFileInfoDelta)
+
+    def test_process_message_content_batch(self):
+        """Test request processMessage filling a DeltaBatch."""
+        batch = delta.DeltaBatch()
+        self.request = self.make_request(SHARE, 0, batch=batch)
+        message = test_delta_info.get_message()
+        self.request.processMessage(message)
+        self.assertIs(self.request.response, batch)
+        self.assertEqual(list(batch), [delta.from_message(message)])
+
+    def test_process_messages_content_batch(self):
+        """Test request processMessages filling a DeltaBatch."""
+        batch = delta.DeltaBatch()
+        self.request = self.make_request(SHARE, 0, batch=batch)
+        end = protocol_pb2.Message()
+        end.type = protocol_pb2.Message.DELTA_END
+        end.delta_end.generation = 100
+        messages = [test_delta_info.get_message() for _ in range(3)]
+        self.request.processMessages(messages + [end])
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(batch[0], delta.from_message(messages[0]))
+        self.assertTrue(self.done_called, 'done() was called')
+
     def test_from_scratch_flag(self):
         """Test from scratch flag."""
         request = self.make_request(SHARE, 0, from_scratch=True, start=False)
@@ -761,6 +841,148 @@ class GetDeltaTestCase(RequestTestCase):
         self.assertEqual(request.share_id, actual_msg.get_delta.share)
 
 
+class DeltaStreamTestCase(TestCase):
+    """Test cases for DeltaStream."""
+
+    def setUp(self):
+        """Initialize testing protocol."""
+        self.protocol = FakedProtocol()
+        self.protocol.transport = StringTransport()
+        self.stream = self.protocol.get_delta_stream(
+            SHARE, from_generation=5, max_pending=4
+        )
+
+    def deltas(self, *generations):
+        """Receive DELTA_INFO messages with the given generations."""
+        messages = []
+        for generation in generations:
+            message = test_delta_info.get_message()
+            message.delta_info.generation = generation
+            messages.append(message)
+        self.stream.processMessages(messages)
+
+    def end(self):
+        """Receive DELTA_END."""
+        message = protocol_pb2.Message()
+        message.type = protocol_pb2.Message.DELTA_END
+        message.delta_end.generation = 100
+        self.stream.processMessage(message)
+
+    def generations(self, infos):
+        """Return the generations of the deltas."""
+        return [info.generation for info in infos]
+
+    def test_start(self):
+        """The GET_DELTA is sent."""
+        self.assertIsInstance(self.stream, DeltaStream)
+        (message,) = self.protocol.messages
+        self.assertEqual(message.type, protocol_pb2.Message.GET_DELTA)
+        self.assertEqual(message.get_delta.from_generation, 5)
+        self.assertEqual(self.stream.checkpoint, 5)
+
+    @defer.inlineCallbacks
+    def test_all_pending_at_once(self):
+        """All the deltas received so far are handed in one batch."""
+        self.deltas(6, 7)
+        self.deltas(8)
+        self.end()
+        infos = yield self.stream.next_batch()
+        self.assertEqual(self.generations(infos), [6, 7, 8])
+        infos = yield self.stream.next_batch()
+        self.assertIsNone(infos)
+
+    @defer.inlineCallbacks
+    def test_waiting_consumer(self):
+        """A consumer waiting gets the deltas as soon as they arrive."""
+        d = self.stream.next_batch()
+        self.assertFalse(d.called)
+        self.deltas(6)
+        infos = yield d
+        self.assertEqual(self.generations(infos), [6])
+        d = self.stream.next_batch()
+        self.end()
+        infos = yield d
+        self.assertIsNone(infos)
+
+    def test_checkpoint(self):
+        """The checkpoint is the highest generation handed."""
+        self.deltas(6, 9, 8)
+        self.assertEqual(self.stream.checkpoint, 5)
+        self.stream.next_batch()
+        self.assertEqual(self.stream.checkpoint, 9)
+        self.deltas(7)
+        self.stream.next_batch()
+        self.assertEqual(self.stream.checkpoint, 9)
+
+    def test_no_checkpoint_from_scratch(self):
+        """A listing from scratch has no checkpoint to resume from."""
+        self.stream = self.protocol.get_delta_stream(SHARE, from_scratch=True)
+        self.deltas(6, 9)
+        self.stream.next_batch()
+        self.assertIsNone(self.stream.checkpoint)
+
+    def test_pause_and_resume(self):
+        """Too many deltas pending pause the transport until taken."""
+        transport = self.protocol.transport
+        self.deltas(6, 7, 8)
+        self.deltas(9, 10)
+        self.assertEqual(transport.producerState, 'paused')
+        self.stream.next_batch()
+        self.assertEqual(transport.producerState, 'producing')
+
+    def test_resume_on_end(self):
+        """The transport is resumed when the request ends."""
+        self.deltas(6, 7, 8, 9, 10)
+        self.assertEqual(self.protocol.transport.producerState, 'paused')
+        self.end()
+        self.assertEqual(self.protocol.transport.producerState, 'producing')
+
+    def test_pause_shared(self):
+        """The reads stay paused while someone else wants them paused."""
+        transport = self.protocol.transport
+        self.protocol.pauseReads()
+        self.deltas(6, 7, 8, 9, 10)
+        self.stream.next_batch()
+        self.assertEqual(transport.producerState, 'paused')
+        self.protocol.resumeReads()
+        self.assertEqual(transport.producerState, 'producing')
+
+    @defer.inlineCallbacks
+    def test_error(self):
+        """The consumer gets the failure the request ended with."""
+        self.deltas(6)
+        message = protocol_pb2.Message()
+        message.type = protocol_pb2.Message.ERROR
+        message.error.type = protocol_pb2.Error.PROTOCOL_ERROR
+        self.stream.processMessage(message)
+        infos = yield self.stream.next_batch()
+        self.assertEqual(self.generations(infos), [6])
+        yield self.assertFailure(
+            self.stream.next_batch(), request.StorageRequestError
+        )
+        self.assertEqual(self.stream.checkpoint, 6)
+        # the request's deferred keeps the failure
+        yield self.assertFailure(
+            self.stream.deferred, request.StorageRequestError
+        )
+
+    @defer.inlineCallbacks
+    def test_async_for(self):
+        """The batches can be iterated with async for."""
+        self.deltas(6, 7)
+        self.deltas(8)
+        self.end()
+
+        async def consume():
+            generations = []
+            async for infos in self.stream:
+                generations.extend(self.generations(infos))
+            return generations
+
+        generations = yield defer.ensureDeferred(consume())
+        self.assertEqual(generations, [6, 7, 8])
+
+
 class TestAuth(RequestTestCase):
     """Tests the authentication request."""
 
@@ -958,12 +1180,296 @@ class PutContentTestCase(RequestTestCase):
         # set up the producer with a content with size 19
         fake_file = io.BytesIO(b"some binary content")
         producer = BytesMessageProducer(pc, fake_file, 0)
+        producer.messages_per_turn = 1
         producer.producing = True
 
         producer.go()
         self.assertEqual(fake_file.tell(), 12)
 
 
+class MultiGetContentTestCase(TestCase):
+    """Test cases for MultiGetContent."""
+
+    def setUp(self):
+        """Initialize testing protocol."""
+        self.protocol = FakedProtocol()
+        self.items = [('share', 'node%d' % i, 'hash') for i in range(5)]
+
+    def in_flight(self):
+        """Return the nodes of the GetContent requests in flight."""
+        return [
+            r.node_id
+            for r in self.protocol.requests.values()
+            if isinstance(r, GetContent)
+        ]
+
+    def finish(self, node, data=b'content'):
+        """Finish the download of node."""
+        (req,) = [
+            r for r in self.protocol.requests.values() if r.node_id == node
+        ]
+        message = protocol_pb2.Message()
+        message.type = protocol_pb2.Message.BYTES
+        message.bytes.bytes = data
+        req.processMessage(message)
+        message = protocol_pb2.Message()
+        message.type = protocol_pb2.Message.EOF
+        req.processMessage(message)
+
+    def fail(self, node):
+        """Fail the download of node."""
+        (req,) = [
+            r for r in self.protocol.requests.values() if r.node_id == node
+        ]
+        message = protocol_pb2.Message()
+        message.type = protocol_pb2.Message.ERROR
+        message.error.type = protocol_pb2.Error.DOES_NOT_EXIST
+        req.processMessage(message)
+
+    def test_window(self):
+        """Only 'window' downloads are in flight."""
+        mgc = MultiGetContent(self.protocol, self.items, window=2)
+        mgc.start()
+        self.assertEqual(self.in_flight(), ['node0', 'node1'])
+        self.assertEqual(len(self.protocol.messages), 2)
+
+    def test_next_one_started(self):
+        """A new download starts as soon as one finishes."""
+        mgc = MultiGetContent(self.protocol, self.items, window=2)
+        mgc.start()
+        self.finish('node1')
+        self.assertEqual(self.in_flight(), ['node0', 'node2'])
+
+    @defer.inlineCallbacks
+    def test_results(self):
+        """All the contents are collected."""
+        mgc = MultiGetContent(self.protocol, iter(self.items), window=2)
+        mgc.start()
+        for i in range(5):
+            self.finish('node%d' % i, data=b'data%d' % i)
+        result = yield mgc.deferred
+        self.assertIs(result, mgc)
+        self.assertEqual(
+            mgc.results,
+            [('share', 'node%d' % i, b'data%d' % i) for i in range(5)],
+        )
+        self.assertEqual(mgc.failures, [])
+
+    @defer.inlineCallbacks
+    def test_failures(self):
+        """Failed downloads are collected, the rest go on."""
+        mgc = MultiGetContent(self.protocol, self.items[:2], window=2)
+        mgc.start()
+        self.fail('node0')
+        self.finish('node1')
+        yield mgc.deferred
+        self.assertEqual(mgc.results, [('share', 'node1', b'content')])
+        [(share, node, failure)] = mgc.failures
+        self.assertEqual(node, 'node0')
+        self.assertTrue(failure.check(request.StorageRequestError))
+
+    def test_callback_backpressure(self):
+        """The next download waits for the deferred from the callback."""
+        waiting = []
+
+        def callback(share, node, data):
+            d = defer.Deferred()
+            waiting.append((node, d))
+            return d
+
+        mgc = MultiGetContent(
+            self.protocol, self.items, window=1, callback=callback
+        )
+        mgc.start()
+        self.finish('node0')
+        self.assertEqual(self.in_flight(), [])
+        self.assertEqual(mgc.results, [])
+
+        waiting[0][1].callback(None)
+        self.assertEqual(self.in_flight(), ['node1'])
+
+    def test_pause_resume(self):
+        """No downloads are started while paused."""
+        mgc = MultiGetContent(self.protocol, self.items, window=2)
+        mgc.start()
+        mgc.pauseProducing()
+        self.finish('node0')
+        self.assertEqual(self.in_flight(), ['node1'])
+        mgc.resumeProducing()
+        self.assertEqual(self.in_flight(), ['node1', 'node2'])
+
+    def test_no_items(self):
+        """Without items it finishes right away."""
+        mgc = MultiGetContent(self.protocol, [])
+        mgc.start()
+        self.assertTrue(mgc.deferred.called)
+
+    def test_bad_window(self):
+        """The window must allow some download."""
+        self.assertRaises(
+            ValueError, MultiGetContent, self.protocol, self.items, 0
+        )
+
+    @defer.inlineCallbacks
+    def test_connection_lost(self):
+        """No downloads are started after losing the connection."""
+        mgc = MultiGetContent(self.protocol, self.items, window=2)
+        mgc.start()
+        self.protocol.connectionLost(Failure(ConnectionLost()))
+        self.assertEqual(self.in_flight(), [])
+        yield self.assertFailure(mgc.deferred, ConnectionLost)
+        self.assertEqual(len(mgc.failures), 2)
+
+    @defer.inlineCallbacks
+    def test_stop_producing(self):
+        """After stopping, the deferred fails when nothing's in flight."""
+        mgc = MultiGetContent(self.protocol, self.items, window=2)
+        mgc.start()
+        mgc.stopProducing()
+        self.finish('node0')
+        self.assertEqual(self.in_flight(), ['node1'])
+        self.assertFalse(mgc.deferred.called)
+        self.finish('node1')
+        self.assertEqual(self.in_flight(), [])
+        yield self.assertFailure(mgc.deferred, request.RequestCancelledError)
+        self.assertEqual(len(mgc.results), 2)
+
+    def test_client_get_contents(self):
+        """The client starts a MultiGetContent."""
+        d = self.protocol.get_contents(self.items, window=3)
+        self.assertIsInstance(d, Deferred)
+        self.assertEqual(self.in_flight(), ['node0', 'node1', 'node2'])
+
+
+class StreamingQueryTestCase(TestCase):
+    """Test cases for StreamingQuery."""
+
+    def setUp(self):
+        """Initialize testing protocol."""
+        self.protocol = FakedProtocol()
+        self.items = [('share', 'node%d' % i, 'hash') for i in range(5)]
+        # two items per query
+        message = protocol_pb2.Message()
+        message.id = 0
+        message.type = protocol_pb2.Message.QUERY
+        max_size = message.ByteSize() + 2 * query_item_size(*self.items[0])
+        self.patch(request, 'MAX_MESSAGE_SIZE', max_size)
+
+    def in_flight(self):
+        """Return the nodes asked by the queries in flight."""
+        return [
+            [q.node for q in r.query_message.query]
+            for r in self.protocol.requests.values()
+            if isinstance(r, Query)
+        ]
+
+    def finish(self, node):
+        """Answer and end the query that asks for node."""
+        (req,) = [
+            r
+            for r in self.protocol.requests.values()
+            if node in [q.node for q in r.query_message.query]
+        ]
+        for q in req.query_message.query:
+            message = protocol_pb2.Message()
+            message.type = protocol_pb2.Message.NODE_STATE
+            message.node_state.share = q.share
+            message.node_state.node = q.node
+            message.node_state.hash = 'new hash'
+            req.processMessage(message)
+        message = protocol_pb2.Message()
+        message.type = protocol_pb2.Message.QUERY_END
+        req.processMessage(message)
+
+    def test_max_in_flight(self):
+        """Only 'max_in_flight' queries are built and started."""
+        sq = StreamingQuery(self.protocol, iter(self.items), max_in_flight=1)
+        sq.start()
+        self.assertEqual(self.in_flight(), [['node0', 'node1']])
+        self.assertEqual(len(self.protocol.messages), 1)
+
+    def test_next_one_started(self):
+        """A new query starts as soon as one finishes."""
+        sq = StreamingQuery(self.protocol, self.items, max_in_flight=2)
+        sq.start()
+        self.finish('node0')
+        self.assertEqual(self.in_flight(), [['node2', 'node3'], ['node4']])
+
+    @defer.inlineCallbacks
+    def test_response(self):
+        """All the node states are collected, once."""
+        d = self.protocol.query_stream(self.items, max_in_flight=2)
+        for node in ('node0', 'node2', 'node4'):
+            self.finish(node)
+        sq = yield d
+        self.assertEqual(
+            [ns.node for ns in sq.response],
+            ['node%d' % i for i in range(5)],
+        )
+        self.assertEqual(sq.failures, [])
+
+    @defer.inlineCallbacks
+    def test_on_state(self):
+        """The node states go to the callback, and are not kept."""
+        called = []
+        d = self.protocol.query_stream(
+            self.items, max_in_flight=2, on_state=called.append
+        )
+        queries = [
+            r for r in self.protocol.requests.values() if isinstance(r, Query)
+        ]
+        for node in ('node0', 'node2', 'node4'):
+            self.finish(node)
+        sq = yield d
+        self.assertEqual(
+            [ns.node for ns in called], ['node%d' % i for i in range(5)]
+        )
+        self.assertEqual(sq.response, [])
+        self.assertEqual([q.response for q in queries], [[], []])
+
+    @defer.inlineCallbacks
+    def test_failures(self):
+        """Failed queries are collected, the rest go on."""
+        sq = StreamingQuery(self.protocol, self.items, max_in_flight=3)
+        sq.start()
+        (req,) = [
+            r
+            for r in self.protocol.requests.values()
+            if r.query_message.query[0].node == 'node2'
+        ]
+        message = protocol_pb2.Message()
+        message.type = protocol_pb2.Message.ERROR
+        message.error.type = protocol_pb2.Error.PROTOCOL_ERROR
+        req.processMessage(message)
+        self.finish('node0')
+        self.finish('node4')
+        yield sq.deferred
+        self.assertEqual(len(sq.response), 3)
+        [failure] = sq.failures
+        self.assertTrue(failure.check(request.StorageRequestError))
+
+    @defer.inlineCallbacks
+    def test_no_items(self):
+        """Without items, no query is sent."""
+        sq = yield self.protocol.query_stream([])
+        self.assertEqual(sq.response, [])
+        self.assertEqual(self.protocol.messages, [])
+
+    @defer.inlineCallbacks
+    def test_connection_lost(self):
+        """No queries are started after losing the connection."""
+        d = self.protocol.query_stream(self.items, max_in_flight=1)
+        self.protocol.connectionLost(Failure(ConnectionLost()))
+        self.assertEqual(self.in_flight(), [])
+        yield self.assertFailure(d, ConnectionLost)
+
+    def test_max_in_flight_positive(self):
+        """At least one query must be in flight."""
+        self.assertRaises(
+            ValueError, StreamingQuery, self.protocol, [], max_in_flight=0
+        )
+
+
 class ChangePublicAccessTestCase(RequestTestCase):
     """Test cases for ChangePublicAccess op."""
 
@@ -0,0 +1,285 @@
+# Copyright 2015-2022 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the
+# OpenSSL library under certain conditions as described in each
+# individual source file, and distribute linked combinations
+# including the two.
+# You must obey the GNU General Public License in all respects
+# for all of the code used other than OpenSSL.  If you modify
+# file(s) with this exception, you may extend this exception to your
+# version of the file(s), but you are not obligated to do so.  If you
+# do not wish to do so, delete this exception statement from your
+# version.  If you delete this exception statement from all source
+# files in the program, then also delete it here.
+
+"""Tests for the persistent delta cache."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from magicicadaprotocol import delta, request
+from magicicadaprotocol.delta_cache import DeltaCache, MAGIC
+from magicicadaprotocol.tests.test_volume_index import (
+    FakeClient,
+    FakeRequest,
+    make_delta,
+)
+from magicicadaprotocol.volume_index import VolumeIndex
+
+
+class DeltaCacheTestCase(unittest.TestCase):
+    """Check the storage of the deltas."""
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'volume.cache')
+        self.cache = self.open()
+
+    def open(self):
+        """Open the cache at self.path."""
+        cache = DeltaCache(self.path)
+        self.addCleanup(cache.close)
+        return cache
+
+    def reopen(self):
+        """Close the cache and open it again."""
+        self.cache.close()
+        self.cache = self.open()
+
+    def test_new(self):
+        """A new cache is empty."""
+        self.assertEqual(len(self.cache), 0)
+        self.assertIsNone(self.cache.generation)
+        self.assertEqual(list(self.cache), [])
+        with open(self.path, 'rb') as fh:
+            self.assertEqual(fh.read(), MAGIC)
+
+    def test_not_a_cache(self):
+        """Other files are not opened."""
+        with open(self.path + '.other', 'wb') as fh:
+            fh.write(b'something else')
+        self.assertRaises(ValueError, DeltaCache, self.path + '.other')
+
+    def test_add_and_get(self):
+        """Deltas are stored and read back, also from lazy deltas."""
+        info = make_delta('a', 'root', 'a.txt', 3, file_type=delta.FILE)
+        self.cache.add(info)
+        lazy = delta.LazyFileInfoDelta(self.cache.get('a').delta_info)
+        lazy.delta_info.file_info.node = 'b'
+        self.cache.add(lazy)
+        self.assertEqual(self.cache.get('a'), info)
+        self.assertEqual(self.cache.get('b').node_id, 'b')
+        self.assertIsNone(self.cache.get('c'))
+        self.assertIn('a', self.cache)
+
+    def test_root(self):
+        """A node without parent is kept without it."""
+        self.cache.add(make_delta('root', None, '', 1))
+        self.assertIsNone(self.cache.get('root').parent_id)
+
+    def test_persisted(self):
+        """The latest deltas and the generation survive a reopen."""
+        self.cache.add(make_delta('a', 'root', 'a.txt', 3))
+        self.cache.add(make_delta('b', 'root', 'b.txt', 4))
+        self.cache.add(make_delta('a', 'root', 'renamed', 5))
+        self.cache.discard('b')
+        self.cache.set_generation(5)
+        self.reopen()
+        self.assertEqual(self.cache.generation, 5)
+        self.assertEqual(
+            list(self.cache), [make_delta('a', 'root', 'renamed', 5)]
+        )
+        self.assertEqual(self.cache.records, 4)
+
+    def test_torn_record(self):
+        """An incomplete last record is dropped."""
+        self.cache.add(make_delta('a', 'root', 'a.txt', 3))
+        self.cache.set_generation(3)
+        size = os.path.getsize(self.path)
+        self.cache.add(make_delta('b', 'root', 'b.txt', 4))
+        self.cache.close()
+        with open(self.path, 'r+b') as fh:
+            fh.truncate(size + 10)
+        self.cache = self.open()
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.cache.add(make_delta('c', 'root', 'c.txt', 4))
+        self.reopen()
+        self.assertEqual(sorted(self.cache.offsets), ['a', 'c'])
+
+    def test_read_after_append(self):
+        """Deltas appended after reading are read too."""
+        self.cache.add(make_delta('a', 'root', 'a.txt', 3))
+        self.cache.get('a')
+        self.cache.add(make_delta('b', 'root', 'b.txt', 4))
+        self.assertEqual(self.cache.get('b').name, 'b.txt')
+
+    def test_clear(self):
+        """Clearing forgets the deltas and the generation."""
+        self.cache.add(make_delta('a', 'root', 'a.txt', 3))
+        self.cache.set_generation(3)
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+        self.assertIsNone(self.cache.generation)
+        self.reopen()
+        self.assertEqual(len(self.cache), 0)
+        self.assertIsNone(self.cache.generation)
+
+    def test_compact(self):
+        """Compacting keeps only the latest live deltas."""
+        for i in range(10):
+            self.cache.add(make_delta('a', 'root', 'a%d' % i, i))
+        self.cache.add(make_delta('b', 'root', 'b.txt', 10))
+        self.cache.discard('b')
+        self.cache.set_generation(10)
+        size = os.path.getsize(self.path)
+        self.cache.compact()
+        self.assertTrue(os.path.getsize(self.path) < size)
+        self.reopen()
+        self.assertEqual(self.cache.records, 1)
+        self.assertEqual(self.cache.generation, 10)
+        self.assertEqual(self.cache.get('a').name, 'a9')
+
+
+class VolumeIndexCacheTestCase(unittest.TestCase):
+    """Check the volume index persisted in a cache."""
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'volume.cache')
+        self.client = FakeClient()
+
+    def index(self):
+        """Return an index with a cache at self.path."""
+        cache = DeltaCache(self.path)
+        self.addCleanup(cache.close)
+        return VolumeIndex(request.ROOT, cache)
+
+    def test_restart(self):
+        """After a restart, only the generations since are asked."""
+        index = self.index()
+        index.update(self.client)
+        [(_, _, from_scratch, d)] = self.client.deltas
+        self.assertTrue(from_scratch)
+        index.apply_many(
+            [
+                make_delta('root', None, '', 1),
+                make_delta('docs', 'root', 'docs', 2),
+                make_delta('a', 'docs', 'a.txt', 3),
+            ]
+        )
+        d.callback(FakeRequest(7))
+        index.cache.close()
+
+        index = self.index()
+        self.assertEqual(index.generation, 7)
+        self.assertEqual(index.lookup('/docs/a.txt').node_id, 'a')
+        index.update(self.client)
+        _, from_generation, from_scratch, _ = self.client.deltas[-1]
+        self.assertEqual(from_generation, 7)
+        self.assertFalse(from_scratch)
+
+    def test_removed_subtree(self):
+        """The nodes under a removed directory are not loaded again."""
+        index = self.index()
+        index.apply_many(
+            [
+                make_delta('root', None, '', 1),
+                make_delta('docs', 'root', 'docs', 2),
+                make_delta('a', 'docs', 'a.txt', 3),
+                make_delta('docs', 'root', 'docs', 4, is_live=False),
+            ]
+        )
+        index.cache.set_generation(4)
+        index.cache.close()
+        index = self.index()
+        self.assertEqual(len(index), 1)
+        self.assertIsNone(index.get('a'))
+        self.assertEqual(index.lookup('/').node_id, 'root')
+        self.assertEqual(list(index.nodes), ['root'])
+
+    def test_not_committed(self):
+        """Deltas stored with no generation after them are dropped."""
+        index = self.index()
+        index.update(self.client)
+        index.apply_many(
+            [
+                make_delta('root', None, '', 1),
+                make_delta('docs', 'root', 'docs', 90),
+            ]
+        )
+        index.cache.close()
+
+        index = self.index()
+        self.assertIsNone(index.generation)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(len(index.cache), 0)
+        index.update(self.client)
+        _, from_generation, from_scratch, _ = self.client.deltas[-1]
+        self.assertIsNone(from_generation)
+        self.assertTrue(from_scratch)
+
+    def test_lazy_load(self):
+        """The tables are built from the cache only when needed."""
+        index = self.index()
+        index.apply_many(
+            [
+                make_delta('root', None, '', 1),
+                make_delta('docs', 'root', 'docs', 2),
+                make_delta('a', 'docs', 'a.txt', 3),
+            ]
+        )
+        index.cache.set_generation(3)
+        index.cache.close()
+
+        index = self.index()
+        self.assertFalse(index.loaded)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.get('a').name, 'a.txt')
+        # new and moved nodes only go to the cache
+        index.apply(make_delta('a', 'root', 'moved.txt', 4))
+        index.apply(make_delta('b', 'docs', 'b.txt', 5))
+        self.assertFalse(index.loaded)
+        self.assertEqual(index.get('a').name, 'moved.txt')
+
+        self.assertEqual(index.lookup('/moved.txt').node_id, 'a')
+        self.assertTrue(index.loaded)
+        self.assertEqual(
+            [info.name for info in index.listdir('docs')], ['b.txt']
+        )
+
+    def test_lazy_remove(self):
+        """Removing a node builds the tables, to remove its subtree."""
+        index = self.index()
+        index.apply_many(
+            [
+                make_delta('root', None, '', 1),
+                make_delta('docs', 'root', 'docs', 2),
+                make_delta('a', 'docs', 'a.txt', 3),
+            ]
+        )
+        index.cache.set_generation(3)
+        index.cache.close()
+
+        index = self.index()
+        index.apply(make_delta('docs', 'root', 'docs', 4, is_live=False))
+        self.assertTrue(index.loaded)
+        self.assertEqual(len(index), 1)
+        self.assertIsNone(index.cache.get('a'))
@@ -110,3 +110,128 @@ class DeltaTestCase(unittest.TestCase):
         msg.delta_info.file_info.parent = ''
         m = delta.from_message(msg)
         self.assertEqual(m.parent_id, None)
+
+    def test_no_dict(self):
+        """The deltas don't carry a __dict__."""
+        m = delta.from_message(get_message())
+        self.assertFalse(hasattr(m, '__dict__'))
+
+    def test_is_not_equal(self):
+        """Deltas differing in any field are not equal."""
+        m = delta.from_message(get_message())
+        msg = get_message()
+        msg.delta_info.file_info.size = 1
+        self.assertNotEqual(m, delta.from_message(msg))
+        self.assertNotEqual(m, m.as_tuple())
+
+
+class LazyDeltaTestCase(unittest.TestCase):
+    """Check the lazy Delta data type."""
+
+    def test_correct_attributes(self):
+        """The fields are read from the message."""
+        m = delta.from_message(get_message(), lazy=True)
+        self.assertIsInstance(m, delta.LazyFileInfoDelta)
+        self.assertEqual(m.generation, 10)
+        self.assertEqual(m.is_live, False)
+        self.assertEqual(m.file_type, delta.FILE)
+        self.assertEqual(m.parent_id, PARENT)
+        self.assertEqual(m.name, "filename")
+        self.assertEqual(m.share_id, SHARE)
+        self.assertEqual(m.node_id, NODE)
+        self.assertEqual(m.is_public, True)
+        self.assertEqual(m.content_hash, HASH)
+        self.assertEqual(m.crc32, CRC)
+        self.assertEqual(m.size, 1024)
+        self.assertEqual(m.last_modified, 2048)
+
+    def test_parent_id_None(self):
+        """No parent is None, as in the eager delta."""
+        msg = get_message()
+        msg.delta_info.file_info.parent = ''
+        m = delta.from_message(msg, lazy=True)
+        self.assertEqual(m.parent_id, None)
+
+    def test_equal_to_eager(self):
+        """Lazy and eager deltas of the same message are equal."""
+        lazy = delta.from_message(get_message(), lazy=True)
+        eager = delta.from_message(get_message())
+        self.assertEqual(lazy, eager)
+        self.assertEqual(eager, lazy)
+
+    def test_not_equal_to_eager(self):
+        """Lazy and eager deltas of different messages are not equal."""
+        msg = get_message()
+        msg.delta_info.generation = 11
+        lazy = delta.from_message(msg, lazy=True)
+        self.assertNotEqual(lazy, delta.from_message(get_message()))
+
+    def test_read_only_when_used(self):
+        """The fields are not copied from the message."""
+        msg = get_message()
+        m = delta.from_message(msg, lazy=True)
+        msg.delta_info.file_info.name = "other"
+        self.assertEqual(m.name, "other")
+
+
+class DeltaBatchTestCase(unittest.TestCase):
+    """Check the DeltaBatch container."""
+
+    def get_messages(self, n=3):
+        """Return n DELTA_INFO messages for different nodes."""
+        messages = []
+        for i in range(n):
+            message = get_message()
+            message.delta_info.generation = i
+            message.delta_info.file_info.node = 'node%d' % i
+            message.delta_info.file_info.crc32 = 2**32 - 1 - i
+            message.delta_info.file_info.size = 2**40 + i
+            messages.append(message)
+        return messages
+
+    def test_empty(self):
+        """A new batch is empty."""
+        batch = delta.DeltaBatch()
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(list(batch), [])
+
+    def test_add_message(self):
+        """The rows are the same than the deltas of the messages."""
+        messages = self.get_messages()
+        batch = delta.DeltaBatch()
+        for message in messages:
+            batch.add_message(message.delta_info)
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(
+            list(batch), [delta.from_message(m) for m in messages]
+        )
+
+    def test_append(self):
+        """FileInfoDelta can be added too."""
+        infos = [delta.from_message(m) for m in self.get_messages()]
+        batch = delta.DeltaBatch(infos)
+        self.assertEqual(list(batch), infos)
+        self.assertEqual(batch[-1], infos[-1])
+
+    def test_parent_id_None(self):
+        """No parent is kept as None."""
+        message = get_message()
+        message.delta_info.file_info.parent = ''
+        batch = delta.DeltaBatch()
+        batch.add_message(message.delta_info)
+        self.assertEqual(batch[0].parent_id, None)
+
+    def test_strings_interned(self):
+        """Repeated strings are stored once."""
+        batch = delta.DeltaBatch()
+        for message in self.get_messages():
+            batch.add_message(message.delta_info)
+        self.assertIs(batch.share_ids[0], batch.share_ids[2])
+        self.assertIs(batch.parent_ids[0], batch.parent_ids[1])
+
+    def test_index_error(self):
+        """Out of range rows raise IndexError."""
+        batch = delta.DeltaBatch()
+        batch.add_message(get_message().delta_info)
+        self.assertRaises(IndexError, batch.__getitem__, 1)
+        self.assertRaises(IndexError, batch.__getitem__, -2)
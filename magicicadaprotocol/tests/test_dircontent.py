@@ -30,15 +30,24 @@
 from io import BytesIO
 from unittest import TestCase
 
+from google.protobuf.message import DecodeError
+
 from magicicadaprotocol.dircontent import (
+    DirContentIndex,
     parse_dir_content,
     write_dir_content,
+    yield_presorted_dir_content,
     DirEntry,
     normalize_filename,
     validate_filename,
     InvalidFilename,
 )
-from magicicadaprotocol.dircontent_pb2 import DIRECTORY, FILE
+from magicicadaprotocol.dircontent_pb2 import (
+    DIRECTORY,
+    FILE,
+    SYMLINK,
+    DirectoryContent,
+)
 
 
 class TestFilenames(TestCase):
@@ -116,3 +125,235 @@ class TestDirContent(TestCase):
         buf.seek(0, 0)
         output_entries = [e for e in parse_dir_content(buf)]
         self.assertEqual(output_entries, [b, a])
+
+
+class RecordingStream(BytesIO):
+    """A stream that records the sizes it's read with."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.reads = []
+
+    def read(self, size=-1):
+        self.reads.append(size)
+        return super().read(size)
+
+
+class TestParseDirContent(TestCase):
+    """Tests for the incremental parsing of directory content."""
+
+    def serialize(self, entries):
+        """Return the serialized content of the entries."""
+        buf = BytesIO()
+        write_dir_content(entries, buf)
+        return buf.getvalue()
+
+    def make_entries(self, n):
+        """Return n entries, sorted."""
+        return [
+            DirEntry(name="entry-%05d-ñ" % i, node_type=FILE, uuid="id%d" % i)
+            for i in range(n)
+        ]
+
+    def test_empty(self):
+        """No content, no entries."""
+        self.assertEqual(list(parse_dir_content(BytesIO(b""))), [])
+
+    def test_small_blocks(self):
+        """Entries split across blocks are parsed."""
+        entries = self.make_entries(50)
+        content = self.serialize(entries)
+        for block_size in (1, 3, 7, 64):
+            parsed = list(parse_dir_content(BytesIO(content), block_size))
+            self.assertEqual(parsed, entries)
+
+    def test_bounded_reads(self):
+        """The stream is never read whole."""
+        stream = RecordingStream(self.serialize(self.make_entries(100)))
+        list(parse_dir_content(stream, block_size=128))
+        self.assertTrue(len(stream.reads) > 1)
+        self.assertEqual(set(stream.reads), {128})
+
+    def test_incremental(self):
+        """Entries are yielded before the stream is exhausted."""
+        stream = RecordingStream(self.serialize(self.make_entries(100)))
+        parsed = parse_dir_content(stream, block_size=128)
+        self.assertEqual(next(parsed).name, "entry-00000-ñ")
+        self.assertEqual(stream.reads, [128])
+
+    def test_truncated(self):
+        """Truncated content fails."""
+        content = self.serialize(self.make_entries(3))
+        stream = BytesIO(content[:-1])
+        parsed = parse_dir_content(stream, block_size=4)
+        self.assertRaises(DecodeError, list, parsed)
+
+    def test_unknown_fields(self):
+        """Unknown fields are skipped, whatever their wire type."""
+        entries = self.make_entries(3)
+        unknown = (
+            b"\x10\x96\x01"  # varint
+            + b"\x19\x00\x00\x00\x00\x00\x00\x00\x00"  # fixed64
+            + b"\x22\x03abc"  # length delimited
+            + b"\x2d\x00\x00\x00\x00"  # fixed32
+        )
+        content = unknown + self.serialize(entries) + unknown
+        for block_size in (1, 5, 64):
+            parsed = list(parse_dir_content(BytesIO(content), block_size))
+            self.assertEqual(parsed, entries)
+
+    def test_unexpected_wire_type(self):
+        """Content with groups or bogus wire types fails."""
+        parsed = parse_dir_content(BytesIO(b"\x13\x14"))
+        self.assertRaises(DecodeError, list, parsed)
+
+    def test_truncated_unknown_field(self):
+        """A truncated unknown field fails too."""
+        parsed = parse_dir_content(BytesIO(b"\x19\x00\x00"))
+        self.assertRaises(DecodeError, list, parsed)
+
+
+class TestYieldDirContent(TestCase):
+    """Tests for the batched serialization of directory content."""
+
+    entries = [
+        DirEntry(name="a", node_type=DIRECTORY, uuid="id-a"),
+        DirEntry(name="", node_type=FILE, uuid=""),
+        DirEntry(name="\u269b" * 100, node_type=SYMLINK, uuid="x" * 200),
+    ] + [
+        DirEntry(name="file%d" % i, node_type=FILE, uuid="id%d" % i)
+        for i in range(100)
+    ]
+
+    def test_same_as_protobuf(self):
+        """The direct encoding is the same as protobuf's."""
+        expected = DirectoryContent()
+        for entry in self.entries:
+            pb_entry = expected.entries.add()
+            pb_entry.name = entry.name
+            pb_entry.node_type = entry.node_type
+            pb_entry.node = entry.uuid
+        direct = b"".join(yield_presorted_dir_content(self.entries))
+        self.assertEqual(direct, expected.SerializeToString())
+        serialized = b"".join(
+            yield_presorted_dir_content(self.entries, direct=False)
+        )
+        self.assertEqual(serialized, direct)
+
+    def test_chunks(self):
+        """The content is yielded in big chunks."""
+        chunks = list(
+            yield_presorted_dir_content(self.entries, chunk_size=256)
+        )
+        self.assertTrue(1 < len(chunks) < len(self.entries))
+        for chunk in chunks[:-1]:
+            self.assertTrue(len(chunk) >= 256)
+            self.assertIsInstance(chunk, bytes)
+
+    def test_no_entries(self):
+        """Nothing is yielded without entries."""
+        self.assertEqual(list(yield_presorted_dir_content([])), [])
+
+
+class TestDirContentIndex(TestCase):
+    """Tests for the sorted index of directory entries."""
+
+    def make_entries(self, names):
+        """Return entries for the names."""
+        return [
+            DirEntry(name=name, node_type=FILE, uuid="id-" + name)
+            for name in names
+        ]
+
+    def assert_serialized(self, index):
+        """The index serializes the same as writing its entries."""
+        expected = BytesIO()
+        write_dir_content(list(index), expected)
+        self.assertEqual(index.serialize(), expected.getvalue())
+
+    def setUp(self):
+        self.index = DirContentIndex(self.make_entries(["b", "d", "a", "c"]))
+
+    def names(self):
+        """Return the names in the index, in order."""
+        return [entry.name for entry in self.index]
+
+    def test_sorted(self):
+        """The entries are sorted."""
+        self.assertEqual(self.names(), ["a", "b", "c", "d"])
+        self.assertEqual(len(self.index), 4)
+
+    def test_sorted_by_utf8(self):
+        """The entries are sorted by their UTF-8 name."""
+        index = DirContentIndex(self.make_entries(["\uff21", "\u00e9", "z"]))
+        self.assertEqual(
+            [entry.name for entry in index], ["z", "\u00e9", "\uff21"]
+        )
+
+    def test_get(self):
+        """Entries are found by name, as string or bytes."""
+        self.assertEqual(self.index.get("c").uuid, "id-c")
+        self.assertEqual(self.index.get(b"d").uuid, "id-d")
+        self.assertIsNone(self.index.get("e"))
+        self.assertIn("a", self.index)
+        self.assertNotIn("aa", self.index)
+
+    def test_insert(self):
+        """Inserted entries keep the order."""
+        for entry in self.make_entries(["bb", "0", "z"]):
+            self.index.insert(entry)
+        self.assertEqual(self.names(), ["0", "a", "b", "bb", "c", "d", "z"])
+
+    def test_insert_replaces(self):
+        """An entry with an existing name replaces it."""
+        entry = DirEntry(name="b", node_type=DIRECTORY, uuid="other")
+        self.index.insert(entry)
+        self.assertEqual(len(self.index), 4)
+        self.assertIs(self.index.get("b"), entry)
+
+    def test_remove(self):
+        """Removed entries are returned."""
+        self.assertEqual(self.index.remove("b").uuid, "id-b")
+        self.assertEqual(self.names(), ["a", "c", "d"])
+        self.assertRaises(KeyError, self.index.remove, "b")
+
+    def test_rename(self):
+        """A renamed entry keeps its node and moves to its place."""
+        entry = self.index.rename("a", "e")
+        self.assertEqual(entry.uuid, "id-a")
+        self.assertEqual(self.names(), ["b", "c", "d", "e"])
+        self.assertRaises(KeyError, self.index.rename, "a", "f")
+
+    def test_serialized_updates(self):
+        """The serialized content follows the changes."""
+        self.assert_serialized(self.index)
+        for entry in self.make_entries(["bb", "0", "z"]):
+            self.index.insert(entry)
+        self.assert_serialized(self.index)
+        self.index.remove("0")
+        self.index.remove("z")
+        self.assert_serialized(self.index)
+        self.index.rename("b", "\u269b" * 80)
+        self.index.insert(DirEntry(name="c", node_type=DIRECTORY, uuid="x"))
+        self.assert_serialized(self.index)
+
+    def test_roundtrip(self):
+        """The index is built back from its serialized content."""
+        stream = BytesIO()
+        write_dir_content(self.index, stream)
+        stream.seek(0)
+        index = DirContentIndex.from_stream(stream)
+        self.assertEqual(list(index), list(self.index))
+
+    def test_from_unsorted_stream(self):
+        """Content not sorted is sorted."""
+        stream = BytesIO()
+        for chunk in yield_presorted_dir_content(self.make_entries("ba")):
+            stream.write(chunk)
+        stream.seek(0)
+        index = DirContentIndex.from_stream(stream)
+        self.assertEqual([entry.name for entry in index], ["a", "b"])
+
+    def test_entry_slots(self):
+        """Entries don't carry a __dict__."""
+        self.assertFalse(hasattr(self.index.get("a"), '__dict__'))
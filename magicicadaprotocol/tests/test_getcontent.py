@@ -27,12 +27,20 @@
 
 """Tests for GetContent request."""
 
+import os
 import unittest
+import zlib
+from io import BytesIO
 
 from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import TestCase as TwistedTestCase
 
-from magicicadaprotocol import protocol_pb2
-from magicicadaprotocol.client import GetContent, StorageClient
+from magicicadaprotocol import errors, protocol_pb2
+from magicicadaprotocol.client import ContentSink, GetContent, StorageClient
+from magicicadaprotocol.content_hash import content_hash_factory, crc32
+
+CONTENT = b"Lorem ipsum dolor sit amet, consectetur adipiscing elit." * 100
+DEFLATED = zlib.compress(CONTENT)
 
 
 class ProcessMessageTestCase(unittest.TestCase):
@@ -60,3 +68,167 @@ class ProcessMessageTestCase(unittest.TestCase):
         gc.processMessage(message)
 
         self.assertEqual(gc.data, b'foobar')
+
+
+def chunks(data, size):
+    """Split data in chunks of size."""
+    stream = BytesIO(data)
+    return iter(lambda: stream.read(size), b"")
+
+
+def content_hash(data):
+    """Return the content hash for data."""
+    hasher = content_hash_factory()
+    hasher.update(data)
+    return hasher.content_hash()
+
+
+class ContentSinkTestCase(TwistedTestCase):
+    """Tests for ContentSink."""
+
+    def write_all(self, sink, size=7):
+        for chunk in chunks(DEFLATED, size):
+            sink.write(chunk)
+        sink.finish()
+
+    def test_file_like(self):
+        """The received bytes are written untouched."""
+        target = BytesIO()
+        sink = ContentSink(target)
+        self.write_all(sink)
+        self.assertEqual(target.getvalue(), DEFLATED)
+        self.assertFalse(target.closed)
+
+    def test_path(self):
+        """A path is created, written and closed."""
+        path = self.mktemp()
+        sink = ContentSink(path)
+        self.write_all(sink)
+        self.assertTrue(sink.fh.closed)
+        with open(path, 'rb') as fh:
+            self.assertEqual(fh.read(), DEFLATED)
+
+    def test_fd(self):
+        """A file descriptor is written and left open."""
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        sink = ContentSink(write_fd)
+        self.write_all(sink, size=len(DEFLATED))
+        self.assertEqual(os.read(read_fd, len(DEFLATED) + 1), DEFLATED)
+
+    def test_computed_values(self):
+        """Sizes, crc32 and hash are computed from the content."""
+        sink = ContentSink(BytesIO())
+        self.write_all(sink)
+        self.assertEqual(sink.deflated_size, len(DEFLATED))
+        self.assertEqual(sink.size, len(CONTENT))
+        self.assertEqual(sink.crc32, crc32(CONTENT))
+        self.assertEqual(sink.hash, content_hash(CONTENT))
+
+    def test_check(self):
+        """The mismatching values are reported."""
+        sink = ContentSink(BytesIO())
+        self.write_all(sink)
+        mismatches = sink.check(
+            deflated_size=len(DEFLATED),
+            size=len(CONTENT) + 1,
+            hash=content_hash(CONTENT),
+            crc32=crc32(CONTENT),
+        )
+        self.assertEqual(
+            mismatches, [('size', len(CONTENT) + 1, len(CONTENT))]
+        )
+
+    def test_not_inflating(self):
+        """Without inflating, only the deflated size is computed."""
+        target = BytesIO()
+        sink = ContentSink(target, inflate=False)
+        for chunk in chunks(DEFLATED[10:], 7):
+            sink.write(chunk)
+        sink.finish()
+        self.assertEqual(target.getvalue(), DEFLATED[10:])
+        self.assertEqual(sink.deflated_size, len(DEFLATED) - 10)
+        self.assertEqual(sink.size, 0)
+        self.assertIsNone(sink.hash)
+
+    def test_given_sink_with_offset(self):
+        """A given sink doesn't inflate a partial download."""
+        sink = ContentSink(BytesIO())
+        protocol = StorageClient()
+        GetContent(protocol, 'share', 'node_id', 'sha1:hash', 10, sink=sink)
+        self.assertIsNone(sink.inflater)
+
+
+class SinkTestCase(TwistedTestCase):
+    """Tests for GetContent writing to a sink."""
+
+    def make_request(self, offset=0):
+        protocol = StorageClient()
+        protocol.transport = StringTransport()
+        self.target = BytesIO()
+        gc = GetContent(
+            protocol, 'share', 'node_id', 'sha1:hash', offset, sink=self.target
+        )
+        gc.start()
+        return gc
+
+    def send(self, gc, crc=None, offset=0):
+        message = protocol_pb2.Message()
+        message.type = protocol_pb2.Message.NODE_ATTR
+        message.node_attr.deflated_size = len(DEFLATED)
+        message.node_attr.size = len(CONTENT)
+        message.node_attr.hash = content_hash(CONTENT)
+        message.node_attr.crc32 = crc32(CONTENT) if crc is None else crc
+        gc.processMessage(message)
+        for chunk in chunks(DEFLATED[offset:], 100):
+            message = protocol_pb2.Message()
+            message.type = protocol_pb2.Message.BYTES
+            message.bytes.bytes = chunk
+            gc.processMessage(message)
+        message = protocol_pb2.Message()
+        message.type = protocol_pb2.Message.EOF
+        gc.processMessage(message)
+
+    def test_written_as_arrives(self):
+        """The data goes to the sink, not kept in memory."""
+        gc = self.make_request()
+        self.send(gc)
+        self.assertEqual(self.target.getvalue(), DEFLATED)
+        self.assertEqual(gc.parts, [])
+        self.assertFalse(hasattr(gc, 'data'))
+        return gc.deferred
+
+    def test_verification_error(self):
+        """A content not matching NODE_ATTR fails the request."""
+        gc = self.make_request()
+        self.send(gc, crc=12)
+        d = self.assertFailure(gc.deferred, errors.ContentVerificationError)
+        d.addCallback(
+            lambda e: self.assertEqual(
+                e.mismatches, [('crc32', 12, crc32(CONTENT))]
+            )
+        )
+        return d
+
+    def test_callback_and_sink(self):
+        """A callback and a sink can't be used together."""
+        self.assertRaises(
+            ValueError,
+            GetContent,
+            StorageClient(),
+            'share',
+            'node_id',
+            'sha1:hash',
+            callback=lambda data: None,
+            sink=BytesIO(),
+        )
+
+    def test_no_verification_with_offset(self):
+        """A partial download can't be verified."""
+        gc = self.make_request(offset=10)
+        self.send(gc, crc=12, offset=10)
+        self.assertEqual(self.target.getvalue(), DEFLATED[10:])
+        self.assertEqual(gc.sink.deflated_size, len(DEFLATED) - 10)
+        self.assertIsNone(gc.sink.hash)
+        return gc.deferred
@@ -0,0 +1,245 @@
+# Copyright 2015-2022 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the
+# OpenSSL library under certain conditions as described in each
+# individual source file, and distribute linked combinations
+# including the two.
+# You must obey the GNU General Public License in all respects
+# for all of the code used other than OpenSSL.  If you modify
+# file(s) with this exception, you may extend this exception to your
+# version of the file(s), but you are not obligated to do so.  If you
+# do not wish to do so, delete this exception statement from your
+# version.  If you delete this exception statement from all source
+# files in the program, then also delete it here.
+
+"""Tests for the persistent hash cache."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+from magicicadaprotocol import content_hash
+from magicicadaprotocol.hash_cache import (
+    MAC_SIZE,
+    MAGIC,
+    HashCache,
+    stat_key,
+)
+
+KEY = b'a secret key'
+
+
+class HashCacheTestCase(unittest.TestCase):
+    """Check the storage of the hashes."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'hashes.cache')
+        self.file_path = self.make_file('file', b'some content' * 100)
+        self.cache = self.open()
+
+    def make_file(self, name, content):
+        """Create a file with content, return its path."""
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as fh:
+            fh.write(content)
+        return path
+
+    def open(self, key=KEY, **kwargs):
+        """Open the cache at self.path."""
+        cache = HashCache(self.path, key=key, **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def reopen(self, **kwargs):
+        """Close the cache and open it again."""
+        self.cache.close()
+        self.cache = self.open(**kwargs)
+
+    def assert_same_info(self, info, expected):
+        """Check that the UploadInfos have the same values."""
+        for name in content_hash.UploadInfo.__slots__:
+            if name != 'magic_hash':
+                self.assertEqual(
+                    getattr(info, name), getattr(expected, name), name
+                )
+        self.assertEqual(
+            info.magic_hash._magic_hash, expected.magic_hash._magic_hash
+        )
+
+    def test_new(self):
+        """A new cache is empty."""
+        self.assertEqual(len(self.cache), 0)
+        self.assertIsNone(self.cache.get(self.file_path))
+        with open(self.path, 'rb') as fh:
+            self.assertTrue(fh.read().startswith(MAGIC))
+
+    def test_not_a_cache(self):
+        """Other files are not opened."""
+        path = self.make_file('other', b'something else')
+        self.assertRaises(ValueError, HashCache, path)
+
+    def test_hash_file(self):
+        """The file is hashed once, then found in the cache."""
+        expected = content_hash.hash_file(self.file_path)
+        info = self.cache.hash_file(self.file_path)
+        self.assert_same_info(info, expected)
+        with mock.patch.object(content_hash, 'hash_file') as hash_file:
+            info = self.cache.hash_file(self.file_path)
+        self.assertFalse(hash_file.called)
+        self.assert_same_info(info, expected)
+
+    def test_persisted(self):
+        """The hashes are there after opening the cache again."""
+        expected = self.cache.hash_file(self.file_path)
+        self.reopen()
+        self.assertEqual(len(self.cache), 1)
+        self.assert_same_info(self.cache.get(self.file_path), expected)
+
+    def test_changed_file(self):
+        """A file that changed is hashed again."""
+        self.cache.hash_file(self.file_path)
+        self.make_file('file', b'other content')
+        self.assertIsNone(self.cache.get(self.file_path))
+        info = self.cache.hash_file(self.file_path)
+        self.assertEqual(info.size, len(b'other content'))
+
+    def test_magic_hash_hidden(self):
+        """The magic hash is not written to disk."""
+        info = self.cache.hash_file(self.file_path)
+        self.cache.flush()
+        magic = info.magic_hash._magic_hash.split(':')[1]
+        with open(self.path, 'rb') as fh:
+            data = fh.read()
+        self.assertNotIn(bytes.fromhex(magic), data)
+        self.assertNotIn(magic.encode('ascii'), data)
+
+    def test_other_key(self):
+        """With another key the records are not trusted."""
+        info = self.cache.hash_file(self.file_path)
+        self.cache.close()
+        self.cache = self.open(key=b'other key')
+        self.assertIsNone(self.cache.get(self.file_path))
+        # hashed again, and stored in place
+        self.assert_same_info(self.cache.hash_file(self.file_path), info)
+        self.cache.flush()
+        self.assertEqual(
+            os.path.getsize(self.path),
+            len(self.cache.header) + self.cache.record.size,
+        )
+
+    def test_tampered(self):
+        """A record changed on disk is not trusted."""
+        self.cache.hash_file(self.file_path)
+        self.cache.close()
+        with open(self.path, 'r+b') as fh:
+            fh.seek(-MAC_SIZE - 1, os.SEEK_END)
+            byte = fh.read(1)
+            fh.seek(-MAC_SIZE - 1, os.SEEK_END)
+            fh.write(bytes([byte[0] ^ 1]))
+        self.cache = self.open()
+        self.assertIsNone(self.cache.get(self.file_path))
+
+    def test_no_key(self):
+        """Without a key the magic hash is not stored."""
+        self.reopen(key=None)
+        self.cache.hash_file(self.file_path)
+        self.assertIsNone(self.cache.get(self.file_path).magic_hash)
+        # with a key, the magic hash is computed
+        self.reopen()
+        info = self.cache.hash_file(self.file_path)
+        self.assertIsNotNone(info.magic_hash)
+
+    def test_lru(self):
+        """Only the most recently used records are kept in memory."""
+        paths = [self.make_file(str(i), b'%d' % i) for i in range(3)]
+        self.reopen(max_entries=2)
+        keys = [stat_key(os.stat(path)) for path in paths]
+        self.cache.hash_file(paths[0])
+        self.cache.hash_file(paths[1])
+        self.cache.get(paths[0])
+        self.cache.hash_file(paths[2])
+        self.assertEqual(list(self.cache.entries), [keys[0], keys[2]])
+        self.assertEqual(len(self.cache), 3)
+
+    def test_read_from_disk(self):
+        """The records not in memory are read from the file."""
+        paths = [self.make_file(str(i), b'%d' % i) for i in range(3)]
+        self.reopen(max_entries=2)
+        infos = [self.cache.hash_file(path) for path in paths]
+        self.reopen(max_entries=2)
+        self.assertEqual(len(self.cache.entries), 0)
+        with mock.patch.object(content_hash, 'hash_file') as hash_file:
+            for path, info in zip(paths, infos):
+                self.assert_same_info(self.cache.hash_file(path), info)
+        self.assertFalse(hash_file.called)
+        self.assertEqual(len(self.cache.entries), 2)
+
+    def test_rescan_does_not_grow(self):
+        """Scanning more files than fit in memory again writes nothing."""
+        paths = [self.make_file(str(i), b'%d' % i) for i in range(5)]
+        self.reopen(max_entries=2)
+        for path in paths:
+            self.cache.hash_file(path)
+        self.cache.flush()
+        size = os.path.getsize(self.path)
+        for path in paths:
+            self.cache.hash_file(path)
+        self.cache.flush()
+        self.assertEqual(os.path.getsize(self.path), size)
+
+    def test_torn_record(self):
+        """A partially written last record is dropped."""
+        self.cache.hash_file(self.file_path)
+        self.cache.flush()
+        with open(self.path, 'ab') as fh:
+            fh.write(b'torn')
+        self.reopen()
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(
+            os.path.getsize(self.path),
+            len(self.cache.header) + self.cache.record.size,
+        )
+
+    def test_add_in_place(self):
+        """Storing a file again overwrites its record."""
+        info = self.cache.hash_file(self.file_path)
+        self.cache.add(info, os.stat(self.file_path))
+        self.cache.flush()
+        self.assertEqual(
+            os.path.getsize(self.path),
+            len(self.cache.header) + self.cache.record.size,
+        )
+        self.reopen()
+        self.assert_same_info(self.cache.get(self.file_path), info)
+
+    def test_compact(self):
+        """Compacting keeps only the most recently used records."""
+        other_path = self.make_file('other', b'other content')
+        info = self.cache.hash_file(self.file_path)
+        self.cache.hash_file(other_path)
+        self.cache.get(self.file_path)
+        self.cache.compact(max_records=1)
+        size = len(self.cache.header) + self.cache.record.size
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.reopen()
+        self.assertEqual(len(self.cache), 1)
+        self.assert_same_info(self.cache.get(self.file_path), info)
+        self.assertIsNone(self.cache.get(other_path))
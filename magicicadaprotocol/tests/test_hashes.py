@@ -30,12 +30,22 @@
 import hashlib
 import os
 import pickle
+import shutil
+import tempfile
 import unittest
+import zlib
+
+from io import BytesIO
 
 from magicicadaprotocol.content_hash import (
     MagicContentHash,
     SHA1ContentHash,
     content_hash_factory,
+    crc32,
+    crc32_combine,
+    crc32_file,
+    hash_file,
+    hash_files,
     magic_hash_factory,
 )
 
@@ -107,6 +117,49 @@ class ContentHashingTests(unittest.TestCase):
         ch = self.hasher.content_hash()
         self.assertEqual("sha1:" + hexdigest, ch)
 
+    def test_content_hash_bound_update(self):
+        """The content hash follows updates with a bound update."""
+        update = self.hasher.update
+        update(b"foo")
+        self.hasher.content_hash()
+        update(b"bar")
+        ch = self.hasher.content_hash()
+        self.assertEqual(ch, "sha1:" + hashlib.sha1(b"foobar").hexdigest())
+
+    def test_update_bound(self):
+        """The methods are the hash object's own."""
+        self.assertEqual(self.hasher.update, self.hasher.hash_object.update)
+        self.assertEqual(self.hasher.digest, self.hasher.hash_object.digest)
+        self.assertEqual(self.hasher.digest_size, hashlib.sha1().digest_size)
+
+    def test_update_many(self):
+        """Update with several buffers at once."""
+        self.hasher.content_hash()
+        self.hasher.update_many([b"foo", bytearray(b"ba"), memoryview(b"r")])
+        s = "sha1:" + hashlib.sha1(b"foobar").hexdigest()
+        self.assertEqual(self.hasher.content_hash(), s)
+
+    def test_update_from_file(self):
+        """Update with the rest of a file, in blocks."""
+        content = os.urandom(1000)
+        fh = BytesIO(content)
+        fh.seek(10)
+        read = self.hasher.update_from_file(fh, block_size=64)
+        self.assertEqual(read, 990)
+        s = hashlib.sha1(content[10:]).hexdigest()
+        self.assertEqual(self.hasher.hexdigest(), s)
+
+    def test_copy(self):
+        """The copy hashes on its own."""
+        self.hasher.update(b"foo")
+        self.hasher.content_hash()
+        cp = self.hasher.copy()
+        cp.update(b"bar")
+        self.assertEqual(cp.hexdigest(), hashlib.sha1(b"foobar").hexdigest())
+        self.assertEqual(
+            self.hasher.hexdigest(), hashlib.sha1(b"foo").hexdigest()
+        )
+
 
 class MagicHashingTests(unittest.TestCase):
     """Test magic content hashing."""
@@ -160,6 +213,15 @@ class MagicHashingTests(unittest.TestCase):
         # we have the real value hidden in the object
         self.assertEqual('magic_hash:' + hexdigest, ch._magic_hash)
 
+    def test_copy_hiding(self):
+        """The copy hashes on its own, and also hides the digest."""
+        self.hasher.update(b"foo")
+        cp = self.hasher.copy()
+        cp.update(b"bar")
+        self.assertRaises(NotImplementedError, cp.hexdigest)
+        s = hashlib.sha1(b"Ubuntu Onefoobar").hexdigest()
+        self.assertEqual(cp.content_hash()._magic_hash, 'magic_hash:' + s)
+
     def test_not_pickable(self):
         """The magic hasher and value can not be pickled"""
         # the hasher
@@ -168,3 +230,100 @@ class MagicHashingTests(unittest.TestCase):
         # the value
         ch = self.hasher.content_hash()
         self.assertRaises(NotImplementedError, pickle.dumps, ch)
+
+
+class CRC32CombineTests(unittest.TestCase):
+    """Test combining crc32s."""
+
+    def test_combine(self):
+        """The combined crc32 is the one of both parts."""
+        a = os.urandom(1000)
+        for b in (b'', b'x', os.urandom(3), os.urandom(4097)):
+            self.assertEqual(
+                crc32_combine(crc32(a), crc32(b), len(b)), crc32(a + b)
+            )
+
+    def test_combine_empty_first(self):
+        """Combining with an empty first part gives the second crc32."""
+        b = os.urandom(100)
+        self.assertEqual(crc32_combine(crc32(b''), crc32(b), 100), crc32(b))
+
+
+class HashFileTests(unittest.TestCase):
+    """Test getting the upload info of files."""
+
+    def setUp(self):
+        """Set up."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def make_file(self, name, content):
+        """Create a file with the content, return its path."""
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as fh:
+            fh.write(content)
+        return path
+
+    def assert_info(self, info, path, content):
+        """The info is the one of the content."""
+        hasher = SHA1ContentHash()
+        hasher.update(content)
+        magic_hasher = MagicContentHash()
+        magic_hasher.update(content)
+        self.assertEqual(info.path, path)
+        self.assertEqual(info.hash, hasher.content_hash())
+        self.assertEqual(
+            info.magic_hash._magic_hash,
+            magic_hasher.content_hash()._magic_hash,
+        )
+        self.assertEqual(info.crc32, crc32(content))
+        self.assertEqual(info.size, len(content))
+        self.assertEqual(info.deflated_size, len(zlib.compress(content)))
+
+    def test_empty(self):
+        """An empty file."""
+        path = self.make_file('empty', b'')
+        self.assert_info(hash_file(path), path, b'')
+
+    def test_several_blocks(self):
+        """A file read in several blocks."""
+        content = os.urandom(1000) + b'x' * 5000
+        path = self.make_file('file', content)
+        self.assert_info(hash_file(path, block_size=64), path, content)
+
+    def test_deflated(self):
+        """The compressed content is written if asked."""
+        content = b'foo bar baz ' * 1000
+        path = self.make_file('file', content)
+        deflated = BytesIO()
+        info = hash_file(path, deflated=deflated, block_size=100)
+        self.assertEqual(len(deflated.getvalue()), info.deflated_size)
+        self.assertEqual(zlib.decompress(deflated.getvalue()), content)
+
+    def test_hash_files(self):
+        """Many files are hashed, and given back in order."""
+        contents = [os.urandom(i * 100) for i in range(10)]
+        paths = [
+            self.make_file('file%d' % i, content)
+            for i, content in enumerate(contents)
+        ]
+        infos = hash_files(paths, workers=3, block_size=128)
+        self.assertEqual(len(infos), 10)
+        for info, path, content in zip(infos, paths, contents):
+            self.assert_info(info, path, content)
+
+    def test_crc32_file(self):
+        """The crc32 of a file is computed in parts."""
+        content = os.urandom(10000)
+        path = self.make_file('file', content)
+        for workers in (1, 3, 4):
+            self.assertEqual(
+                crc32_file(path, workers=workers, block_size=64),
+                crc32(content),
+            )
+
+    def test_crc32_file_small(self):
+        """Small and empty files are not split."""
+        for content in (b'', b'foo'):
+            path = self.make_file('file', content)
+            self.assertEqual(crc32_file(path, block_size=64), crc32(content))
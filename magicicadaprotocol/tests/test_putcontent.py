@@ -27,15 +27,57 @@
 
 """Tests for PutContent request."""
 
+import mmap
+import os
+import shutil
+import struct
+import tempfile
 import unittest
+import zlib
 
 from io import StringIO, BytesIO
+from unittest import mock
 
+from twisted.internet import defer, task
 from twisted.test.proto_helpers import StringTransport
 
-from magicicadaprotocol import protocol_pb2
-from magicicadaprotocol.client import PutContent, StorageClient
-from magicicadaprotocol.request import SIZE_FMT_SIZE
+from magicicadaprotocol import client, content_hash, protocol_pb2
+from magicicadaprotocol.client import (
+    SIZES_AT_END_CAP,
+    BytesMessageProducer,
+    DeflateBytesMessageProducer,
+    MappedBytesMessageProducer,
+    PutContent,
+    QuerySetCaps,
+    StorageClient,
+)
+from magicicadaprotocol.request import SIZE_FMT, SIZE_FMT_SIZE
+
+
+def parse_frames(data):
+    """Parse all the len+data frames in data."""
+    stream = BytesIO(data)
+    messages = []
+    size = stream.read(SIZE_FMT_SIZE)
+    while size:
+        message = protocol_pb2.Message()
+        message.ParseFromString(stream.read(struct.unpack(SIZE_FMT, size)[0]))
+        messages.append(message)
+        size = stream.read(SIZE_FMT_SIZE)
+    return messages
+
+
+def use_clock(test):
+    """Make the producers run with a task.Clock during test, return it."""
+    clock = task.Clock()
+    for name, value in [
+        ('callLater', clock.callLater),
+        ('clock', clock.seconds),
+    ]:
+        patcher = mock.patch.object(BytesMessageProducer, name, value)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+    return clock
 
 
 class TestOffset(unittest.TestCase):
@@ -43,6 +85,7 @@ class TestOffset(unittest.TestCase):
 
     def setUp(self):
         super(TestOffset, self).setUp()
+        self.clock = use_clock(self)
         transport = StringTransport()
         self.protocol = StorageClient()
         self.protocol.transport = transport
@@ -53,17 +96,24 @@ class TestOffset(unittest.TestCase):
         protocol.transport = StringTransport()
         protocol.max_payload_size = 20
 
-        fd = BytesIO(
-            b"Lorem ipsum dolor sit amet, consectetur adipiscing elit."
-        )
+        content = b"Lorem ipsum dolor sit amet, consectetur adipiscing elit."
+        fd = BytesIO(content)
         pc = PutContent(protocol, 'share', 'node', '', '', 0, 0, 0, fd)
         message = protocol_pb2.Message()
         message.type = protocol_pb2.Message.BEGIN_CONTENT
         message.begin_content.offset = offset = 23
         pc.start()
+        protocol.transport.clear()
         pc.processMessage(message)
+        self.clock.advance(0)
 
-        self.assertEqual(fd.tell(), offset + protocol.max_payload_size)
+        payloads = [
+            m.bytes.bytes
+            for m in parse_frames(protocol.transport.value())
+            if m.type == protocol_pb2.Message.BYTES
+        ]
+        self.assertEqual(b"".join(payloads), content[offset:])
+        self.assertEqual(len(payloads[0]), protocol.max_payload_size)
 
     def test_offset_none(self):
         """On BEGIN_CONTENT, the file is seek'ed to 0 pos when no offset."""
@@ -212,3 +262,310 @@ class TestUploadId(unittest.TestCase):
         data = self.protocol.transport.value()
         pc_msg.ParseFromString(data[SIZE_FMT_SIZE:])
         self.assertEqual(pc_msg.put_content.magic_hash, '')
+
+
+class TestMappedSource(unittest.TestCase):
+    """Tests for uploading from a memory mapping."""
+
+    content = b"Lorem ipsum dolor sit amet, consectetur adipiscing elit."
+
+    def setUp(self):
+        super(TestMappedSource, self).setUp()
+        self.clock = use_clock(self)
+        self.protocol = StorageClient()
+        self.protocol.transport = StringTransport()
+        self.protocol.max_payload_size = 20
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'content')
+        with open(self.path, 'wb') as fh:
+            fh.write(self.content)
+
+    def begin(self, source, offset=0):
+        """Start a PutContent from source, and begin the upload."""
+        pc = PutContent(
+            self.protocol, 'share', 'node', '', '', 0, 0, 0, source
+        )
+        pc.start()
+        self.protocol.transport.clear()
+        message = protocol_pb2.Message()
+        message.type = protocol_pb2.Message.BEGIN_CONTENT
+        message.begin_content.offset = offset
+        pc.processMessage(message)
+        self.clock.advance(0)
+        return pc
+
+    def sent_payloads(self):
+        """Return the payloads of the BYTES messages sent."""
+        return [
+            m.bytes.bytes
+            for m in parse_frames(self.protocol.transport.value())
+            if m.type == protocol_pb2.Message.BYTES
+        ]
+
+    def test_path(self):
+        """Upload the content of a path."""
+        pc = self.begin(self.path)
+        self.assertIsInstance(pc.producer, MappedBytesMessageProducer)
+        payloads = self.sent_payloads()
+        self.assertEqual(b"".join(payloads), self.content)
+        self.assertEqual([len(p) for p in payloads], [20, 20, 16])
+
+    def test_path_offset(self):
+        """Upload the content of a path from the offset."""
+        self.begin(self.path, offset=23)
+        self.assertEqual(b"".join(self.sent_payloads()), self.content[23:])
+
+    def test_path_unmapped_on_eof(self):
+        """The mapping is closed after EOF."""
+        pc = self.begin(self.path)
+        self.assertTrue(pc.producer.finished)
+        self.assertIsNone(pc.producer.mapping)
+        self.assertIsNone(pc.producer.view)
+
+    def test_empty_path(self):
+        """An empty file is uploaded even if it can't be mapped."""
+        open(self.path, 'wb').close()
+        self.begin(self.path)
+        self.assertEqual(self.sent_payloads(), [])
+        last = parse_frames(self.protocol.transport.value())[-1]
+        self.assertEqual(last.type, protocol_pb2.Message.EOF)
+
+    def test_mmap(self):
+        """Upload the content of a mapping, which is left open."""
+        with open(self.path, 'rb') as fh:
+            mapping = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.addCleanup(mapping.close)
+        self.begin(mapping, offset=5)
+        self.assertEqual(b"".join(self.sent_payloads()), self.content[5:])
+        self.assertFalse(mapping.closed)
+        # the view was released, so the mapping can be closed
+        mapping.close()
+
+    def test_cancel_releases(self):
+        """Cancelling the upload releases the mapping."""
+        pc = PutContent(
+            self.protocol, 'share', 'node', '', '', 0, 0, 0, self.path
+        )
+        pc.start()
+        pc.registerProducer(
+            MappedBytesMessageProducer(pc, self.path, 0), streaming=True
+        )
+        pc.producer.resumeProducing = lambda: None
+        pc.producer._position()
+        self.assertIsNotNone(pc.producer.mapping)
+        pc.cancel()
+        self.assertIsNone(pc.producer.mapping)
+        self.assertEqual(pc.producer.read(10), b"")
+
+
+class TestDeflate(unittest.TestCase):
+    """Tests for compressing the content while uploading it."""
+
+    content = os.urandom(1000) + b"compressible " * 10000
+
+    def setUp(self):
+        super(TestDeflate, self).setUp()
+        self.clock = use_clock(self)
+        self.protocol = StorageClient()
+        self.protocol.transport = StringTransport()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'content')
+        with open(self.path, 'wb') as fh:
+            fh.write(self.content)
+        self.info = content_hash.hash_file(self.path)
+
+    def begin(self, sizes_at_end=False, offset=0, source=None):
+        """Start a deflating PutContent, and begin the upload."""
+        if source is None:
+            source = open(self.path, 'rb')
+            self.addCleanup(source.close)
+        if sizes_at_end:
+            self.protocol.sizes_at_end = True
+            args = (None, None, None, None)
+        else:
+            info = self.info
+            args = (info.hash, info.crc32, info.size, info.deflated_size)
+        pc = PutContent(
+            self.protocol, 'share', 'node', '', *args, source, deflate=True
+        )
+        pc.start()
+        self.put_content = parse_frames(self.protocol.transport.value())[0]
+        self.protocol.transport.clear()
+        message = protocol_pb2.Message()
+        message.type = protocol_pb2.Message.BEGIN_CONTENT
+        message.begin_content.offset = offset
+        pc.processMessage(message)
+        self.clock.advance(0)
+        return pc
+
+    def sent(self):
+        """Return the compressed content sent, and the EOF message."""
+        messages = parse_frames(self.protocol.transport.value())
+        deflated = b"".join(
+            m.bytes.bytes
+            for m in messages
+            if m.type == protocol_pb2.Message.BYTES
+        )
+        self.assertEqual(messages[-1].type, protocol_pb2.Message.EOF)
+        return deflated, messages[-1]
+
+    def test_compressed(self):
+        """The content is sent compressed."""
+        pc = self.begin()
+        self.assertIsInstance(pc.producer, DeflateBytesMessageProducer)
+        deflated, eof = self.sent()
+        self.assertEqual(zlib.decompress(deflated), self.content)
+        self.assertEqual(len(deflated), self.info.deflated_size)
+        self.assertFalse(eof.HasField('put_content'))
+
+    def test_path_source(self):
+        """The content can be compressed from a path."""
+        pc = self.begin(source=self.path)
+        self.assertIsInstance(pc.producer.raw, MappedBytesMessageProducer)
+        deflated, _ = self.sent()
+        self.assertEqual(zlib.decompress(deflated), self.content)
+        self.assertEqual(pc.hash, self.info.hash)
+        # the mapping is released
+        self.assertIsNone(pc.producer.raw.view)
+
+    def test_mmap_source(self):
+        """The content can be compressed from a mmap, left open."""
+        with open(self.path, 'rb') as fh:
+            mapping = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.addCleanup(mapping.close)
+        self.begin(offset=100, source=mapping)
+        deflated, _ = self.sent()
+        self.assertEqual(deflated, zlib.compress(self.content)[100:])
+        self.assertFalse(mapping.closed)
+
+    def test_values_computed(self):
+        """The hashes and sizes are set in the request when done."""
+        pc = self.begin()
+        self.sent()
+        self.assertEqual(pc.hash, self.info.hash)
+        self.assertEqual(pc.magic_hash, self.info.magic_hash._magic_hash)
+        self.assertEqual(pc.crc32, self.info.crc32)
+        self.assertEqual(pc.size, len(self.content))
+        self.assertEqual(pc.deflated_size, self.info.deflated_size)
+
+    def test_offset(self):
+        """The offset skips compressed content."""
+        self.begin(offset=100)
+        deflated, _ = self.sent()
+        full = zlib.compress(self.content)
+        self.assertEqual(deflated, full[100:])
+
+    def test_sizes_at_end(self):
+        """Without the values, they are sent in the EOF message."""
+        pc = self.begin(sizes_at_end=True)
+        self.assertTrue(pc.sizes_at_end)
+        self.assertFalse(self.put_content.put_content.HasField('hash'))
+        self.assertFalse(self.put_content.put_content.HasField('size'))
+        deflated, eof = self.sent()
+        self.assertEqual(zlib.decompress(deflated), self.content)
+        self.assertEqual(eof.put_content.hash, self.info.hash)
+        self.assertEqual(
+            eof.put_content.magic_hash, self.info.magic_hash._magic_hash
+        )
+        self.assertEqual(eof.put_content.crc32, self.info.crc32)
+        self.assertEqual(eof.put_content.size, len(self.content))
+        self.assertEqual(
+            eof.put_content.deflated_size, self.info.deflated_size
+        )
+
+    def test_upload_file_sizes_at_end(self):
+        """upload_file sends the file in one pass if the server allows."""
+        self.protocol.sizes_at_end = True
+        self.protocol.upload_file('share', 'node', '', self.path)
+        put_content = parse_frames(self.protocol.transport.value())[0]
+        self.assertEqual(put_content.type, protocol_pb2.Message.PUT_CONTENT)
+        self.assertFalse(put_content.put_content.HasField('hash'))
+        (pc,) = self.protocol.requests.values()
+        self.assertTrue(pc.deflate)
+        self.assertTrue(pc.sizes_at_end)
+
+    def test_sizes_at_end_not_accepted(self):
+        """The values can't be left out if the server didn't accept it."""
+        self.assertRaises(
+            ValueError,
+            PutContent,
+            self.protocol,
+            'share',
+            'node',
+            '',
+            None,
+            None,
+            None,
+            None,
+            BytesIO(),
+            deflate=True,
+        )
+
+    def accept_caps(self, caps, set_mode=True):
+        """Ask the server for caps, and accept them."""
+        req = QuerySetCaps(self.protocol, caps, set_mode=set_mode)
+        req.start()
+        message = protocol_pb2.Message()
+        message.type = protocol_pb2.Message.ACCEPT_CAPS
+        message.accept_caps.accepted = True
+        req.processMessage(message)
+
+    def test_caps_negotiation(self):
+        """The sizes go at the end once set_caps succeeds with the cap."""
+        self.accept_caps([SIZES_AT_END_CAP], set_mode=False)
+        self.assertFalse(self.protocol.sizes_at_end)
+        self.accept_caps(['other', SIZES_AT_END_CAP])
+        self.assertTrue(self.protocol.sizes_at_end)
+        self.accept_caps(['other'])
+        self.assertFalse(self.protocol.sizes_at_end)
+
+    def test_upload_file_hashed_first(self):
+        """upload_file hashes the file first if the server needs it."""
+        with mock.patch.object(
+            client.threads, 'deferToThread', defer.maybeDeferred
+        ):
+            d = self.protocol.upload_file('share', 'node', '', self.path)
+        put_content = parse_frames(self.protocol.transport.value())[0]
+        self.assertEqual(put_content.put_content.hash, self.info.hash)
+        self.assertEqual(
+            put_content.put_content.magic_hash,
+            self.info.magic_hash._magic_hash,
+        )
+        self.assertEqual(put_content.put_content.crc32, self.info.crc32)
+        self.assertEqual(put_content.put_content.size, self.info.size)
+        self.assertEqual(
+            put_content.put_content.deflated_size, self.info.deflated_size
+        )
+        (pc,) = self.protocol.requests.values()
+        self.assertTrue(pc.deflate)
+        self.assertFalse(pc.sizes_at_end)
+
+        message = protocol_pb2.Message()
+        message.type = protocol_pb2.Message.OK
+        pc.processMessage(message)
+        results = []
+        d.addCallback(results.append)
+        self.assertEqual(results, [pc])
+        self.assertTrue(pc.fd.closed)
+
+    def test_upload_file_closed_on_error(self):
+        """The file is closed if the upload can't be started."""
+        opened = []
+
+        def fake_open(*args):
+            opened.append(open(*args))
+            return opened[-1]
+
+        self.protocol.sizes_at_end = True
+        with mock.patch.object(
+            client, 'open', fake_open, create=True
+        ), mock.patch.object(
+            self.protocol, 'put_content_request', side_effect=ValueError
+        ):
+            d = self.protocol.upload_file('share', 'node', '', self.path)
+        failures = []
+        d.addErrback(failures.append)
+        self.assertTrue(failures[0].check(ValueError))
+        self.assertTrue(opened[0].closed)
@@ -30,7 +30,8 @@
 import os
 import unittest
 
-from magicicadaprotocol.client import MultiQuery
+from magicicadaprotocol import protocol_pb2, request
+from magicicadaprotocol.client import MultiQuery, Query, query_item_size
 
 
 class TestQuery10(unittest.TestCase):
@@ -57,3 +58,75 @@ class TestQuery1000(TestQuery10):
     """Check with even more queries."""
 
     N = 1000
+
+
+class TestQueryItemSize(unittest.TestCase):
+    """Check the size accounting of the query items."""
+
+    def assert_size(self, share, node, a_hash):
+        """The item adds exactly its size to the message."""
+        message = protocol_pb2.Message()
+        message.id = 0
+        message.type = protocol_pb2.Message.QUERY
+        before = message.ByteSize()
+        qi = message.query.add()
+        qi.share = share
+        qi.node = str(node)
+        qi.hash = a_hash
+        self.assertEqual(
+            message.ByteSize() - before, query_item_size(share, node, a_hash)
+        )
+
+    def test_empty(self):
+        """Empty fields are still sent."""
+        self.assert_size('', '', '')
+
+    def test_small(self):
+        """Small item."""
+        self.assert_size('share', 'node', 'sha1:' + 'a' * 40)
+
+    def test_long_strings(self):
+        """Lengths that need bigger varints."""
+        self.assert_size('s' * 200, 'n' * 20000, 'h' * 127)
+
+    def test_non_ascii(self):
+        """The size is the one of the encoded strings."""
+        self.assert_size('ñandú', 'ñ' * 100, '')
+
+    def test_not_a_string_node(self):
+        """The node is sent as a string."""
+        self.assert_size('', 12345, '')
+
+
+class TestQuerySplit(unittest.TestCase):
+    """Check how the items are split in Query messages."""
+
+    def test_split(self):
+        """All the items are sent, in order, as packed as possible."""
+        items = [
+            ('share', 'node-%d' % i, 'sha1:%040d' % i) for i in range(5000)
+        ]
+        queries = MultiQuery(None, items).queries
+        self.assertTrue(len(queries) > 1)
+
+        sent = []
+        for query in queries:
+            message = query.query_message
+            self.assertTrue(message.ByteSize() <= request.MAX_MESSAGE_SIZE)
+            if query.overflow is not None:
+                # the next item would not have fit
+                self.assertTrue(
+                    message.ByteSize() + query_item_size(*query.overflow)
+                    > request.MAX_MESSAGE_SIZE
+                )
+            sent.extend((q.share, q.node, q.hash) for q in message.query)
+        self.assertEqual(sent, items)
+
+    def test_first(self):
+        """The pending overflow item goes before the rest of the items."""
+        items = iter([('share', 'node-1', ''), ('share', 'node-2', '')])
+        query = Query(None, items, first=('share', 'node-0', ''))
+        self.assertEqual(
+            [q.node for q in query.query_message.query],
+            ['node-0', 'node-1', 'node-2'],
+        )
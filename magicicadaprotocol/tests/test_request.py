@@ -27,14 +27,23 @@
 
 """Tests for directory content serialization/unserialization."""
 
+import struct
 import uuid
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
 from twisted.trial.unittest import TestCase as TwistedTestCase
 
-from magicicadaprotocol import errors, protocol_pb2
-from magicicadaprotocol.request import RequestHandler, Request, RequestResponse
+from magicicadaprotocol import errors, protocol_pb2, validators
+from magicicadaprotocol.request import (
+    MAX_MESSAGE_SIZE,
+    SIZE_FMT,
+    SIZE_FMT_SIZE,
+    RequestHandler,
+    Request,
+    RequestResponse,
+)
 
 
 class MindlessRequest(Request):
@@ -194,3 +203,432 @@ class TestRequestResponse(TestRequest):
             protocol=protocol, message=message
         )
         self.request.protocol.requests[message.id] = self.request
+
+
+class RecordingRequestHandler(RequestHandler):
+    """A RequestHandler that records the messages it receives."""
+
+    def __init__(self):
+        RequestHandler.__init__(self)
+        self.received = []
+
+    def processMessage(self, message):
+        """Keep track of messages."""
+        self.received.append(message)
+
+
+def build_frame(message_id):
+    """Build a len+data frame for a NOOP message with the given id."""
+    message = protocol_pb2.Message()
+    message.id = message_id
+    message.type = protocol_pb2.Message.NOOP
+    data = message.SerializeToString()
+    return struct.pack(SIZE_FMT, len(data)) + data
+
+
+class TestBuildMessage(TwistedTestCase):
+    """Tests for the frame decoding in RequestHandler."""
+
+    def setUp(self):
+        self.handler = RecordingRequestHandler()
+        self.handler.makeConnection(StringTransport())
+
+    def received_ids(self):
+        return [m.id for m in self.handler.received]
+
+    def test_many_frames_in_one_read(self):
+        """All the frames in a single read are decoded, in order."""
+        self.handler.dataReceived(b"".join(build_frame(i) for i in range(50)))
+        self.assertEqual(self.received_ids(), list(range(50)))
+        self.assertEqual(self.handler.pending_data, b"")
+
+    def test_frames_split_byte_by_byte(self):
+        """Frames arriving one byte at a time are decoded when complete."""
+        data = build_frame(1) + build_frame(2)
+        for byte in data:
+            self.handler.dataReceived(bytes([byte]))
+        self.assertEqual(self.received_ids(), [1, 2])
+        self.assertEqual(self.handler.pending_data, b"")
+
+    def test_frame_split_across_reads(self):
+        """A partial trailing frame waits for the rest of its data."""
+        first, second = build_frame(1), build_frame(2)
+        self.handler.dataReceived(first + second[:-2])
+        self.assertEqual(self.received_ids(), [1])
+        # the size was consumed, only the partial body is kept
+        self.assertEqual(self.handler.pending_data, second[SIZE_FMT_SIZE:-2])
+        self.handler.dataReceived(second[-2:])
+        self.assertEqual(self.received_ids(), [1, 2])
+
+    def test_empty_message(self):
+        """A zero length frame is an empty message."""
+        self.handler.dataReceived(struct.pack(SIZE_FMT, 0) + build_frame(3))
+        self.assertEqual(self.received_ids(), [0, 3])
+
+    def test_message_too_big(self):
+        """A frame bigger than MAX_MESSAGE_SIZE drops the connection."""
+        self.handler.dataReceived(struct.pack(SIZE_FMT, MAX_MESSAGE_SIZE + 1))
+        self.assertTrue(self.handler.transport.disconnecting)
+        self.assertEqual(self.received_ids(), [])
+
+
+class BatchingRequestHandler(RecordingRequestHandler):
+    """A RecordingRequestHandler that receives messages in batches."""
+
+    BATCH_MESSAGES = True
+
+    def __init__(self):
+        RecordingRequestHandler.__init__(self)
+        self.batches = []
+
+    def processMessages(self, messages):
+        """Keep track of batches."""
+        self.batches.append([m.id for m in messages])
+        RecordingRequestHandler.processMessages(self, messages)
+
+
+class BatchingRequest(MindlessRequest):
+    """A request that records the batches it receives."""
+
+    def __init__(self, protocol):
+        MindlessRequest.__init__(self, protocol)
+        self.batches = []
+
+    def processMessages(self, messages):
+        """Keep track of batches."""
+        self.batches.append([m.id for m in messages])
+
+
+class FailingRequest(MindlessRequest):
+    """A request that fails with the first message it processes."""
+
+    def __init__(self, protocol):
+        MindlessRequest.__init__(self, protocol)
+        self.received = []
+
+    def processMessage(self, message):
+        """Keep track of messages, fail with the first one."""
+        self.received.append(message)
+        if len(self.received) == 1:
+            raise ValueError("failed")
+
+
+class TestBatchMessages(TwistedTestCase):
+    """Tests for the batched message dispatch."""
+
+    def setUp(self):
+        self.handler = BatchingRequestHandler()
+        self.handler.makeConnection(StringTransport())
+
+    def test_one_batch_per_read(self):
+        """All the messages from a read are dispatched together."""
+        self.handler.dataReceived(b"".join(build_frame(i) for i in range(5)))
+        self.handler.dataReceived(build_frame(5) + build_frame(6)[:-1])
+        self.assertEqual(self.handler.batches, [[0, 1, 2, 3, 4], [5]])
+        self.assertEqual([m.id for m in self.handler.received], list(range(6)))
+
+    def test_no_batch_for_partial_frame(self):
+        """Nothing is dispatched if no frame is complete."""
+        self.handler.dataReceived(build_frame(1)[:-1])
+        self.assertEqual(self.handler.batches, [])
+
+    def test_requests_get_their_messages_together(self):
+        """Consecutive messages for a request are handed over at once."""
+        handler = RequestHandler()
+        handler.makeConnection(ConnectionLike())
+        req = BatchingRequest(handler)
+        req.start()
+        other = BatchingRequest(handler)
+        other.start()
+
+        messages = []
+        for request_id in [req.id, req.id, other.id, req.id]:
+            message = protocol_pb2.Message()
+            message.id = request_id
+            message.type = protocol_pb2.Message.BYTES
+            messages.append(message)
+        handler.processMessages(messages)
+
+        self.assertEqual(req.batches, [[req.id, req.id], [req.id]])
+        self.assertEqual(other.batches, [[other.id]])
+
+    def test_message_too_big_after_frames(self):
+        """The frames before a too big one are dispatched."""
+        self.handler.dataReceived(
+            build_frame(1)
+            + build_frame(2)
+            + struct.pack(SIZE_FMT, MAX_MESSAGE_SIZE + 1)
+        )
+        self.assertTrue(self.handler.transport.disconnecting)
+        self.assertEqual(self.handler.batches, [[1, 2]])
+        self.assertEqual([m.id for m in self.handler.received], [1, 2])
+
+    def test_request_failing_in_batch(self):
+        """A request failing with a message is errored as one by one."""
+        handler = RequestHandler()
+        handler.makeConnection(ConnectionLike())
+        req = FailingRequest(handler)
+        req.start()
+        other = BatchingRequest(handler)
+        other.start()
+
+        messages = []
+        for request_id in [req.id, req.id, other.id]:
+            message = protocol_pb2.Message()
+            message.id = request_id
+            message.type = protocol_pb2.Message.NOOP
+            messages.append(message)
+        handler.processMessages(messages)
+
+        # the second message is not for an active request anymore
+        self.assertEqual(req.received, messages[:1])
+        self.assertEqual(other.batches, [[other.id]])
+        return self.assertFailure(req.deferred, ValueError)
+
+    def test_default_request_batch(self):
+        """By default a request processes the batch message by message."""
+        received = []
+        self.patch(MindlessRequest, 'processMessage', received.append)
+        req = MindlessRequest(self.handler)
+        messages = [protocol_pb2.Message(), protocol_pb2.Message()]
+        req.processMessages(messages)
+        self.assertEqual(received, messages)
+
+
+class RecordingTransport(StringTransport):
+    """A StringTransport that records every write call."""
+
+    def __init__(self):
+        StringTransport.__init__(self)
+        self.calls = []
+
+    def write(self, data):
+        self.calls.append('write')
+        StringTransport.write(self, data)
+
+    def writeSequence(self, seq):
+        self.calls.append('writeSequence')
+        StringTransport.writeSequence(self, seq)
+
+
+class TestSendMessage(TwistedTestCase):
+    """Tests for the outgoing frames."""
+
+    def setUp(self):
+        self.transport = RecordingTransport()
+        self.handler = RequestHandler()
+        self.handler.makeConnection(self.transport)
+        self.clock = task.Clock()
+        self.patch(self.handler, 'callLater', self.clock.callLater)
+
+    def send(self, *ids):
+        for message_id in ids:
+            message = protocol_pb2.Message()
+            message.id = message_id
+            message.type = protocol_pb2.Message.NOOP
+            self.handler.sendMessage(message)
+
+    def test_single_write(self):
+        """Size and body are written in a single call."""
+        self.send(1)
+        self.assertEqual(self.transport.calls, ['write'])
+        self.assertEqual(self.transport.value(), build_frame(1))
+
+    def test_buffered_until_end_of_turn(self):
+        """Frames are written together at the end of the reactor turn."""
+        self.handler.WRITE_HIGH_WATER_MARK = 1024
+        self.send(1, 2, 3)
+        self.assertEqual(self.transport.calls, [])
+
+        self.clock.advance(0)
+        self.assertEqual(self.transport.calls, ['writeSequence'])
+        expected = build_frame(1) + build_frame(2) + build_frame(3)
+        self.assertEqual(self.transport.value(), expected)
+
+    def test_high_water_mark(self):
+        """Frames are flushed as soon as the high water mark is reached."""
+        self.handler.WRITE_HIGH_WATER_MARK = len(build_frame(1)) * 2
+        self.send(1, 2, 3)
+        self.assertEqual(self.transport.calls, ['writeSequence'])
+        expected = build_frame(1) + build_frame(2)
+        self.assertEqual(self.transport.value(), expected)
+
+        self.clock.advance(0)
+        self.assertEqual(self.transport.calls, ['writeSequence'] * 2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_connection_lost_drops_frames(self):
+        """Buffered frames are dropped when the connection is lost."""
+        self.handler.WRITE_HIGH_WATER_MARK = 1024
+        self.send(1)
+        self.handler.connectionLost(Failure(RuntimeError()))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.handler.outgoing_frames, [])
+
+
+class TestMessageValidation(TwistedTestCase):
+    """Tests for the validation of incoming messages."""
+
+    def setUp(self):
+        self.handler = RequestHandler()
+        self.validated = []
+        self.validate_message = validators.validate_message
+        self.patch(
+            validators,
+            'validate_message',
+            lambda message: self.validated.append(message.type) or [],
+        )
+
+    def build_message(self, message_type):
+        message = protocol_pb2.Message()
+        message.type = message_type
+        return message
+
+    def test_bulk_types_not_validated(self):
+        """BYTES, EOF, NOOP and PONG skip the validation."""
+        for message_type in RequestHandler.UNVALIDATED_MESSAGE_TYPES:
+            message = self.build_message(message_type)
+            self.assertEqual(self.handler.validate_message(message), [])
+        self.assertEqual(self.validated, [])
+
+    def test_eof_with_put_content_validated(self):
+        """An EOF with the sizes and hashes at the end is validated."""
+        message = self.build_message(protocol_pb2.Message.EOF)
+        message.put_content.hash = 'bogus'
+        self.handler.validate_message(message)
+        self.assertEqual(self.validated, [protocol_pb2.Message.EOF])
+
+    def test_eof_with_bad_hash_rejected(self):
+        """An EOF with a bogus put_content hash does not validate."""
+        self.patch(validators, 'validate_message', self.validate_message)
+        message = self.build_message(protocol_pb2.Message.EOF)
+        message.id = 1
+        message.put_content.hash = 'bogus'
+        self.assertNotEqual(self.handler.validate_message(message), [])
+
+    def test_other_types_validated(self):
+        """Everything else is validated."""
+        message = self.build_message(protocol_pb2.Message.NODE_STATE)
+        self.handler.validate_message(message)
+        self.assertEqual(self.validated, [protocol_pb2.Message.NODE_STATE])
+
+    def test_set_message_validation(self):
+        """The policy can be changed per type."""
+        self.handler.set_message_validation(protocol_pb2.Message.BYTES, True)
+        self.handler.set_message_validation(protocol_pb2.Message.OK, False)
+        self.handler.validate_message(
+            self.build_message(protocol_pb2.Message.BYTES)
+        )
+        self.handler.validate_message(
+            self.build_message(protocol_pb2.Message.OK)
+        )
+        self.assertEqual(self.validated, [protocol_pb2.Message.BYTES])
+        # the class default is untouched
+        self.assertIn(
+            protocol_pb2.Message.BYTES,
+            RequestHandler.UNVALIDATED_MESSAGE_TYPES,
+        )
+
+    def test_process_message_skips_validation(self):
+        """processMessage does not validate the bulk types."""
+        req = MindlessRequest(self.handler)
+        self.handler.makeConnection(ConnectionLike())
+        req.start()
+        message = self.build_message(protocol_pb2.Message.BYTES)
+        message.id = req.id
+        self.handler.processMessage(message)
+        self.assertEqual(self.validated, [])
+
+
+class TestDispatch(TwistedTestCase):
+    """Tests for the dispatch of new messages to the handlers."""
+
+    def setUp(self):
+        self.handler = RequestHandler()
+        self.handler.makeConnection(StringTransport())
+
+    def build_message(self, message_type):
+        message = protocol_pb2.Message()
+        message.id = 7
+        message.type = message_type
+        return message
+
+    def test_handlers_from_methods(self):
+        """The table maps message types to the handle_* methods."""
+        handlers = self.handler.get_handlers()
+        self.assertEqual(
+            handlers[protocol_pb2.Message.PING], self.handler.handle_PING
+        )
+        self.assertEqual(
+            handlers[protocol_pb2.Message.NOOP], self.handler.handle_NOOP
+        )
+        self.assertNotIn(protocol_pb2.Message.BYTES, handlers)
+        self.assertIs(self.handler.get_handlers(), handlers)
+
+    def test_dispatch(self):
+        """New messages go to their handler."""
+        self.handler.processMessage(
+            self.build_message(protocol_pb2.Message.PING)
+        )
+        response = protocol_pb2.Message()
+        response.ParseFromString(
+            self.handler.transport.value()[SIZE_FMT_SIZE:]
+        )
+        self.assertEqual(response.type, protocol_pb2.Message.PONG)
+        self.assertEqual(response.id, 7)
+
+    def test_register_handler(self):
+        """Handlers can be registered by message type."""
+        called = []
+        self.handler.register_handler(
+            protocol_pb2.Message.NODE_STATE, called.append
+        )
+        message = self.build_message(protocol_pb2.Message.NODE_STATE)
+        self.handler.processMessage(message)
+        self.assertEqual(called, [message])
+
+    def test_handler_names_per_class(self):
+        """The handle_* methods are looked up once per class."""
+        names = RequestHandler.get_handler_names()
+        self.assertEqual(names[protocol_pb2.Message.PING], 'handle_PING')
+        self.assertIs(RequestHandler().get_handler_names(), names)
+
+        class Handler(RequestHandler):
+            def handle_OK(self, message):
+                """Handle OK."""
+
+        self.assertIn(protocol_pb2.Message.OK, Handler.get_handler_names())
+        self.assertNotIn(protocol_pb2.Message.OK, names)
+
+    def test_invalidate_handlers(self):
+        """New handle_* methods are found after invalidating the table."""
+        called = []
+
+        class Handler(RequestHandler):
+            """A handler that gets a new method."""
+
+        handler = Handler()
+        handler.makeConnection(StringTransport())
+        handler.get_handlers()
+        Handler.handle_OK = lambda self, message: called.append(message)
+        handler.invalidate_handlers()
+        message = self.build_message(protocol_pb2.Message.OK)
+        handler.processMessage(message)
+        self.assertEqual(called, [message])
+
+    def test_invalidate_keeps_registered(self):
+        """The registered handlers survive invalidating the table."""
+        called = []
+        self.handler.register_handler(
+            protocol_pb2.Message.NODE_STATE, called.append
+        )
+        self.handler.invalidate_handlers()
+        message = self.build_message(protocol_pb2.Message.NODE_STATE)
+        self.handler.processMessage(message)
+        self.assertEqual(called, [message])
+
+    def test_no_handler(self):
+        """Messages without handler can not be processed."""
+        message = self.build_message(protocol_pb2.Message.OK)
+        e = self.assertRaises(Exception, self.handler.processMessage, message)
+        self.assertIn("peer cant handle message 'OK'", str(e))
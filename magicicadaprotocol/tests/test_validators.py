@@ -0,0 +1,119 @@
+# Copyright 2015-2022 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the
+# OpenSSL library under certain conditions as described in each
+# individual source file, and distribute linked combinations
+# including the two.
+# You must obey the GNU General Public License in all respects
+# for all of the code used other than OpenSSL.  If you modify
+# file(s) with this exception, you may extend this exception to your
+# version of the file(s), but you are not obligated to do so.  If you
+# do not wish to do so, delete this exception statement from your
+# version.  If you delete this exception statement from all source
+# files in the program, then also delete it here.
+
+"""Tests for message validation."""
+
+import unittest
+import uuid
+
+from magicicadaprotocol import protocol_pb2, request, validators
+
+NODE = str(uuid.uuid4())
+HASH = 'sha1:' + '0' * 40
+
+
+class ValidatorsTestCase(unittest.TestCase):
+    """Tests for the field validators."""
+
+    def test_is_valid_node(self):
+        self.assertTrue(validators.is_valid_node(NODE))
+        self.assertFalse(validators.is_valid_node(NODE.upper()))
+        self.assertFalse(validators.is_valid_node('foo'))
+
+    def test_is_valid_share(self):
+        self.assertTrue(validators.is_valid_share(request.ROOT))
+        self.assertTrue(validators.is_valid_share(NODE))
+        self.assertFalse(validators.is_valid_share('foo'))
+
+    def test_is_valid_hash(self):
+        self.assertTrue(validators.is_valid_hash(''))
+        self.assertTrue(validators.is_valid_hash(request.UNKNOWN_HASH))
+        self.assertTrue(validators.is_valid_hash(HASH))
+        self.assertFalse(validators.is_valid_hash('sha1:1234'))
+        self.assertFalse(validators.is_valid_hash(HASH + '0'))
+
+
+class ValidateMessageTestCase(unittest.TestCase):
+    """Tests for validate_message."""
+
+    def test_valid(self):
+        """A message with valid fields has no errors."""
+        message = protocol_pb2.Message()
+        message.type = protocol_pb2.Message.GET_CONTENT
+        message.get_content.share = request.ROOT
+        message.get_content.node = NODE
+        message.get_content.hash = HASH
+        self.assertEqual(validators.validate_message(message), [])
+
+    def test_invalid_fields(self):
+        """All the invalid fields are reported, in field order."""
+        message = protocol_pb2.Message()
+        message.type = protocol_pb2.Message.GET_CONTENT
+        message.get_content.share = 'bad share'
+        message.get_content.node = 'bad node'
+        message.get_content.hash = HASH
+        self.assertEqual(
+            validators.validate_message(message),
+            ["Invalid share: 'bad share'", "Invalid node: 'bad node'"],
+        )
+
+    def test_repeated_submessages(self):
+        """Every item of a repeated field is validated."""
+        message = protocol_pb2.Message()
+        message.type = protocol_pb2.Message.QUERY
+        for node in [NODE, 'bad1', NODE, 'bad2']:
+            item = message.query.add()
+            item.share = request.ROOT
+            item.node = node
+            item.hash = HASH
+        self.assertEqual(
+            validators.validate_message(message),
+            ["Invalid node: 'bad1'", "Invalid node: 'bad2'"],
+        )
+
+    def test_unset_fields_not_validated(self):
+        """Fields that are not set are not validated."""
+        message = protocol_pb2.Message()
+        message.type = protocol_pb2.Message.MAKE_FILE
+        message.make.name = 'foo'
+        self.assertEqual(validators.validate_message(message), [])
+
+    def test_plan_is_cached(self):
+        """The plan for a descriptor is built only once."""
+        descriptor = protocol_pb2.Message.DESCRIPTOR
+        plan = validators.get_validation_plan(descriptor)
+        self.assertIs(validators.get_validation_plan(descriptor), plan)
+
+    def test_plan_skips_fields_without_validation(self):
+        """Subtrees with nothing to validate are not in the plan."""
+        plan = validators.get_validation_plan(protocol_pb2.Message.DESCRIPTOR)
+        names = [name for name, _, _ in plan]
+        self.assertIn('get_content', names)
+        self.assertIn('query', names)
+        self.assertNotIn('bytes', names)
+        self.assertNotIn('protocol', names)
+        self.assertNotIn('type', names)
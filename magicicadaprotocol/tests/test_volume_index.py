@@ -0,0 +1,276 @@
+# Copyright 2015-2022 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the
+# OpenSSL library under certain conditions as described in each
+# individual source file, and distribute linked combinations
+# including the two.
+# You must obey the GNU General Public License in all respects
+# for all of the code used other than OpenSSL.  If you modify
+# file(s) with this exception, you may extend this exception to your
+# version of the file(s), but you are not obligated to do so.  If you
+# do not wish to do so, delete this exception statement from your
+# version.  If you delete this exception statement from all source
+# files in the program, then also delete it here.
+
+"""Tests for the local volume index."""
+
+import unittest
+
+from twisted.internet import defer
+
+from magicicadaprotocol import delta, request
+from magicicadaprotocol.tests.test_delta_info import get_message
+from magicicadaprotocol.volume_index import VolumeIndex, VolumeIndexUpdater
+
+
+def make_delta(node_id, parent_id, name, generation, is_live=True, **kw):
+    """Return a FileInfoDelta for a node."""
+    values = dict(
+        generation=generation,
+        is_live=is_live,
+        file_type=delta.DIRECTORY,
+        parent_id=parent_id,
+        share_id=request.ROOT,
+        node_id=node_id,
+        name=name,
+        is_public=False,
+        content_hash='',
+        crc32=0,
+        size=0,
+        last_modified=0,
+    )
+    values.update(kw)
+    return delta.FileInfoDelta(**values)
+
+
+class VolumeIndexTestCase(unittest.TestCase):
+    """Check how the deltas are applied to the index."""
+
+    def setUp(self):
+        self.index = VolumeIndex(request.ROOT)
+        self.index.apply_many(
+            [
+                make_delta('root', None, '', 1),
+                make_delta('docs', 'root', 'docs', 2),
+                make_delta('a', 'docs', 'a.txt', 3, file_type=delta.FILE),
+                make_delta('b', 'docs', 'b.txt', 4, file_type=delta.FILE),
+            ]
+        )
+
+    def names(self, infos):
+        """Return the sorted names of the deltas."""
+        return sorted(info.name for info in infos)
+
+    def test_empty(self):
+        """A new index has nothing."""
+        index = VolumeIndex(request.ROOT)
+        self.assertEqual(len(index), 0)
+        self.assertIsNone(index.generation)
+        self.assertIsNone(index.lookup('/docs'))
+
+    def test_generation(self):
+        """Applying deltas doesn't change the generation."""
+        self.assertIsNone(self.index.generation)
+
+    def test_lookup(self):
+        """Paths are looked up from the root."""
+        self.assertEqual(self.index.root_id, 'root')
+        self.assertEqual(self.index.lookup('/').node_id, 'root')
+        self.assertEqual(self.index.lookup('docs/a.txt').node_id, 'a')
+        self.assertEqual(self.index.lookup('/docs/b.txt/').node_id, 'b')
+        self.assertIsNone(self.index.lookup('/docs/c.txt'))
+        self.assertIsNone(self.index.lookup('/other/a.txt'))
+
+    def test_listdir(self):
+        """The children of a node are listed."""
+        self.assertEqual(
+            self.names(self.index.listdir('docs')), ['a.txt', 'b.txt']
+        )
+        self.assertEqual(self.index.listdir('a'), [])
+
+    def test_update_node(self):
+        """A newer delta replaces the node."""
+        self.index.apply(make_delta('a', 'docs', 'a.txt', 5, size=10))
+        self.assertEqual(self.index.get('a').size, 10)
+        self.assertEqual(len(self.index), 4)
+
+    def test_move(self):
+        """A node moved or renamed leaves its old place."""
+        self.index.apply(make_delta('a', 'root', 'moved.txt', 5))
+        self.assertIsNone(self.index.lookup('/docs/a.txt'))
+        self.assertEqual(self.index.lookup('/moved.txt').node_id, 'a')
+        self.assertEqual(self.names(self.index.listdir('docs')), ['b.txt'])
+
+    def test_old_delta_ignored(self):
+        """A delta older than the node in the index is ignored."""
+        self.index.apply(make_delta('a', 'root', 'moved.txt', 2))
+        self.assertEqual(self.index.lookup('/docs/a.txt').node_id, 'a')
+
+    def test_remove(self):
+        """A dead node is removed."""
+        self.index.apply(make_delta('a', 'docs', 'a.txt', 5, is_live=False))
+        self.assertIsNone(self.index.get('a'))
+        self.assertIsNone(self.index.lookup('/docs/a.txt'))
+
+    def test_remove_directory(self):
+        """A dead directory takes its children with it."""
+        self.index.apply(make_delta('docs', 'root', 'docs', 5, is_live=False))
+        self.assertEqual(list(self.index.nodes), ['root'])
+        self.assertEqual(self.index.listdir('root'), [])
+
+    def test_remove_unknown(self):
+        """A dead node not in the index is ignored."""
+        self.index.apply(make_delta('x', 'root', 'x', 5, is_live=False))
+        self.assertEqual(len(self.index), 4)
+
+    def test_lazy_deltas(self):
+        """Lazy deltas can be applied too."""
+        message = get_message()
+        message.delta_info.is_live = True
+        message.delta_info.file_info.parent = 'docs'
+        index = VolumeIndex(request.ROOT)
+        index.apply(delta.from_message(message, lazy=True))
+        self.assertEqual(index.listdir('docs')[0].name, 'filename')
+
+
+class FakeRequest:
+    """A finished GetDelta."""
+
+    def __init__(self, end_generation, full=True):
+        self.end_generation = end_generation
+        self.full = full
+
+
+class FakeClient:
+    """A client that records the deltas asked."""
+
+    def __init__(self):
+        self.deltas = []
+        self.volume_new_generation_callback = None
+
+    def get_delta(
+        self, share_id, from_generation=None, callback=None, from_scratch=False
+    ):
+        d = defer.Deferred()
+        self.deltas.append((share_id, from_generation, from_scratch, d))
+        return d
+
+    def set_volume_new_generation_callback(self, callback):
+        self.volume_new_generation_callback = callback
+
+
+class VolumeIndexUpdateTestCase(unittest.TestCase):
+    """Check how the index is updated from the server."""
+
+    def setUp(self):
+        self.client = FakeClient()
+        self.index = VolumeIndex(request.ROOT)
+
+    def successResultOf(self, d):
+        """Return the result of the fired deferred."""
+        results = []
+        d.addBoth(results.append)
+        self.assertEqual(len(results), 1)
+        return results[0]
+
+    def test_from_scratch(self):
+        """The first update is a full listing."""
+        d = self.index.update(self.client)
+        [(share_id, from_generation, from_scratch, d2)] = self.client.deltas
+        self.assertEqual(share_id, request.ROOT)
+        self.assertTrue(from_scratch)
+        d2.callback(FakeRequest(10))
+        self.assertIs(self.successResultOf(d), self.index)
+        self.assertEqual(self.index.generation, 10)
+
+    def test_from_scratch_interrupted(self):
+        """An unfinished full listing is started again from scratch."""
+        d = self.index.update(self.client)
+        self.index.apply(make_delta('root', None, '', 90))
+        self.client.deltas.pop()[-1].errback(Exception('connection lost'))
+        self.assertEqual(str(self.successResultOf(d).value), 'connection lost')
+        self.assertIsNone(self.index.generation)
+
+        self.index.update(self.client)
+        [(_, from_generation, from_scratch, _)] = self.client.deltas
+        self.assertIsNone(from_generation)
+        self.assertTrue(from_scratch)
+        self.assertEqual(len(self.index), 0)
+
+    def test_from_generation(self):
+        """Once at a generation, the update asks only from there."""
+        self.index.generation = 7
+        self.index.update(self.client)
+        [(_, from_generation, from_scratch, _)] = self.client.deltas
+        self.assertEqual(from_generation, 7)
+        self.assertFalse(from_scratch)
+
+    def test_not_full(self):
+        """A partial delta is followed by the rest."""
+        self.index.generation = 7
+        d = self.index.update(self.client)
+        self.client.deltas[0][-1].callback(FakeRequest(9, full=False))
+        self.assertEqual(self.client.deltas[1][1], 9)
+        self.client.deltas[1][-1].callback(FakeRequest(12))
+        self.assertIs(self.successResultOf(d), self.index)
+        self.assertEqual(self.index.generation, 12)
+
+
+class VolumeIndexUpdaterTestCase(unittest.TestCase):
+    """Check the updates driven by the new generations."""
+
+    def setUp(self):
+        self.client = FakeClient()
+        self.updater = VolumeIndexUpdater(self.client)
+        self.updater.add(request.ROOT)
+        self.client.deltas.pop()[-1].callback(FakeRequest(5))
+        self.index = self.updater.get(request.ROOT)
+
+    def test_registered(self):
+        """The updater listens to the new generations."""
+        self.assertEqual(
+            self.client.volume_new_generation_callback,
+            self.updater.new_generation,
+        )
+        self.assertEqual(self.index.generation, 5)
+
+    def test_new_generation(self):
+        """A newer generation gets the missing deltas."""
+        self.updater.new_generation(request.ROOT, 6)
+        [(_, from_generation, _, _)] = self.client.deltas
+        self.assertEqual(from_generation, 5)
+
+    def test_same_generation(self):
+        """A generation the index has already is ignored."""
+        self.updater.new_generation(request.ROOT, 5)
+        self.assertEqual(self.client.deltas, [])
+
+    def test_unknown_volume(self):
+        """Volumes not indexed are ignored."""
+        self.updater.new_generation('other', 6)
+        self.assertEqual(self.client.deltas, [])
+
+    def test_new_generation_while_updating(self):
+        """Newer generations while updating are got after it."""
+        self.updater.new_generation(request.ROOT, 6)
+        self.updater.new_generation(request.ROOT, 8)
+        self.assertEqual(len(self.client.deltas), 1)
+        self.client.deltas.pop()[-1].callback(FakeRequest(6))
+        [(_, from_generation, _, d)] = self.client.deltas
+        self.assertEqual(from_generation, 6)
+        d.callback(FakeRequest(8))
+        self.assertEqual(self.index.generation, 8)
+        self.assertEqual(self.updater.updating, {})
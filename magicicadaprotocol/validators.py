@@ -30,15 +30,11 @@
 import re
 from uuid import UUID
 
-from google.protobuf.message import Message as _PBMessage
-from google.protobuf.internal.containers import BaseContainer as _PBContainer
+SHA1_RE = re.compile(r'sha1:[0-9a-z]{40}$')
 
-try:
-    from google.protobuf.internal.cpp_message import RepeatedCompositeContainer
-except ImportError:
-    CONTAINER_CLASSES = _PBContainer
-else:
-    CONTAINER_CLASSES = (_PBContainer, RepeatedCompositeContainer)
+# the validation plans, by message descriptor
+_plans = {}
+_building = set()
 
 
 def is_valid_node(node_id):
@@ -71,7 +67,7 @@ def is_valid_sha1(sha1):
     A valid sha1 hash reads "sha1:", and then a 40 hex characters.
 
     """
-    return bool(re.match(r'sha1:[0-9a-z]{40}$', sha1))
+    return bool(SHA1_RE.match(sha1))
 
 
 def is_valid_hash(a_hash):
@@ -90,31 +86,70 @@ def is_valid_hash(a_hash):
     return is_valid
 
 
+def _is_repeated(field):
+    """Tell if the field descriptor is for a repeated field."""
+    try:
+        return field.is_repeated
+    except AttributeError:
+        # older protobufs only have the label
+        return field.label == field.LABEL_REPEATED
+
+
+def get_validation_plan(descriptor):
+    """Return the validation plan for messages of the given descriptor.
+
+    The plan is a list of (name, repeated, check) tuples, in field number
+    order, where check is either the validator for a plain field or the
+    plan for a sub-message. Fields with nothing to validate inside are
+    left out. Plans are built once and cached.
+    """
+    plan = _plans.get(descriptor)
+    if plan is not None:
+        return plan
+
+    # cache it before filling it, in case of recursive messages
+    _plans[descriptor] = plan = []
+    _building.add(descriptor)
+    fields = sorted(descriptor.fields, key=lambda field: field.number)
+    for field in fields:
+        if field.message_type is not None:
+            check = get_validation_plan(field.message_type)
+            if not check and field.message_type not in _building:
+                continue
+        else:
+            check = globals().get("is_valid_" + field.name)
+            if check is None:
+                continue
+        plan.append((field.name, _is_repeated(field), check))
+    _building.discard(descriptor)
+    return plan
+
+
+def _run_plan(plan, message, is_invalid):
+    """Validate the message following the plan."""
+    for name, repeated, check in plan:
+        if repeated:
+            values = getattr(message, name)
+        elif message.HasField(name):
+            values = (getattr(message, name),)
+        else:
+            continue
+
+        if isinstance(check, list):
+            for submsg in values:
+                _run_plan(check, submsg, is_invalid)
+        else:
+            for value in values:
+                if not check(value):
+                    is_invalid.append("Invalid %s: %r" % (name, value))
+
+
 def validate_message(message):
     """
     Recursively validate a message's fields
     """
     is_invalid = []
-    from magicicadaprotocol import validators  # this is us!
-
-    for descriptor, submsg in message.ListFields():
-        if isinstance(submsg, CONTAINER_CLASSES):
-            # containers are iterables that have messages in them
-            for i in submsg:
-                is_invalid.extend(validate_message(i))
-        elif isinstance(submsg, _PBMessage):
-            # a plain sub-message
-            is_invalid.extend(validate_message(submsg))
-        else:
-            # we got down to the actual fields! yay
-            validator = getattr(
-                validators, "is_valid_" + descriptor.name, None
-            )
-            if validator is not None:
-                if not validator(submsg):
-                    is_invalid.append(
-                        "Invalid %s: %r" % (descriptor.name, submsg)
-                    )
+    _run_plan(get_validation_plan(message.DESCRIPTOR), message, is_invalid)
     return is_invalid
 
 
@@ -0,0 +1,300 @@
+# Copyright 2015-2022 Chicharreros (https://launchpad.net/~chicharreros)
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranties of
+# MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the
+# OpenSSL library under certain conditions as described in each
+# individual source file, and distribute linked combinations
+# including the two.
+# You must obey the GNU General Public License in all respects
+# for all of the code used other than OpenSSL.  If you modify
+# file(s) with this exception, you may extend this exception to your
+# version of the file(s), but you are not obligated to do so.  If you
+# do not wish to do so, delete this exception statement from your
+# version.  If you delete this exception statement from all source
+# files in the program, then also delete it here.
+
+"""A local index of the nodes of volumes, kept up to date with deltas."""
+
+from twisted.internet import defer
+
+
+class VolumeIndex:
+    """Hold the live nodes of a volume, applying deltas incrementally.
+
+    The nodes are kept by node id, with the children of each directory by
+    name, so looking up a path or listing a directory doesn't need any
+    directory content.
+
+    If a DeltaCache is given, the index starts with the nodes and the
+    generation stored there, and keeps it up to date, so after a restart
+    only the generations since are asked for. The nodes are read from
+    the cache when asked for, and the nodes and children tables are only
+    built the first time a path is looked up, a directory listed or a
+    node removed. A cache with no generation stored didn't finish its
+    first listing, and is emptied.
+
+    @ivar generation: the generation of the volume the index is at, None
+        before the first delta
+    @ivar root_id: the id of the root node of the volume, if known
+    @ivar loaded: if the nodes and children tables are built
+    """
+
+    def __init__(self, volume_id, cache=None):
+        """Create an index for volume_id, with the cache if given."""
+        self.volume_id = volume_id
+        self.generation = None
+        self.root_id = None
+        self.nodes = {}
+        self.children = {}
+        self.cache = cache
+        self.loaded = True
+        if cache is not None:
+            if cache.generation is None:
+                cache.clear()
+            else:
+                self.generation = cache.generation
+                self.loaded = not len(cache)
+
+    def __len__(self):
+        if not self.loaded:
+            return len(self.cache)
+        return len(self.nodes)
+
+    def _load(self):
+        """Build the nodes and children tables from the cache."""
+        if self.loaded:
+            return
+        self.loaded = True
+        for info in self.cache:
+            self._insert(info)
+
+    def _unlink(self, info):
+        """Remove the node from its parent's children."""
+        siblings = self.children.get(info.parent_id)
+        if siblings is not None and siblings.get(info.name) == info.node_id:
+            del siblings[info.name]
+            if not siblings:
+                del self.children[info.parent_id]
+
+    def _remove(self, node_id):
+        """Remove the node, and everything under it."""
+        pending = [node_id]
+        while pending:
+            node_id = pending.pop()
+            info = self.nodes.pop(node_id, None)
+            if info is None:
+                continue
+            if self.cache is not None:
+                self.cache.discard(node_id)
+            self._unlink(info)
+            pending.extend(self.children.pop(node_id, {}).values())
+            if node_id == self.root_id:
+                self.root_id = None
+
+    def _clear(self):
+        """Remove all the nodes."""
+        if self.cache is not None:
+            self.cache.clear()
+        self.nodes = {}
+        self.children = {}
+        self.root_id = None
+        self.loaded = True
+
+    def _insert(self, info):
+        """Put the live node in the tables."""
+        self.nodes[info.node_id] = info
+        if info.parent_id is None:
+            self.root_id = info.node_id
+        else:
+            siblings = self.children.setdefault(info.parent_id, {})
+            siblings[info.name] = info.node_id
+
+    def apply(self, info):
+        """Apply a FileInfoDelta to the index.
+
+        Deltas older than what the index has for the node are ignored.
+        The generation of the index is not changed, that's done when the
+        whole delta was applied.
+
+        """
+        if not self.loaded:
+            if info.is_live:
+                # keep it only in the cache, until the tables are built
+                old = self.cache.get(info.node_id)
+                if old is None or old.generation <= info.generation:
+                    self.cache.add(info)
+                return
+            self._load()
+
+        old = self.nodes.get(info.node_id)
+        if old is not None:
+            if old.generation > info.generation:
+                return
+            if not info.is_live:
+                self._remove(info.node_id)
+                return
+            if old.parent_id != info.parent_id or old.name != info.name:
+                self._unlink(old)
+        elif not info.is_live:
+            return
+
+        self._insert(info)
+        if self.cache is not None:
+            self.cache.add(info)
+
+    def apply_many(self, infos):
+        """Apply all the deltas in infos."""
+        for info in infos:
+            self.apply(info)
+
+    def get(self, node_id):
+        """Return the delta of the node, or None if not in the index."""
+        if not self.loaded:
+            return self.cache.get(node_id)
+        return self.nodes.get(node_id)
+
+    def listdir(self, node_id):
+        """Return the deltas of the children of the node."""
+        self._load()
+        nodes = self.nodes
+        return [
+            nodes[child_id]
+            for child_id in self.children.get(node_id, {}).values()
+        ]
+
+    def lookup(self, path):
+        """Return the delta of the node at path (from the volume root).
+
+        Return None if there's no node there.
+
+        """
+        self._load()
+        node_id = self.root_id
+        for name in path.split('/'):
+            if not name:
+                continue
+            node_id = self.children.get(node_id, {}).get(name)
+            if node_id is None:
+                return None
+        return self.nodes.get(node_id)
+
+    def update(self, client):
+        """Get the missing generations of the volume, and apply them.
+
+        It's a full listing the first time, and a delta from the index's
+        generation after that. Return a deferred that fires with the
+        index when it's up to date.
+
+        What a full listing that didn't finish left is dropped before
+        listing again, as the nodes removed since would be kept.
+
+        """
+        if self.generation is None:
+            self._clear()
+        d = client.get_delta(
+            self.volume_id,
+            from_generation=self.generation,
+            callback=self.apply,
+            from_scratch=self.generation is None,
+        )
+        d.addCallback(self._updated, client)
+        return d
+
+    def _updated(self, req, client):
+        """The delta finished, ask again if there's more."""
+        if self.generation is None or req.end_generation > self.generation:
+            self.generation = req.end_generation
+        if self.cache is not None:
+            self.cache.set_generation(self.generation)
+        if not req.full:
+            return self.update(client)
+        return self
+
+
+class VolumeIndexUpdater:
+    """Keep volume indexes up to date with the volumes' new generations.
+
+    The updater registers itself as the client's volume new generation
+    callback, and updates the index of the volume only when the
+    notified generation is newer than what the index has.
+
+    @ivar indexes: the VolumeIndex of each volume, by volume id
+    """
+
+    def __init__(self, client):
+        """Create the updater, listening to client's notifications."""
+        self.client = client
+        self.indexes = {}
+        self.updating = {}
+        self.wanted = {}
+        client.set_volume_new_generation_callback(self.new_generation)
+
+    def add(self, volume_id, cache=None):
+        """Start indexing the volume, return a deferred with its index.
+
+        If given, the index starts from what's in the DeltaCache.
+
+        """
+        key = str(volume_id)
+        if key not in self.indexes:
+            self.indexes[key] = VolumeIndex(volume_id, cache)
+        return self.refresh(volume_id)
+
+    def get(self, volume_id):
+        """Return the index of the volume, None if not indexed."""
+        return self.indexes.get(str(volume_id))
+
+    def new_generation(self, volume_id, generation):
+        """The volume is at a new generation, update its index if behind."""
+        index = self.get(volume_id)
+        if index is None:
+            return
+        if index.generation is None or generation > index.generation:
+            self.refresh(volume_id, generation)
+
+    def refresh(self, volume_id, generation=None):
+        """Update the index of the volume, if not being updated.
+
+        If it's being updated and a newer generation is wanted, update it
+        again when the current update finishes.
+
+        """
+        key = str(volume_id)
+        index = self.indexes[key]
+        if key in self.updating:
+            if generation is not None:
+                self.wanted[key] = max(self.wanted.get(key, 0), generation)
+            return self.updating[key]
+
+        d = defer.Deferred()
+        self.updating[key] = d
+        update = index.update(self.client)
+        update.addBoth(self._refreshed, key, d)
+        return d
+
+    def _refreshed(self, result, key, d):
+        """The update finished; update again if needed, or fire d."""
+        del self.updating[key]
+        index = self.indexes[key]
+        wanted = self.wanted.pop(key, None)
+        if (
+            wanted is not None
+            and index.generation is not None
+            and index.generation < wanted
+        ):
+            next_d = self.refresh(index.volume_id, wanted)
+            next_d.chainDeferred(d)
+        else:
+            d.callback(result)